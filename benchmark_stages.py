@@ -0,0 +1,211 @@
+"""
+Stage-level benchmark of the closed-loop printing pipeline
+
+This file times the hot path of a job on synthetic data, without a printer
+or camera attached: layer splitting (parse_layer / split_layers), the
+G-code layer index (build and get_layer_coordinates), contour projection,
+defect mask extraction, full and incremental labeling of consecutive
+layers, ironing layer generation, and stable picture taking
+against a replayed frame source. For every stage it reports per-call
+latency percentiles and the peak Python / NumPy memory of one call.
+
+Example:
+    python benchmark_stages.py --layers 10,100,1000 --contours 1,16 --json bench.json
+
+The calibration file and picture position default to settings.py.
+"""
+
+import os
+import json
+import time
+import shutil
+import tempfile
+import argparse
+import tracemalloc
+import numpy as np
+
+from synthetic_data import generate_gcode, FrameRenderer, FrameReplay
+from layer_parsing_separate import parse_layer, split_layers
+from layer_store import LayerStore
+from gcode_layer_index import GcodeLayerIndex, load_layer_index
+from gcode_layer_visualization import get_layer_coordinates
+from gcode_ironing import generate_iron_layer
+from defect_detection import DefectDetection
+from incremental_detection import IncrementalDetection
+import settings as config
+from camera_control import CameraControl
+from calibration import load_calibration
+
+
+def percentiles(samples):
+    samples = np.asarray(samples, dtype=np.float64) * 1000.
+    return {"n": len(samples), "mean_ms": float(samples.mean()),
+            "p50_ms": float(np.percentile(samples, 50)), "p90_ms": float(np.percentile(samples, 90)),
+            "p99_ms": float(np.percentile(samples, 99)), "max_ms": float(samples.max())}
+
+
+# peak traced memory of one call, in bytes
+def peak_memory(fn, *args, **kwargs):
+    tracemalloc.start()
+    try:
+        fn(*args, **kwargs)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+class StageBenchmark:
+    """
+    Collects latency samples and memory peaks per stage
+    """
+    def __init__(self):
+        self.samples = {}
+        self.memory = {}
+
+    def time(self, stage, fn, *args, **kwargs):
+        start = time.perf_counter()
+        result = fn(*args, **kwargs)
+        self.samples.setdefault(stage, []).append(time.perf_counter() - start)
+        return result
+
+    def measure_memory(self, stage, fn, *args, **kwargs):
+        self.memory[stage] = peak_memory(fn, *args, **kwargs)
+
+    def report(self):
+        report = {}
+        for stage, samples in self.samples.items():
+            report[stage] = percentiles(samples)
+            report[stage]["peak_mb"] = self.memory.get(stage, 0) / 1e6
+        return report
+
+
+def run_suite(workdir, config, calibration, num_layer, num_contour, points_per_contour = 120, num_defect = 5,
+              frame_layers = 10, stable_pics = 3, fps = 30., jitter_frames = 5, roi_mode = False, seed = 0):
+    rng = np.random.default_rng(seed)
+    bench = StageBenchmark()
+    center = (config.img_taken_position[0] - calibration.T_nozzle_cam[0, 3],
+              config.img_taken_position[1] + calibration.T_nozzle_cam[1, 3])
+    gcode_path = generate_gcode(os.path.join(workdir, "part.gcode"), num_layer, num_contour, points_per_contour,
+                                center=center, layer_height=config.layer_height)
+    layers = list(range(1, num_layer + 1))
+    sample_layers = sorted(set(np.linspace(1, num_layer, min(frame_layers, num_layer)).astype(int).tolist()))
+
+    # layer splitting, whole file
+    object_dir = os.path.join(workdir, "object") + os.sep
+    wipe_dir = os.path.join(workdir, "wipe") + os.sep
+    os.makedirs(object_dir, exist_ok=True)
+    os.makedirs(wipe_dir, exist_ok=True)
+    bench.time("parse_layer", parse_layer, gcode_path, object_dir, wipe_dir)
+    bench.measure_memory("parse_layer", parse_layer, gcode_path, object_dir, wipe_dir)
+    layer_store = bench.time("split_layers", split_layers, gcode_path, LayerStore(), camera_position=center)
+    bench.measure_memory("split_layers", split_layers, gcode_path, LayerStore(), camera_position=center)
+
+    # layer index, built once then queried per layer
+    bench.time("build_layer_index", GcodeLayerIndex.build, gcode_path)
+    bench.measure_memory("build_layer_index", GcodeLayerIndex.build, gcode_path)
+    load_layer_index(gcode_path)
+    for layerID in layers:
+        bench.time("get_layer_coordinates", get_layer_coordinates, gcode_path, layerID, 2)
+    bench.measure_memory("get_layer_coordinates", get_layer_coordinates, gcode_path, layers[-1], 2)
+
+    # detection on rendered frames
+    detector = DefectDetection.from_calibration(calibration, gcode_path, workdir + os.sep, config.img_taken_position,
+                                                config.layer_height, roi_mode=roi_mode)
+    renderer = FrameRenderer(detector)
+    frames = []
+    for layerID in sample_layers:
+        frame, _ = renderer.render(layerID, num_defect, rng=rng)
+        frames.append(frame)
+        cropped_img, roi = bench.time("project_contour", detector.project_contour, frame, layerID, False)
+        bench.time("get_defect_mask", detector.get_defect_mask, cropped_img, config.binary_threshold)
+    bench.measure_memory("project_contour", detector.project_contour, frames[-1], sample_layers[-1], False)
+    bench.measure_memory("get_defect_mask", detector.get_defect_mask, cropped_img, config.binary_threshold)
+
+    # full against incremental labeling of consecutive layers, defects persisting over three layers
+    incremental = IncrementalDetection()
+    max_area = detector.max_area()
+    for layerID in range(1, min(frame_layers, num_layer) + 1):
+        frame, _ = renderer.render(layerID, num_defect, rng=np.random.default_rng((seed, layerID // 3)))
+        cropped_img, roi = detector.project_contour(frame, layerID, False)
+        homography = detector.layer_homography(layerID - 1, layerID) if layerID > 1 else None
+        blurred = detector.preprocess(cropped_img)
+        bench.time("label_full", detector.get_defects, cropped_img, config.binary_threshold, blurred=blurred,
+                   offset=roi[:2])
+        bench.time("label_incremental", incremental.detect, layerID, blurred, cropped_img[:, :, 3], roi, homography,
+                   config.binary_threshold, max_area=max_area)
+
+    # ironing layers
+    for layerID in sample_layers:
+        output_path = os.path.join(workdir, "layer_{}_cor.gcode".format(layerID))
+        bench.time("generate_iron_layer", generate_iron_layer, object_dir + "layer_{}.gcode".format(layerID),
+                   output_path)
+    bench.measure_memory("generate_iron_layer", generate_iron_layer,
+                         object_dir + "layer_{}.gcode".format(sample_layers[-1]), output_path)
+    # ironing layers from the template kept per layer, as the orchestrator generates them
+    for layerID in sample_layers:
+        template = bench.time("ironing_template", layer_store.ironing_template, "layer_{}".format(layerID))
+        bench.time("ironing_emit", template.emit)
+
+    # stable picture against a replayed frame source
+    replay = FrameReplay(frames[:1], fps=fps, jitter_frames=jitter_frames)
+    camera = CameraControl(capture=replay)
+    for _ in range(stable_pics):
+        replay.settle()
+        bench.time("take_stable_pic", camera.take_stable_pic)
+    replay.settle()
+    bench.measure_memory("take_stable_pic", camera.take_stable_pic)
+    camera.turn_off_cam()
+
+    report = bench.report()
+    for stage in ("parse_layer", "split_layers", "build_layer_index"):
+        report[stage]["per_layer_ms"] = report[stage]["mean_ms"] / num_layer
+    return report
+
+
+def print_report(title, report):
+    print(title)
+    print("  {:<24}{:>6}{:>11}{:>11}{:>11}{:>11}{:>11}".format(
+        "stage", "n", "p50 ms", "p90 ms", "p99 ms", "max ms", "peak MB"))
+    for stage, r in report.items():
+        print("  {:<24}{:>6}{:>11.2f}{:>11.2f}{:>11.2f}{:>11.2f}{:>11.2f}".format(
+            stage, r["n"], r["p50_ms"], r["p90_ms"], r["p99_ms"], r["max_ms"], r["peak_mb"]))
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline stages on synthetic data")
+    parser.add_argument("--layers", default="20", help="comma separated layer counts, e.g. 10,100,1000")
+    parser.add_argument("--contours", default="1", help="comma separated contours per layer")
+    parser.add_argument("--points", type=int, default=120, help="points per contour")
+    parser.add_argument("--defects", type=int, default=5, help="holes injected per frame")
+    parser.add_argument("--frame-layers", type=int, default=10, help="layers rendered and analysed")
+    parser.add_argument("--stable-pics", type=int, default=3)
+    parser.add_argument("--fps", type=float, default=30.)
+    parser.add_argument("--roi", action="store_true", help="run the detector in ROI mode")
+    parser.add_argument("--calibration", default=None, help="calibration file, defaults to settings.py")
+    parser.add_argument("--workdir", default=None, help="kept after the run if given")
+    parser.add_argument("--json", default=None, help="write all results to this file")
+    args = parser.parse_args(argv)
+
+    calibration = load_calibration(config.calibration_path if args.calibration is None else args.calibration)
+    results = []
+    for num_layer in [int(v) for v in args.layers.split(",")]:
+        for num_contour in [int(v) for v in args.contours.split(",")]:
+            workdir = args.workdir or tempfile.mkdtemp(prefix="clp_bench_")
+            workdir = os.path.join(workdir, "L{}_C{}".format(num_layer, num_contour))
+            os.makedirs(workdir, exist_ok=True)
+            try:
+                report = run_suite(workdir, config, calibration, num_layer, num_contour, args.points, args.defects,
+                                   args.frame_layers, args.stable_pics, args.fps, roi_mode=args.roi)
+            finally:
+                if args.workdir is None:
+                    shutil.rmtree(os.path.dirname(workdir))
+            print_report("{} layers, {} contours per layer".format(num_layer, num_contour), report)
+            results.append({"layers": num_layer, "contours": num_contour, "roi": args.roi, "stages": report})
+
+    if args.json is not None:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
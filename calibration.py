@@ -0,0 +1,177 @@
+"""
+Camera calibration store
+
+This file keeps the camera intrinsics, distortion coefficients and the
+nozzle to camera transform in a JSON file instead of constants in the main
+script. The undistortion camera matrix and remap tables derived from them
+are cached next to the file, keyed by the calibration hash, in the compact
+fixed-point map format (CV_16SC2), and memory-mapped on reload. A calibration
+can be loaded for another capture resolution of the same sensor (e.g. native
+3840x2160 instead of 1920x1080): the intrinsics are scaled to it, which
+assumes both modes see the same field of view.
+"""
+
+import os
+import json
+import shutil
+import hashlib
+import numpy as np
+import cv2 as cv
+
+CALIBRATION_VERSION = 1
+
+_MAP_COLUMNS = ("undistort_camera_matrix", "map1", "map2")
+
+# calibrations already loaded in this process, keyed by (path, mtime, size)
+_loaded_calibrations = {}
+
+
+# camera matrix of the image resized by (sx, sy), about the pixel centres
+def scale_camera_matrix(camera_matrix, sx, sy):
+    camera_matrix = np.array(camera_matrix, dtype=np.float64)
+    camera_matrix[0, 0] *= sx
+    camera_matrix[1, 1] *= sy
+    camera_matrix[0, 2] = (camera_matrix[0, 2] + 0.5) * sx - 0.5
+    camera_matrix[1, 2] = (camera_matrix[1, 2] + 0.5) * sy - 0.5
+    return camera_matrix
+
+
+class Calibration:
+    """
+    Camera intrinsics, distortion, nozzle to camera transform and undistortion maps
+    """
+    def __init__(self, camera_matrix, dist_coeffs, T_nozzle_cam, img_shape = (1920, 1080), alpha = 1,
+                 path = None):
+        self.camera_matrix = np.asarray(camera_matrix, dtype=np.float64)
+        self.dist_coeffs = np.asarray(dist_coeffs, dtype=np.float64)
+        self.T_nozzle_cam = np.asarray(T_nozzle_cam, dtype=np.float64)
+        self.img_shape = tuple(int(v) for v in img_shape)
+        self.alpha = alpha
+        self.path = path
+        self.hash = self.calibration_hash()
+
+        self.undistort_camera_matrix = None
+        self.map1 = None
+        self.map2 = None
+
+    def calibration_hash(self):
+        h = hashlib.sha1()
+        for array in (self.camera_matrix, self.dist_coeffs, self.T_nozzle_cam):
+            h.update(np.ascontiguousarray(array).tobytes())
+        h.update(json.dumps([self.img_shape, self.alpha]).encode())
+        return h.hexdigest()
+
+    def to_dict(self):
+        return {"camera_matrix": self.camera_matrix.tolist(), "dist_coeffs": self.dist_coeffs.tolist(),
+                "T_nozzle_cam": self.T_nozzle_cam.tolist(), "img_shape": list(self.img_shape), "alpha": self.alpha}
+
+    # human-readable JSON, one matrix row per line
+    def save(self, path):
+        items = []
+        for name, value in self.to_dict().items():
+            if isinstance(value, list) and value and isinstance(value[0], list):
+                rows = ",\n".join("    " + json.dumps(row) for row in value)
+                items.append('  "{}": [\n{}\n  ]'.format(name, rows))
+            else:
+                items.append('  "{}": {}'.format(name, json.dumps(value)))
+        with open(path, "w") as f:
+            f.write("{\n" + ",\n".join(items) + "\n}\n")
+        self.path = path
+
+    # the same camera captured at another resolution
+    def scaled(self, img_shape):
+        img_shape = tuple(int(v) for v in img_shape)
+        camera_matrix = scale_camera_matrix(self.camera_matrix, img_shape[0] / self.img_shape[0],
+                                            img_shape[1] / self.img_shape[1])
+        return Calibration(camera_matrix, self.dist_coeffs, self.T_nozzle_cam, img_shape, self.alpha, self.path)
+
+    # compute the undistortion camera matrix and the fixed-point remap tables
+    def compute_maps(self):
+        self.undistort_camera_matrix, roi = cv.getOptimalNewCameraMatrix(self.camera_matrix, self.dist_coeffs,
+                                                                         self.img_shape, self.alpha, self.img_shape)
+        mapx, mapy = cv.initUndistortRectifyMap(self.camera_matrix, self.dist_coeffs, None,
+                                                self.undistort_camera_matrix, self.img_shape, cv.CV_32FC1)
+        self.map1, self.map2 = cv.convertMaps(mapx, mapy, cv.CV_16SC2)
+
+    # (undistort_camera_matrix, map1, map2), computed on first use
+    def undistortion(self):
+        if self.map1 is None:
+            self.compute_maps()
+        return self.undistort_camera_matrix, self.map1, self.map2
+
+    # write the derived arrays as .npy files so they can be memory-mapped
+    def save_maps(self, cache_dir):
+        self.undistortion()
+        tmp_dir = cache_dir + ".tmp{}".format(os.getpid())
+        os.makedirs(tmp_dir, exist_ok=True)
+        for name in _MAP_COLUMNS:
+            np.save(os.path.join(tmp_dir, name + ".npy"), getattr(self, name))
+        with open(os.path.join(tmp_dir, "meta.json"), "w") as f:
+            json.dump({"version": CALIBRATION_VERSION, "hash": self.hash}, f)
+        if os.path.isdir(cache_dir):
+            shutil.rmtree(cache_dir)
+        os.replace(tmp_dir, cache_dir)
+
+    def load_maps(self, cache_dir, mmap_mode = "r"):
+        with open(os.path.join(cache_dir, "meta.json"), "r") as f:
+            meta = json.load(f)
+        if meta.get("version") != CALIBRATION_VERSION:
+            raise ValueError("Calibration cache version mismatch: {}".format(cache_dir))
+        if meta.get("hash") != self.hash:
+            raise ValueError("Calibration cache hash mismatch: {}".format(cache_dir))
+        for name in _MAP_COLUMNS:
+            setattr(self, name, np.load(os.path.join(cache_dir, name + ".npy"), mmap_mode=mmap_mode))
+
+    # worker processes reload a calibration file from its cache instead of receiving the maps
+    def __reduce__(self):
+        if self.path is not None:
+            return (load_calibration, (self.path, True, self.img_shape))
+        return (Calibration, (self.camera_matrix, self.dist_coeffs, self.T_nozzle_cam, self.img_shape, self.alpha))
+
+
+def cache_dir_path(calibration_path, calibration_hash):
+    return "{}.{}.calibcache".format(calibration_path, calibration_hash[:16])
+
+
+# write a calibration file
+def save_calibration(calibration_path, camera_matrix, dist_coeffs, T_nozzle_cam, img_shape = (1920, 1080),
+                     alpha = 1):
+    calibration = Calibration(camera_matrix, dist_coeffs, T_nozzle_cam, img_shape, alpha)
+    calibration.save(calibration_path)
+    return calibration
+
+
+# load a calibration file, computing and caching its undistortion maps on disk the first time
+# img_shape: capture resolution (width, height) if it differs from the one of the file
+def load_calibration(calibration_path, use_disk_cache = True, img_shape = None):
+    stat = os.stat(calibration_path)
+    key = (os.path.abspath(calibration_path), stat.st_mtime_ns, stat.st_size,
+           None if img_shape is None else tuple(int(v) for v in img_shape))
+    if key in _loaded_calibrations:
+        return _loaded_calibrations[key]
+
+    with open(calibration_path, "r") as f:
+        values = json.load(f)
+    calibration = Calibration(values["camera_matrix"], values["dist_coeffs"], values["T_nozzle_cam"],
+                              values.get("img_shape", (1920, 1080)), values.get("alpha", 1), path=calibration_path)
+    if img_shape is not None and tuple(img_shape) != calibration.img_shape:
+        calibration = calibration.scaled(img_shape)
+
+    cache_dir = cache_dir_path(calibration_path, calibration.hash)
+    loaded = False
+    if use_disk_cache and os.path.isdir(cache_dir):
+        try:
+            calibration.load_maps(cache_dir)
+            loaded = True
+        except (OSError, ValueError) as err:
+            print("Rebuilding undistortion maps: {}".format(err))
+    if not loaded:
+        calibration.compute_maps()
+        if use_disk_cache:
+            try:
+                calibration.save_maps(cache_dir)
+            except OSError as err:
+                print("Could not cache undistortion maps: {}".format(err))
+
+    _loaded_calibrations[key] = calibration
+    return calibration
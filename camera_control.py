@@ -1,20 +1,95 @@
 import cv2
 import time
+import threading
 import numpy as np
-import copy
+from collections import deque
 
 class CameraControl:
     """
     Class for establishing connection with camera
+
+    By default a background thread grabs frames continuously into a ring buffer
+    of preallocated frames, so a picture is always a fresh frame and never one
+    left over in the driver buffer.
     """
-    def __init__(self, camera_id = 0, resolution = (1920, 1080)):
-        self.cap = cv2.VideoCapture(camera_id)
+    def __init__(self, camera_id = 0, resolution = (1920, 1080), buffer_size = 4, background_grab = True,
+                 stability_roi = None, stability_downsample = 4, capture = None):
+        # capture: object with the cv2.VideoCapture interface to use instead of camera_id
+        self.cap = cv2.VideoCapture(camera_id) if capture is None else capture
         self.set_resolution(resolution)
-    
+
+        # stability check on a downsampled region (x0, y0, x1, y1) of the frame
+        self.stability_roi = stability_roi
+        self.stability_downsample = stability_downsample
+
+        # ring buffer filled by the grab thread
+        self.buffer_size = max(buffer_size, 2)
+        self.frames = None
+        self.frame_times = [0.] * self.buffer_size
+        self.frame_count = 0
+        self.frame_cond = threading.Condition()
+        self.grabbing = False
+        self.grab_thread = None
+        if background_grab:
+            self.start_grabbing()
+
     def set_resolution(self, resolution):
         self.cap.set(cv2.CAP_PROP_FRAME_WIDTH, resolution[0])
         self.cap.set(cv2.CAP_PROP_FRAME_HEIGHT, resolution[1])
 
+    def start_grabbing(self):
+        if not self.cap.isOpened():
+            raise RuntimeError("Camera is not opened")
+        self.grabbing = True
+        self.grab_thread = threading.Thread(target=self._grab_loop, daemon=True)
+        self.grab_thread.start()
+
+    def stop_grabbing(self):
+        self.grabbing = False
+        if self.grab_thread is not None:
+            self.grab_thread.join()
+            self.grab_thread = None
+
+    def _grab_loop(self):
+        while self.grabbing:
+            # the slot being written is never the newest frame, readers copy the newest one
+            slot = self.frame_count % self.buffer_size
+            if self.frames is None:
+                ret_flag, img = self.cap.read()
+            else:
+                ret_flag, img = self.cap.read(self.frames[slot])
+            if not ret_flag:
+                time.sleep(0.01)
+                continue
+
+            with self.frame_cond:
+                if self.frames is None or self.frames.shape[1:] != img.shape:
+                    self.frames = np.empty((self.buffer_size,) + img.shape, dtype=img.dtype)
+                    self.frames[:] = img
+                elif not np.shares_memory(img, self.frames[slot]):
+                    self.frames[slot] = img
+                self.frame_times[slot] = time.time()
+                self.frame_count += 1
+                self.frame_cond.notify_all()
+
+    # wait for a frame grabbed after frame number `after`, returns the frame and its number
+    def next_frame(self, after = None, timeout = 5.):
+        img, count, grab_time = self.next_timed_frame(after, timeout)
+        return img, count
+
+    # like next_frame, also returns the time the frame was grabbed
+    def next_timed_frame(self, after = None, timeout = 5.):
+        if not self.grabbing:
+            grab_time = time.time()
+            return self.get_pic(), None, grab_time
+        with self.frame_cond:
+            if after is None:
+                after = self.frame_count
+            if not self.frame_cond.wait_for(lambda: self.frame_count > after, timeout):
+                raise TimeoutError("No frame from camera within {} s".format(timeout))
+            slot = (self.frame_count - 1) % self.buffer_size
+            return self.frames[slot].copy(), self.frame_count, self.frame_times[slot]
+
     def take_pic(self, img_path, layerID):
         # img = self.get_pic()
         img = self.take_stable_pic()
@@ -22,28 +97,54 @@ class CameraControl:
         print("success to save layer_{}.jpg".format(layerID))
 
     def get_pic(self):
-        while(not self.cap.isOpened()): # check camera status
-            pass
+        if self.grabbing:
+            return self.next_frame()[0]
+        if not self.cap.isOpened(): # check camera status
+            raise RuntimeError("Camera is not opened")
 
         ret_flag, img = self.cap.read() # get img
         return img
-    
-    def take_stable_pic(self, delay_time = 0.5, diff_threshold = 1.):
-        diff_mean = 100
-        img1 = self.get_pic()
-        img1_gray = cv2.cvtColor(img1, cv2.COLOR_BGR2GRAY)
 
-        while diff_mean > diff_threshold or diff_mean == 0:
-            time.sleep(delay_time)
-            img2 = self.get_pic()
-            img2_gray = cv2.cvtColor(img2, cv2.COLOR_BGR2GRAY)
+    # downsampled grayscale region used to judge stability, area averaging also averages out sensor noise
+    def stability_image(self, img):
+        if self.stability_roi is not None:
+            x0, y0, x1, y1 = self.stability_roi
+            img = img[y0:y1, x0:x1]
+        step = self.stability_downsample
+        size = (max(img.shape[1] // step, 1), max(img.shape[0] // step, 1))
+        return cv2.cvtColor(cv2.resize(img, size, interpolation=cv2.INTER_AREA), cv2.COLOR_BGR2GRAY)
 
-            img_diff = cv2.subtract(img1_gray, img2_gray)
-            diff_mean = np.mean(img_diff)
-            print("img_diff: ", diff_mean)
-            img1_gray = copy.copy(img2_gray)
+    # return the first frame after `stable_frames` consecutive frames changed less than diff_threshold
+    # (mean absolute difference of the stability images) from the frame about delay_time before them,
+    # so a slow sway of the head is not taken for a stable picture
+    def take_stable_pic(self, delay_time = 0.5, diff_threshold = 2., stable_frames = 3, timeout = 10.):
+        start_time = time.time()
+        img, count, grab_time = self.next_timed_frame()
+        # stability images of the last frames, oldest first
+        history = deque([(grab_time, self.stability_image(img))])
+        num_stable = 0
+        diff_mean = None
 
-        return img1
+        while num_stable < stable_frames:
+            if time.time() - start_time > timeout:
+                print("camera not stable after {} s, using latest frame".format(timeout))
+                break
+            if not self.grabbing:
+                time.sleep(delay_time)
+            img, count, grab_time = self.next_timed_frame(count)
+            img_gray = self.stability_image(img)
+
+            # reference: the newest frame grabbed at least delay_time earlier
+            while len(history) > 1 and history[1][0] <= grab_time - delay_time:
+                history.popleft()
+            if history[0][0] <= grab_time - delay_time:
+                diff_mean = np.mean(cv2.absdiff(history[0][1], img_gray))
+                num_stable = num_stable + 1 if diff_mean < diff_threshold else 0
+            history.append((grab_time, img_gray))
+
+        print("img_diff: ", diff_mean)
+        return img
 
     def turn_off_cam(self):
+        self.stop_grabbing()
         self.cap.release()
@@ -0,0 +1,92 @@
+"""
+Precomputed per-layer projection masks
+
+This file builds the XOR mask of the projected G-code contours and the
+polyline overlay for every layer ahead of time, in a process pool, so that
+the online detection only has to apply a ready mask to the captured frame.
+Masks are stored cropped to their bounding box and bit-packed.
+"""
+
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+
+# detector living in each worker process
+_worker_detector = None
+
+
+class LayerMask:
+    """
+    Bounding-box-cropped, bit-packed contour mask of one layer
+    """
+    def __init__(self, mask, bbox, polylines, img_size):
+        # bbox: (x0, y0, x1, y1) in undistorted image pixels, img_size: (width, height)
+        self.bbox = bbox
+        self.crop_shape = mask.shape
+        self.bits = np.packbits(mask > 0)
+        self.polylines = polylines
+        self.img_size = img_size
+
+    @property
+    def empty(self):
+        return self.crop_shape[0] == 0 or self.crop_shape[1] == 0
+
+    # mask cropped to the bounding box, 0 / 255
+    def crop(self):
+        size = self.crop_shape[0] * self.crop_shape[1]
+        mask = np.unpackbits(self.bits, count=size).reshape(self.crop_shape)
+        return mask * np.uint8(255)
+
+    # mask of the image region x0:x1, y0:y1
+    def region(self, x0, y0, x1, y1):
+        mask = np.zeros((y1 - y0, x1 - x0), dtype=np.uint8)
+        if self.empty:
+            return mask
+        bx0, by0, bx1, by1 = self.bbox
+        ix0, iy0, ix1, iy1 = max(x0, bx0), max(y0, by0), min(x1, bx1), min(y1, by1)
+        if ix0 < ix1 and iy0 < iy1:
+            mask[iy0-y0:iy1-y0, ix0-x0:ix1-x0] = self.crop()[iy0-by0:iy1-by0, ix0-bx0:ix1-bx0]
+        return mask
+
+    # mask at full image size
+    def full(self):
+        (width, height) = self.img_size
+        return self.region(0, 0, width, height)
+
+    def nbytes(self):
+        return self.bits.nbytes + sum(p.nbytes for p in self.polylines)
+
+
+def _init_worker(detector_args, detector_kwargs):
+    global _worker_detector
+    from defect_detection import DefectDetection
+    _worker_detector = DefectDetection(*detector_args, **detector_kwargs)
+
+
+def _compute_layer_mask(layerID):
+    return _worker_detector.build_layer_mask(layerID)
+
+
+class LayerMaskPrecompute:
+    """
+    Compute the layer masks in a background process pool
+    """
+    def __init__(self, defect_detector, layers, processes = None):
+        detector_args, detector_kwargs = defect_detector.init_args()
+        self.executor = ProcessPoolExecutor(processes, initializer=_init_worker,
+                                            initargs=(detector_args, detector_kwargs))
+        self.futures = {}
+        for layerID in layers:
+            self.futures[layerID] = self.executor.submit(_compute_layer_mask, layerID)
+
+    # mask of a layer, waits if it is still being computed, None if it was not requested
+    def get(self, layerID):
+        future = self.futures.get(layerID)
+        if future is None:
+            return None
+        return future.result()
+
+    def done(self):
+        return all(future.done() for future in self.futures.values())
+
+    def shutdown(self, wait = True):
+        self.executor.shutdown(wait=wait, cancel_futures=not wait)
@@ -1,31 +1,88 @@
 import cv2 as cv
 import numpy as np
-from gcode_layer_visualization import get_layer_coordinates
+from gcode_layer_index import load_layer_index
+from contour_masks import LayerMask
+from defect_extraction import extract_defects, span_pixels, REFERENCE_WIDTH
+from image_writer import DEFAULT_FORMATS
+from calibration import Calibration
+from incremental_detection import IncrementalDetection
+from multiscale_detection import MultiscaleDetection
 import copy
-import matplotlib.pyplot as plt
 np.set_printoptions(suppress=True)
 
 class DefectDetection:
     def __init__(self, camera_matrix, dist_coeffs, T_nozzle_cam, 
-                 gcode_path, img_folder_path, img_taken_position, layer_height = 0.1):
-        # set camera intrinsic and extrinsic parameters
+                 gcode_path, img_folder_path, img_taken_position, layer_height = 0.1, 
+                 roi_mode = False, roi_margin = 8, calibration = None, incremental = False, multiscale = False):
+        # set camera intrinsic and extrinsic parameters, the undistortion maps are
+        # fixed-point (CV_16SC2) and loaded from the calibration cache when given (see calibration.py)
+        if calibration is None:
+            calibration = Calibration(camera_matrix, dist_coeffs, T_nozzle_cam)
+        self.calibration = calibration
         self.camera_matrix = camera_matrix
         self.dist_coeffs = dist_coeffs
-        self.img_shape = (1920, 1080)
-        self.undistort_camera_matrix, roi = cv.getOptimalNewCameraMatrix(self.camera_matrix, 
-        self.dist_coeffs, self.img_shape, 1, self.img_shape)
+        self.img_shape = calibration.img_shape
+        self.undistort_camera_matrix, self.undistort_map1, self.undistort_map2 = calibration.undistortion()
         self.undistort_dist_coeffs = np.array([0., 0., 0., 0., 0.])
-        self.undistort_mapx, self.undistort_mapy = cv.initUndistortRectifyMap(self.camera_matrix, self.dist_coeffs, None, 
-                                                                              self.undistort_camera_matrix, self.img_shape, 5)
         self.T_nozzle_cam = T_nozzle_cam
+
+        # pinhole model of the undistorted image on the printing plane, shared by
+        # pixels_to_printer and printer_to_pixels
+        self.pixel_f = (self.undistort_camera_matrix[0, 0] + self.undistort_camera_matrix[1, 1]) / 2
+        self.pixel_center = self.undistort_camera_matrix[:2, 2].copy()
+        self.pixel_scale = self.T_nozzle_cam[2, 3] / self.pixel_f * np.array([1., -1.])
+        # image centre relative to the nozzle, in printer frame
+        self.img_center_offset = np.array([-self.T_nozzle_cam[0, 3], self.T_nozzle_cam[1, 3], 0.])
         
         self.gcode_path = gcode_path
+        self.layer_index = load_layer_index(gcode_path)
         self.layer_height = layer_height
         self.nozzle_pos = [0, 0, 0]
 
         self.img_folder_path = img_folder_path
         self.img_taken_position = img_taken_position
 
+        # precomputed layer masks, anything with a get(layerID) method (see contour_masks.py)
+        self.layer_masks = None
+
+        # ROI mode: undistort and detect only inside the bounding box of the projected contours
+        self.roi_mode = roi_mode
+        self.roi_margin = roi_margin
+
+        # defect area bounds are given in pixels of a 1920 wide capture: the upper bound is scaled to the
+        # capture resolution to keep the same physical size, the lower one is kept to find smaller holes
+        self.area_scale = (self.img_shape[0] / REFERENCE_WIDTH) ** 2
+
+        # defects found in the last analysed image (structured array, see defect_extraction.py)
+        self.last_defects = None
+        self.last_spans = None
+
+        # incremental mode: reuse the previous layer's result in unchanged tiles (see incremental_detection.py)
+        self.incremental = IncrementalDetection() if incremental else None
+        # multi-scale mode for native resolution frames: screen a downsampled level, refine candidate
+        # tiles at full resolution (see multiscale_detection.py)
+        if incremental and multiscale:
+            raise ValueError("Incremental and multi-scale detection can not be combined")
+        self.multiscale = MultiscaleDetection() if multiscale else None
+
+        # debug images are written synchronously unless a writer is set (see image_writer.py)
+        self.image_writer = None
+
+    # detector using the camera parameters of a calibration file (see calibration.load_calibration)
+    @classmethod
+    def from_calibration(cls, calibration, gcode_path, img_folder_path, img_taken_position, layer_height = 0.1, 
+                         **kwargs):
+        return cls(calibration.camera_matrix, calibration.dist_coeffs, calibration.T_nozzle_cam, 
+                   gcode_path, img_folder_path, img_taken_position, layer_height, calibration = calibration, **kwargs)
+
+    # constructor arguments, used to rebuild the detector in worker processes
+    def init_args(self):
+        args = (self.camera_matrix, self.dist_coeffs, self.T_nozzle_cam, 
+                self.gcode_path, self.img_folder_path, self.img_taken_position)
+        return args, {"layer_height": self.layer_height, "roi_mode": self.roi_mode, "roi_margin": self.roi_margin, 
+                      "calibration": self.calibration, "incremental": self.incremental is not None, 
+                      "multiscale": self.multiscale is not None}
+
     def update_nozzle_pos(self, layerID):
         Z = (layerID - 1) * self.layer_height + 0.2
         self.nozzle_pos = [self.img_taken_position[0], self.img_taken_position[1], Z]
@@ -46,142 +103,234 @@ class DefectDetection:
 
         return T_printer_cam, tvec, rvec
     
-    # (NOT USED IN THIS PAPER) convert 2D pixel position to 3D position in the printer frame
-    def image_pixel_to_Gcode_position(self, defect_coord):
-        img_center_pos = copy.copy(self.nozzle_pos) # in printer frame
-        img_center_pos[0] -= self.T_nozzle_cam[0, 3]
-        img_center_pos[1] += self.T_nozzle_cam[1, 3]
-
-        (w, h) = self.img_shape
-        undistort_camera_matrix, roi = cv.getOptimalNewCameraMatrix(self.camera_matrix, 
-                                                                    self.dist_coeffs, 
-                                                                    (w,h), 1, (w,h))
+    # homography from undistorted pixels of the surface of layer from_layerID, seen at that layer, 
+    # to the pixels of the same XY on the surface of layer to_layerID, seen at that layer
+    def layer_homography(self, from_layerID, to_layerID):
+        (width, height) = self.img_shape
+        corners = np.array([[0, 0], [width, 0], [width, height], [0, height]], dtype=np.float64)
+        img_points = []
+        for layerID in (from_layerID, to_layerID):
+            _, tvec, rvec = self.get_T_printer_cam(layerID)
+            if layerID == from_layerID:
+                printer_points = self.pixels_to_printer(corners)
+            z = self.layer_index.layer_height_z(layerID)
+            printer_points[:, 2] = self.nozzle_pos[2] if z is None else z
+            points, _ = cv.projectPoints(printer_points, rvec, tvec, self.undistort_camera_matrix, self.undistort_dist_coeffs)
+            img_points.append(points.reshape(-1, 2).astype(np.float32))
+        return cv.getPerspectiveTransform(img_points[0], img_points[1])
 
-        fx = undistort_camera_matrix[0, 0]
-        fy = undistort_camera_matrix[1, 1]
-        f = (fx + fy) / 2
-        cx = undistort_camera_matrix[0, 2]
-        cy = undistort_camera_matrix[1, 2]
-        depth = self.T_nozzle_cam[2, 3]
+    # image centre in printer frame for the current nozzle position, or for the given one
+    def img_center_pos(self, nozzle_pos = None):
+        nozzle_pos = self.nozzle_pos if nozzle_pos is None else nozzle_pos
+        return np.asarray(nozzle_pos, dtype=np.float64) + self.img_center_offset
 
-        dx = defect_coord[0] - cx
-        dy = defect_coord[1] - cy
+    # convert (N, 2) undistorted pixel positions to (N, 3) positions in the printer frame
+    def pixels_to_printer(self, pixels, nozzle_pos = None):
+        pixels = np.asarray(pixels, dtype=np.float64).reshape(-1, 2)
+        positions = np.empty((len(pixels), 3))
+        positions[:, :2] = (pixels - self.pixel_center) * self.pixel_scale
+        positions[:, 2] = 0.
+        return positions + self.img_center_pos(nozzle_pos)
 
-        dX_printer = depth / f * dx
-        dY_printer = -depth / f * dy
-        defect_pos = copy.copy(img_center_pos) + np.array([dX_printer, dY_printer, 0])
+    # convert (N, 2) or (N, 3) printer frame positions to (N, 2) undistorted pixel positions
+    def printer_to_pixels(self, positions, nozzle_pos = None):
+        positions = np.asarray(positions, dtype=np.float64)
+        offset = positions[:, :2] - self.img_center_pos(nozzle_pos)[:2]
+        return offset / self.pixel_scale + self.pixel_center
 
-        return defect_pos
+    # (NOT USED IN THIS PAPER) convert 2D pixel position to 3D position in the printer frame
+    def image_pixel_to_Gcode_position(self, defect_coord):
+        return self.pixels_to_printer(defect_coord)[0]
 
     # (NOT USED IN THIS PAPER)
     def get_Gcode_positions(self, defect_coords):
-        all_positions = []
-        for coord in defect_coords:
-            all_positions.append(self.image_pixel_to_Gcode_position(coord))
-        return all_positions
+        return self.pixels_to_printer(defect_coords)
     
     # (NOT USED IN THIS PAPER)
-    def defect_mask_to_positions(self, defect_mask, type):
+    def defect_mask_to_positions(self, defect_mask, type, offset = (0, 0)):
         # type 1: centroid
         # type 2: all points
-        analysis = cv.connectedComponentsWithStats(defect_mask, 8, cv.CV_32S)
-        (totalLabels, label_ids, values, centroid) = analysis
+        # offset: position of the mask in the full image (ROI mode)
+        defects, spans, _ = extract_defects(defect_mask, 1, np.inf, offset, with_spans = type == 2)
+        return self.defects_to_positions(defects, spans, type)
 
+    # (NOT USED IN THIS PAPER)
+    def defects_to_positions(self, defects, spans, type):
         if type == 1:
-            return self.get_Gcode_positions(centroid[1:])
+            return self.get_Gcode_positions(np.stack([defects["cx"], defects["cy"]], axis=1))
         elif type == 2:
-            defect_positions = []
-            for i in range(1, totalLabels):
-                pixels = np.argwhere(label_ids == i)
-                pixels = pixels[:, ::-1]
-                defect_positions.append(self.get_Gcode_positions(pixels))
-            return defect_positions
+            # map all defect pixels at once, then split per defect
+            pixels = span_pixels(spans, len(defects))
+            if len(pixels) == 0:
+                return []
+            positions = self.pixels_to_printer(np.concatenate(pixels))
+            return np.split(positions, np.cumsum([len(p) for p in pixels])[:-1])
 
     # get contour of certain layer from G-code
     def get_contours(self, layerID):
-        x, y, z = get_layer_coordinates(self.gcode_path, layerID, 2) # 2: perimeter
-        num_contour = len(x)
+        z = self.layer_index.layer_height_z(layerID)
         all_contours = []
-        for contour_id in range(num_contour):
-            size_contour = len(x[contour_id])
-            contour_points = np.zeros((size_contour, 3), np.float32)
-            contour_points[:, 0] = np.array(x[contour_id])
-            contour_points[:, 1] = np.array(y[contour_id])
+        for xy in self.layer_index.contour_points(layerID, 2): # 2: perimeter
+            contour_points = np.zeros((len(xy), 3), np.float32)
+            contour_points[:, :2] = xy
             contour_points[:, 2] = z
             all_contours.append(contour_points)
 
         return all_contours
     
-    # project contour from G-code to the image
-    def project_contour(self, img, layerID, save_projection_img = True):
-        img = cv.resize(img, self.img_shape)
-        img = cv.remap(img, self.undistort_mapx, self.undistort_mapy, cv.INTER_LINEAR)
-        height, width = img.shape[:2]
+    # project the contours of a layer to undistorted image pixels
+    def project_layer_points(self, layerID):
+        _, tvec, rvec = self.get_T_printer_cam(layerID)
+        all_points = []
+        for contour_points in self.get_contours(layerID):
+            img_points, _ = cv.projectPoints(contour_points, rvec, tvec, self.undistort_camera_matrix, self.undistort_dist_coeffs)
+            all_points.append(img_points.astype(np.int32))
+        return all_points
 
-        isClosed = True
-        contour_color = (255, 0, 0)
-        thickness = 2
-        img_contour = copy.copy(img)
+    # xor of the filled projected contours, cropped to their bounding box
+    def build_layer_mask(self, layerID):
+        (width, height) = self.img_shape
+        all_points = self.project_layer_points(layerID)
+        if len(all_points) == 0:
+            return LayerMask(np.zeros((0, 0), dtype=np.uint8), (0, 0, 0, 0), all_points, self.img_shape)
+
+        points = np.concatenate(all_points).reshape(-1, 2)
+        x0, y0 = np.clip(points.min(axis=0), 0, [width, height])
+        x1, y1 = np.clip(points.max(axis=0) + 1, 0, [width, height])
+        x0, y0, x1, y1 = int(x0), int(y0), int(max(x1, x0)), int(max(y1, y0))
 
         mask_color = (255, 255, 255)
-        masks = []
+        final_mask = np.zeros((y1 - y0, x1 - x0), dtype=np.uint8)
+        for img_points in all_points:
+            mask = np.zeros_like(final_mask)
+            cv.drawContours(mask, [img_points], 0, mask_color, thickness=cv.FILLED, offset=(-x0, -y0))
+            final_mask = cv.bitwise_xor(final_mask, mask)
 
-        _, tvec, rvec = self.get_T_printer_cam(layerID)
-        contours = self.get_contours(layerID)
-        for contour_points in contours:
-            img_points, _ = cv.projectPoints(contour_points, rvec, tvec, self.undistort_camera_matrix, self.undistort_dist_coeffs)
-            img_points.reshape(-1, 1, 2)
-            mask = np.zeros((height, width), dtype=np.uint8)
-            cv.drawContours(mask, [img_points.astype(np.int32)], 0, mask_color, thickness=cv.FILLED)
-            masks.append(mask)
+        return LayerMask(final_mask, (x0, y0, x1, y1), all_points, self.img_shape)
 
-            if save_projection_img:
-                img_contour = cv.polylines(img_contour, [img_points.astype(np.int32)],isClosed, contour_color, thickness)
+    def set_image_writer(self, image_writer):
+        self.image_writer = image_writer
 
-        if save_projection_img:
-            cv.imwrite(self.img_folder_path+"layer_{}_w_contour.jpg".format(layerID), img_contour)
+    def save_enabled(self, artifact):
+        return self.image_writer is None or self.image_writer.is_enabled(artifact)
 
-        # xor all masks
-        final_mask = np.zeros((height, width), dtype=np.uint8)
-        for mask in masks:
-            final_mask = cv.bitwise_xor(final_mask, mask)
+    # write a debug image of the given artifact type to the image folder, or to the run archive of the
+    # image writer (origin: position of the image in the frame)
+    def save_image(self, artifact, file_name, img, layerID = None, origin = (0, 0)):
+        if self.image_writer is not None:
+            self.image_writer.save(artifact, self.img_folder_path + file_name, img, layerID, origin = origin)
+        else:
+            cv.imwrite(self.img_folder_path + file_name + DEFAULT_FORMATS[artifact], img)
+
+    def set_layer_masks(self, layer_masks):
+        self.layer_masks = layer_masks
+
+    def get_layer_mask(self, layerID):
+        layer_mask = None
+        if self.layer_masks is not None:
+            layer_mask = self.layer_masks.get(layerID)
+        if layer_mask is None:
+            layer_mask = self.build_layer_mask(layerID)
+        return layer_mask
+
+    # image region (x0, y0, x1, y1) to process for a layer mask
+    def get_roi(self, layer_mask):
+        (width, height) = self.img_shape
+        if not self.roi_mode or layer_mask.empty:
+            return (0, 0, width, height)
+        x0, y0, x1, y1 = layer_mask.bbox
+        m = self.roi_margin
+        return (max(x0 - m, 0), max(y0 - m, 0), min(x1 + m, width), min(y1 + m, height))
+
+    # project contour from G-code to the image, returns (cropped_img, roi): the masked image of the
+    # region roi = (x0, y0, x1, y1) of the frame
+    def project_contour(self, img, layerID, save_projection_img = True):
+        self.update_nozzle_pos(layerID)
+        layer_mask = self.get_layer_mask(layerID)
+        roi = x0, y0, x1, y1 = self.get_roi(layer_mask)
+
+        # undistort only the region of interest with the sliced remap tables
+        if img.shape[1::-1] != self.img_shape:
+            img = cv.resize(img, self.img_shape)
+        img = cv.remap(img, self.undistort_map1[y0:y1, x0:x1], self.undistort_map2[y0:y1, x0:x1], cv.INTER_LINEAR)
+
+        isClosed = True
+        contour_color = (255, 0, 0)
+        thickness = 2
+
+        if save_projection_img and self.save_enabled("contour"):
+            polylines = [img_points - np.int32([x0, y0]) for img_points in layer_mask.polylines]
+            img_contour = cv.polylines(copy.copy(img), polylines, isClosed, contour_color, thickness)
+            self.save_image("contour", "layer_{}_w_contour".format(layerID), img_contour, layerID, (x0, y0))
+
+        final_mask = layer_mask.region(x0, y0, x1, y1)
 
         # crop out valid part
         dst = cv.bitwise_and(img, img, mask=final_mask)
 
         # make background white
-        dst[np.where(np.all(dst[..., :3] == 0, -1))] = 255
+        dst[final_mask == 0] = 255
         r,g,b = cv.split(dst)
 
         # merge and use mask as alpha channel
         cropped_img = cv.merge([r, g, b, final_mask], 4)
-        return cropped_img
+        return cropped_img, roi
     
-    # apply binary threshold and area-based filter to detect defects
-    def get_defect_mask(self, cropped_img, binary_threshold = 90):
-        # Image pre processing
+    # grayscale and blur, shared by every binary threshold
+    def preprocess(self, cropped_img):
         grayImage = cv.cvtColor(cropped_img, cv.COLOR_BGR2GRAY)
+        return cv.GaussianBlur(grayImage, (5, 5), 0)
 
-        gaussianBlur = cv.GaussianBlur(grayImage, (5, 5), 0)
+    # upper defect area bound in pixels of the capture resolution, max_threshold given for a 1920 wide capture
+    def max_area(self, max_threshold = 200):
+        return int(round(max_threshold * self.area_scale))
+
+    # apply binary threshold and area-based filter to detect defects
+    # returns (defects, spans, defect_mask), see defect_extraction.extract_defects
+    def get_defects(self, cropped_img, binary_threshold = 90, min_threshold = 10, max_threshold = 200, 
+                    blurred = None, offset = (0, 0), with_spans = False):
+        # Image pre processing
+        gaussianBlur = self.preprocess(cropped_img) if blurred is None else blurred
         ret, binary = cv.threshold(gaussianBlur, binary_threshold, 255, cv.THRESH_BINARY_INV)
 
-        min_threshold = 10
-        max_threshold = 200
-        defect_mask = copy.copy(binary)
-        analysis = cv.connectedComponentsWithStats(defect_mask, 8, cv.CV_32S)
-        (totalLabels, label_ids, values, centroid) = analysis
-        for i in range(1, totalLabels):
-            if values[i, 4] < min_threshold or values[i, 4] > max_threshold:
-                defect_mask[label_ids == i] = 0
+        return extract_defects(binary, min_threshold, self.max_area(max_threshold), offset, with_spans)
 
+    def get_defect_mask(self, cropped_img, binary_threshold = 90, min_threshold = 10, max_threshold = 200, 
+                        blurred = None):
+        _, _, defect_mask = self.get_defects(cropped_img, binary_threshold, min_threshold, max_threshold, blurred)
         return defect_mask
 
+    # component areas of the thresholded image, for counting defects under many area bounds
+    def get_component_areas(self, blurred, binary_threshold = 90):
+        ret, binary = cv.threshold(blurred, binary_threshold, 255, cv.THRESH_BINARY_INV)
+        totalLabels, label_ids, values, centroid = cv.connectedComponentsWithStats(binary, 8, cv.CV_32S)
+        return values[1:, cv.CC_STAT_AREA]
+
     def get_defect_positions(self, img, layerID, type = 1, binary_threshold = 90):
         # type 1: centroid
         # type 2: all points
-        cropped_img = self.project_contour(img, layerID)
-        defect_mask = self.get_defect_mask(cropped_img, binary_threshold)
-        cv.imwrite(self.img_folder_path+"layer_{}_crop.png".format(layerID), cropped_img)
-        cv.imwrite(self.img_folder_path+"layer_{}_defect.png".format(layerID), defect_mask)
+        if self.multiscale is not None:
+            # the crop is the downsampled level, the full resolution region is never undistorted whole
+            defects, spans, defect_mask, roi, cropped_img, crop_origin = self.multiscale.detect(
+                self, img, layerID, binary_threshold, with_spans = type == 2)
+            self.last_defects, self.last_spans = defects, spans
+            self.save_image("crop", "layer_{}_crop".format(layerID), cropped_img, layerID, crop_origin)
+            self.save_image("defect", "layer_{}_defect".format(layerID), defect_mask, layerID, roi[:2])
+            return self.defects_to_positions(defects, spans, type)
+
+        cropped_img, roi = self.project_contour(img, layerID)
+        if self.incremental is not None:
+            homography = self.layer_homography(layerID - 1, layerID) if layerID > 1 else None
+            self.update_nozzle_pos(layerID)
+            defects, spans, defect_mask = self.incremental.detect(layerID, self.preprocess(cropped_img), 
+                                                                  cropped_img[:, :, 3], roi, homography, 
+                                                                  binary_threshold, max_area = self.max_area(), 
+                                                                  with_spans = type == 2)
+        else:
+            defects, spans, defect_mask = self.get_defects(cropped_img, binary_threshold, offset = roi[:2], 
+                                                           with_spans = type == 2)
+        self.last_defects, self.last_spans = defects, spans
+        self.save_image("crop", "layer_{}_crop".format(layerID), cropped_img, layerID, roi[:2])
+        self.save_image("defect", "layer_{}_defect".format(layerID), defect_mask, layerID, roi[:2])
 
-        return self.defect_mask_to_positions(defect_mask, type)
\ No newline at end of file
+        return self.defects_to_positions(defects, spans, type)
\ No newline at end of file
@@ -0,0 +1,102 @@
+"""
+Vectorized defect extraction from a binary image
+
+This file turns a thresholded image into defects: connected components are
+filtered by area with one label lookup table pass over the image, and all
+kept defects are returned as one structured array (label, area, bounding
+box, centroid). Optionally the pixels of every defect are returned as
+run-length encoded row spans.
+"""
+
+import numpy as np
+import cv2 as cv
+
+DEFECT_DTYPE = np.dtype([
+    ("label", np.int32),
+    ("area", np.int32),
+    ("x", np.int32),        # bounding box, full image pixels
+    ("y", np.int32),
+    ("width", np.int32),
+    ("height", np.int32),
+    ("cx", np.float64),     # centroid, full image pixels
+    ("cy", np.float64),
+])
+
+# capture width the pixel area bounds of the defects are given for, see DefectDetection.max_area
+REFERENCE_WIDTH = 1920
+
+SPAN_DTYPE = np.dtype([
+    ("label", np.int32),
+    ("row", np.int32),
+    ("start", np.int32),    # first column
+    ("stop", np.int32),     # last column + 1
+])
+
+
+# defects of a binary image with min_area <= area <= max_area
+# returns (defects, spans, defect_mask), spans is None unless with_spans is set
+def extract_defects(binary, min_area = 10, max_area = 200, offset = (0, 0), with_spans = False):
+    totalLabels, label_ids, values, centroid = cv.connectedComponentsWithStats(binary, 8, cv.CV_32S)
+
+    areas = values[:, cv.CC_STAT_AREA]
+    keep = (areas >= min_area) & (areas <= max_area)
+    keep[0] = False
+    kept = np.flatnonzero(keep)
+
+    # relabel kept components 1..n and drop the others in a single pass
+    lut = np.zeros(totalLabels, dtype=np.int32)
+    lut[kept] = np.arange(1, len(kept) + 1, dtype=np.int32)
+    defect_labels = lut[label_ids]
+    defect_mask = np.where(defect_labels > 0, np.uint8(255), np.uint8(0))
+
+    defects = np.zeros(len(kept), dtype=DEFECT_DTYPE)
+    defects["label"] = lut[kept]
+    defects["area"] = areas[kept]
+    defects["x"] = values[kept, cv.CC_STAT_LEFT] + offset[0]
+    defects["y"] = values[kept, cv.CC_STAT_TOP] + offset[1]
+    defects["width"] = values[kept, cv.CC_STAT_WIDTH]
+    defects["height"] = values[kept, cv.CC_STAT_HEIGHT]
+    defects["cx"] = centroid[kept, 0] + offset[0]
+    defects["cy"] = centroid[kept, 1] + offset[1]
+
+    spans = None
+    if with_spans:
+        spans = label_spans(defect_labels, offset)
+    return defects, spans, defect_mask
+
+
+# run-length encoded row spans of a label image, sorted by label
+def label_spans(labels, offset = (0, 0)):
+    height, width = labels.shape
+    inside = labels > 0
+    start_mask = inside.copy()
+    start_mask[:, 1:] &= labels[:, 1:] != labels[:, :-1]
+    stop_mask = inside.copy()
+    stop_mask[:, :-1] &= labels[:, :-1] != labels[:, 1:]
+
+    # every run has one start and one stop, both found in row-major order
+    rows, starts = np.nonzero(start_mask)
+    _, stops = np.nonzero(stop_mask)
+    span_labels = labels[rows, starts]
+    order = np.argsort(span_labels, kind="stable")
+
+    spans = np.zeros(len(rows), dtype=SPAN_DTYPE)
+    spans["label"] = span_labels[order]
+    spans["row"] = rows[order] + offset[1]
+    spans["start"] = starts[order] + offset[0]
+    spans["stop"] = stops[order] + 1 + offset[0]
+    return spans
+
+
+# (N, 2) pixel (x, y) arrays of every defect, from its spans
+def span_pixels(spans, num_defect):
+    if num_defect == 0:
+        return []
+    lengths = (spans["stop"] - spans["start"]).astype(np.int64)
+    run_first = np.cumsum(lengths) - lengths
+    xs = np.arange(lengths.sum()) - np.repeat(run_first, lengths) + np.repeat(spans["start"], lengths)
+    ys = np.repeat(spans["row"], lengths)
+    pixels = np.stack([xs, ys], axis=1)
+
+    counts = np.bincount(np.repeat(spans["label"], lengths), minlength=num_defect + 1)[1:]
+    return np.split(pixels, np.cumsum(counts)[:-1])
@@ -0,0 +1,176 @@
+"""
+Offline re-analysis of a captured run over many detection parameters
+
+This file re-runs the defect detection over the layer images of a finished
+run (layer_N.jpg in the image folder, or the frames of its archive, see
+run_archive.py) and counts the defects of every layer
+for every combination of binary threshold and component area bounds. Each
+layer image is undistorted, masked and blurred once; every threshold only
+adds a threshold and a connected component pass, and every area bound is a
+count over the component areas. Layers are processed in a process pool.
+
+Example:
+    python defect_threshold_sweep.py --image-dir ./images/elp_0301_0/
+        --gcode ./gcode/SmallBellow_only_Oct29_0.3mm.gcode
+        --binary-thresholds 60:120:5 --min-areas 5,10,20 --max-areas 200,400
+        --output sweep.csv
+
+The calibration file, picture position and layer height default to the
+values in settings.py. The calibration is scaled to the capture resolution
+of the run (the size of its first frame, or --resolution), so frames of a
+4K run are analysed at 4K with the scaled area bounds, like the live
+detection.
+"""
+
+import os
+import re
+import csv
+import argparse
+import numpy as np
+import cv2 as cv
+from concurrent.futures import ProcessPoolExecutor
+from calibration import load_calibration
+from run_archive import RunArchiveReader, find_archive
+import settings as config
+
+# detector living in each worker process
+_worker_detector = None
+# archive readers of each worker process, keyed by archive directory
+_worker_archives = {}
+
+
+def _init_worker(detector_args, detector_kwargs):
+    global _worker_detector
+    from defect_detection import DefectDetection
+    _worker_detector = DefectDetection(*detector_args, **detector_kwargs)
+
+
+# image of a layer: a file path, or (archive directory, index row) of an archived frame
+def load_layer_image(source):
+    if isinstance(source, str):
+        return cv.imread(source)
+    archive_dir, row = source
+    reader = _worker_archives.get(archive_dir)
+    if reader is None:
+        reader = _worker_archives[archive_dir] = RunArchiveReader(archive_dir)
+    return np.array(reader.image(row))
+
+
+# defect counts of one layer image for all parameter combinations
+def analyze_layer(detector, layerID, img_source, binary_thresholds, area_bounds):
+    img = load_layer_image(img_source)
+    cropped_img, roi = detector.project_contour(img, layerID, save_projection_img = False)
+    blurred = detector.preprocess(cropped_img)
+    rows = []
+    for binary_threshold in binary_thresholds:
+        areas = detector.get_component_areas(blurred, binary_threshold)
+        for (min_area, max_area) in area_bounds:
+            # max_area is given for a 1920 wide capture like DefectDetection.get_defects
+            num_defect = int(np.count_nonzero((areas >= min_area) & (areas <= detector.max_area(max_area))))
+            rows.append((layerID, binary_threshold, min_area, max_area, num_defect))
+    return rows
+
+
+def _analyze_layer(task):
+    return analyze_layer(_worker_detector, *task)
+
+
+# layer images of a run: {layerID: path or (archive directory, index row)}, corrected pictures are skipped
+def find_layer_images(img_dir_path):
+    archive_dir = find_archive(img_dir_path)
+    if archive_dir is not None:
+        frames = RunArchiveReader(archive_dir).layer_frames()
+        return {layerID: (archive_dir, frames[layerID]) for layerID in sorted(frames)}
+    layer_images = {}
+    for filename in os.listdir(img_dir_path):
+        match = re.fullmatch(r"layer_(\d+)\.jpg", filename)
+        if match:
+            layer_images[int(match.group(1))] = os.path.join(img_dir_path, filename)
+    return dict(sorted(layer_images.items()))
+
+
+# "70,80,90" or "60:120:5" (start:stop:step, stop included)
+def parse_values(text):
+    if ":" in text:
+        start, stop, step = [int(v) for v in text.split(":")]
+        return list(range(start, stop + 1, step))
+    return [int(v) for v in text.split(",")]
+
+
+def run_sweep(detector_args, detector_kwargs, layer_images, binary_thresholds, area_bounds, processes = None):
+    tasks = [(layerID, img_source, binary_thresholds, area_bounds) for layerID, img_source in layer_images.items()]
+    rows = []
+    with ProcessPoolExecutor(processes, initializer=_init_worker,
+                             initargs=(detector_args, detector_kwargs)) as executor:
+        for layer_rows in executor.map(_analyze_layer, tasks):
+            rows.extend(layer_rows)
+    return rows
+
+
+def write_table(rows, output_path):
+    with open(output_path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["layer", "binary_threshold", "min_area", "max_area", "num_defect"])
+        writer.writerows(rows)
+
+
+# number of layers that would have been fixed and total defects, per parameter combination
+def summarize(rows, defect_threshold):
+    summary = {}
+    for layerID, binary_threshold, min_area, max_area, num_defect in rows:
+        key = (binary_threshold, min_area, max_area)
+        fixed, total = summary.get(key, (0, 0))
+        summary[key] = (fixed + (num_defect >= defect_threshold), total + num_defect)
+    return summary
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description="Re-run defect detection of a captured run over a parameter sweep")
+    parser.add_argument("--image-dir", required=True, help="image folder of the run (layer_N.jpg or archive)")
+    parser.add_argument("--gcode", required=True, help="G-code without the wiping pattern")
+    parser.add_argument("--binary-thresholds", default="85", help="e.g. 70,80,90 or 60:120:5")
+    parser.add_argument("--min-areas", default="10")
+    parser.add_argument("--max-areas", default="200")
+    parser.add_argument("--defect-threshold", type=int, default=2, help="defects per layer to count it as fixed")
+    parser.add_argument("--layer-height", type=float, default=None)
+    parser.add_argument("--position", type=float, nargs=2, default=None, metavar=("X", "Y"),
+                        help="picture taking position")
+    parser.add_argument("--calibration", default=None, help="calibration file, defaults to settings.py")
+    parser.add_argument("--resolution", type=int, nargs=2, default=None, metavar=("WIDTH", "HEIGHT"),
+                        help="capture resolution of the run, defaults to the size of its first frame")
+    parser.add_argument("--processes", type=int, default=None)
+    parser.add_argument("--output", default="threshold_sweep.csv")
+    args = parser.parse_args(argv)
+
+    layer_images = find_layer_images(args.image_dir)
+    if not layer_images:
+        raise ValueError("No layer_N images in {}".format(args.image_dir))
+    layer_height = config.layer_height if args.layer_height is None else args.layer_height
+    img_taken_position = config.img_taken_position if args.position is None else list(args.position)
+    # calibration scaled to the frames of the run, so the area bounds scale like in the live detection
+    if args.resolution is None:
+        img_shape = load_layer_image(next(iter(layer_images.values()))).shape[1::-1]
+    else:
+        img_shape = tuple(args.resolution)
+    calibration = load_calibration(config.calibration_path if args.calibration is None else args.calibration,
+                                   img_shape=img_shape)
+    detector_args = (calibration.camera_matrix, calibration.dist_coeffs, calibration.T_nozzle_cam,
+                     args.gcode, args.image_dir, img_taken_position)
+    detector_kwargs = {"layer_height": layer_height, "roi_mode": True, "calibration": calibration}
+
+    binary_thresholds = parse_values(args.binary_thresholds)
+    area_bounds = [(mn, mx) for mn in parse_values(args.min_areas) for mx in parse_values(args.max_areas) if mn <= mx]
+    print("{} layers of {}x{}, {} binary thresholds, {} area bounds".format(
+        len(layer_images), *img_shape, len(binary_thresholds), len(area_bounds)))
+
+    rows = run_sweep(detector_args, detector_kwargs, layer_images, binary_thresholds, area_bounds, args.processes)
+    write_table(rows, args.output)
+
+    print("binary_threshold, min_area, max_area: fixed layers, total defects")
+    for key, (fixed, total) in sorted(summarize(rows, args.defect_threshold).items()):
+        print("{}, {}, {}: {}, {}".format(*key, fixed, total))
+    print("Table written to {}".format(args.output))
+
+
+if __name__ == "__main__":
+    main()
@@ -2,39 +2,101 @@
 
 This file edits the parsed g-code file by adding lines of 
 Gcode for nozzle movement to predetermined camera position.
+
+Ironing layers are generated from an IroningTemplate, which parses the
+layer once into a single format string with a placeholder for every E and S
+value and keeps the values as arrays, so every E / S proportion is a
+vectorized scaling of those arrays, a rounding pass and one format call.
+The templates are kept per layer (LayerStore.ironing_template,
+IroningPrecompute) and reused.
 """
 
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+
+class IroningTemplate:
+    """
+    Layerwise G-code parsed once for generating ironing layers
+    """
+    def __init__(self, gcode):
+        lines = []
+        is_e, values = [], []
+        for line in gcode:
+            line = line.strip()
+            if line.startswith(";"):
+                continue
+            line = line.replace("{", "{{").replace("}", "}}")
+            if ' E' not in line and ' S' not in line:
+                lines.append(line)
+                continue
+            ele_list = line.split(" ")
+            for i, ele in enumerate(ele_list):
+                if ele.startswith("E") or ele.startswith("S"):
+                    original = round(float(ele[1:]), 3)
+                    if original >= 0:
+                        ele_list[i] = ele[0] + "{}"
+                        is_e.append(ele[0] == "E")
+                        values.append(original)
+            lines.append(' '.join(ele_list))
+        # output layer with a placeholder per value, in the order of the values
+        self.format = "\n".join(lines)
+        self.is_e = np.array(is_e, dtype=bool)
+        self.values = np.array(values, dtype=np.float64)
+
+    # ironing lines with E and S values scaled by the given proportions
+    def emit(self, E_proportion = 0.2, S_proportion = 0.6):
+        if not self.format:
+            return []
+        # Python round per value: np.round rounds the scaled binary value differently (E0.202 * 0.25)
+        new_E = [round(value, 3) for value in (self.values[self.is_e] * E_proportion).tolist()]
+        new_S = (self.values[~self.is_e] * S_proportion).astype(np.int64)
+        new_values = np.empty(len(self.values), dtype=object)
+        new_values[self.is_e] = new_E
+        new_values[~self.is_e] = new_S.tolist()
+        return self.format.format(*new_values).split("\n")
+
+
 # gcode_path: layerwise_gcode_file
 def generate_iron_layer(gcode_path, output_path, E_proportion = 0.2, S_proportion = 0.6):
-    new_gcode_list = []
     gcode = [i.strip() for i in open(gcode_path)]
-    for line in gcode:
-        if line.startswith(";"):
-            pass
-        elif ' E' not in line and ' S' not in line:
-            new_gcode_list.append(line)
-        else:
-            original_E = 0
-            original_S = 0
-            ele_list = line.split(" ")
-            for i, ele in enumerate(ele_list):
-                if ele.startswith("E"):
-                    original_E = round(float(ele[1:]), 3)
-                    if (original_E < 0):
-                        pass
-                    else:
-                        new_E = original_E * E_proportion
-                        ele_list[i] = "E{}".format(round(new_E, 3))
-                elif ele.startswith("S"):
-                    original_S = round(float(ele[1:]), 3)
-                    if (original_S < 0):
-                        pass
-                    else:
-                        new_S = original_S * S_proportion
-                        ele_list[i] = "S{}".format(int(new_S))
-            new_line = ' '.join(ele_list)
-            new_gcode_list.append(new_line)
+    new_gcode_list = iron_lines(gcode, E_proportion, S_proportion)
 
     file = open(output_path, "w")
     for line in new_gcode_list:
-        file.write(line + "\n")
\ No newline at end of file
+        file.write(line + "\n")
+
+# gcode: list of layerwise gcode lines, returns the ironing lines
+# for a single use only, keep the IroningTemplate of a layer when it is ironed more than once
+def iron_lines(gcode, E_proportion = 0.2, S_proportion = 0.6):
+    return IroningTemplate(gcode).emit(E_proportion, S_proportion)
+
+
+class IroningPrecompute:
+    """
+    Parse the ironing templates of a layer store in a background process pool
+    """
+    def __init__(self, layer_store, layers, E_proportion = 0.2, S_proportion = 0.6, processes = None):
+        self.executor = ProcessPoolExecutor(processes)
+        self.E_proportion = E_proportion
+        self.S_proportion = S_proportion
+        self.futures = {}
+        for layerID in layers:
+            gcode = layer_store.get("layer_{}".format(layerID))
+            self.futures[layerID] = self.executor.submit(IroningTemplate, gcode)
+
+    # template of a layer, waits if it is still being parsed, None if not requested
+    def template(self, layerID):
+        future = self.futures.get(layerID)
+        if future is None:
+            return None
+        return future.result()
+
+    # ironing lines of a layer, None if not requested
+    def get(self, layerID):
+        template = self.template(layerID)
+        if template is None:
+            return None
+        return template.emit(self.E_proportion, self.S_proportion)
+
+    def shutdown(self, wait = True):
+        self.executor.shutdown(wait=wait, cancel_futures=not wait)
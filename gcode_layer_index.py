@@ -0,0 +1,255 @@
+"""
+Indexed layer store for sliced G-code
+
+This file parses a .gcode file once into columnar arrays (X/Y/Z/E/F per move,
+tagged with layer number, ;TYPE: category and contour) so that the contour of
+any layer can be looked up without re-reading the file. The index is cached
+next to the G-code file, keyed by the file hash, and memory-mapped on reload.
+"""
+
+import os
+import json
+import shutil
+import hashlib
+import numpy as np
+
+INDEX_VERSION = 1
+
+# type of layer (1: Perimeter, 2: External Perimeter, 3: Overhang perimeter, 4: Internal infill, 5: Solid infill, 6: Top solid infill,
+# 7: Bridge infill, 8: Skirt/Brim, 9: Custom)
+LAYER_TYPES = {
+    ";TYPE:Perimeter": 1,
+    ";TYPE:External perimeter": 2,
+    ";TYPE:Overhang perimeter": 3,
+    ";TYPE:Internal infill": 4,
+    ";TYPE:Solid infill": 5,
+    ";TYPE:Top solid infill": 6,
+    ";TYPE:Bridge infill": 7,
+    ";TYPE:Skirt/Brim": 8,
+    ";TYPE:Custom": 9,
+}
+
+# row flags
+FLAG_POINT = 1  # extrusion move contributing a contour point
+FLAG_BREAK = 2  # travel (or other) move ending the current contour
+
+_MOVE_COLUMNS = ("x", "y", "z", "e", "f")
+_COLUMNS = _MOVE_COLUMNS + ("layer", "type", "flags", "contour",
+                            "point_rows", "contour_key", "contour_start", "contour_stop",
+                            "contour_closed", "layer_z", "layer_offsets")
+
+# indexes already loaded in this process, keyed by (path, mtime, size)
+_loaded_indexes = {}
+
+
+def file_hash(path, chunk_size = 1 << 20):
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class GcodeLayerIndex:
+    """
+    Columnar, per-layer index of the moves in a G-code file
+    """
+    def __init__(self, arrays):
+        for name in _COLUMNS:
+            setattr(self, name, arrays[name])
+        self.num_layer = len(self.layer_z) - 1
+
+    # parse the G-code file in one pass
+    @classmethod
+    def build(cls, gcode_path):
+        num_layer = 0
+        layer_type = 0
+        layer_z = {}
+        pos = {"X": 0., "Y": 0., "Z": 0., "F": 0.}
+        contour_count = {}
+
+        cols = {name: [] for name in _MOVE_COLUMNS + ("layer", "type", "flags", "contour")}
+
+        with open(gcode_path, "r") as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                # set layer type and layer number with comments
+                if line.startswith(";"):
+                    if line == ";LAYER_CHANGE":
+                        num_layer += 1
+                        layer_type = 0
+                    elif line.startswith(";Z:"):
+                        layer_z[num_layer] = float(line[3:])
+                    elif line in LAYER_TYPES:
+                        layer_type = LAYER_TYPES[line]
+                    continue
+
+                ele_list = line.split(";")[0].split()
+                if not ele_list:
+                    continue
+                is_move = ele_list[0] in ("G0", "G1", "G2", "G3")
+
+                # same classification as the original contour extraction:
+                # extrusion moves add points, M codes and feed-rate-only moves are ignored,
+                # anything else (travel, Z hop, retraction) ends the current contour
+                if ele_list[-1][0] == "E":
+                    flags = FLAG_POINT if is_move else 0
+                elif line.startswith("M"):
+                    flags = 0
+                elif len(ele_list) > 1 and ele_list[1][0] == "F":
+                    flags = 0
+                else:
+                    flags = FLAG_BREAK
+
+                if not is_move and flags != FLAG_BREAK:
+                    continue
+
+                e = 0.
+                has_xy = False
+                for ele in ele_list[1:]:
+                    if ele[0] in pos:
+                        pos[ele[0]] = float(ele[1:])
+                        has_xy = has_xy or ele[0] in "XY"
+                    elif ele[0] == "E":
+                        e = float(ele[1:])
+                if flags == FLAG_POINT and not has_xy:
+                    flags = 0
+
+                key = (num_layer, layer_type)
+                if flags == FLAG_BREAK:
+                    contour_count[key] = contour_count.get(key, 0) + 1
+                cols["x"].append(pos["X"])
+                cols["y"].append(pos["Y"])
+                cols["z"].append(pos["Z"])
+                cols["e"].append(e)
+                cols["f"].append(pos["F"])
+                cols["layer"].append(num_layer)
+                cols["type"].append(layer_type)
+                cols["flags"].append(flags)
+                cols["contour"].append(contour_count.get(key, 0) if flags == FLAG_POINT else -1)
+
+        arrays = {name: np.array(cols[name], dtype=np.float64) for name in _MOVE_COLUMNS}
+        arrays["layer"] = np.array(cols["layer"], dtype=np.int32)
+        arrays["type"] = np.array(cols["type"], dtype=np.int8)
+        arrays["flags"] = np.array(cols["flags"], dtype=np.uint8)
+        arrays["contour"] = np.array(cols["contour"], dtype=np.int32)
+
+        # group contour points by (layer, type, contour), keeping file order inside each contour
+        point_rows = np.flatnonzero(arrays["flags"] == FLAG_POINT)
+        order = np.lexsort((point_rows, arrays["contour"][point_rows],
+                            arrays["type"][point_rows], arrays["layer"][point_rows]))
+        point_rows = point_rows[order]
+        p_layer = arrays["layer"][point_rows].astype(np.int64)
+        p_type = arrays["type"][point_rows].astype(np.int64)
+        p_contour = arrays["contour"][point_rows].astype(np.int64)
+        new_contour = np.ones(len(point_rows), dtype=bool)
+        new_contour[1:] = ((p_layer[1:] != p_layer[:-1]) | (p_type[1:] != p_type[:-1]) |
+                           (p_contour[1:] != p_contour[:-1]))
+        contour_start = np.flatnonzero(new_contour)
+        contour_stop = np.append(contour_start[1:], len(point_rows))
+
+        # a contour is closed when a later move of the same layer and type ended it
+        final_count = np.array([contour_count.get((l, t), 0) for l, t in
+                                zip(p_layer[contour_start], p_type[contour_start])], dtype=np.int64)
+        arrays["point_rows"] = point_rows
+        arrays["contour_key"] = p_layer[contour_start] * 16 + p_type[contour_start]
+        arrays["contour_start"] = contour_start
+        arrays["contour_stop"] = contour_stop
+        arrays["contour_closed"] = p_contour[contour_start] < final_count
+
+        arrays["layer_z"] = np.array([layer_z.get(i, np.nan) for i in range(num_layer + 1)], dtype=np.float64)
+        arrays["layer_offsets"] = np.searchsorted(arrays["layer"], np.arange(num_layer + 2)).astype(np.int64)
+        return cls(arrays)
+
+    # write the index as one .npy file per column so it can be memory-mapped
+    def save(self, index_dir, source_hash):
+        tmp_dir = index_dir + ".tmp{}".format(os.getpid())
+        os.makedirs(tmp_dir, exist_ok=True)
+        for name in _COLUMNS:
+            np.save(os.path.join(tmp_dir, name + ".npy"), getattr(self, name))
+        with open(os.path.join(tmp_dir, "meta.json"), "w") as f:
+            json.dump({"version": INDEX_VERSION, "hash": source_hash}, f)
+        if os.path.isdir(index_dir):
+            shutil.rmtree(index_dir)
+        os.replace(tmp_dir, index_dir)
+
+    @classmethod
+    def load(cls, index_dir, source_hash = None, mmap_mode = "r"):
+        with open(os.path.join(index_dir, "meta.json"), "r") as f:
+            meta = json.load(f)
+        if meta.get("version") != INDEX_VERSION:
+            raise ValueError("Index version mismatch: {}".format(index_dir))
+        if source_hash is not None and meta.get("hash") != source_hash:
+            raise ValueError("Index hash mismatch: {}".format(index_dir))
+        arrays = {name: np.load(os.path.join(index_dir, name + ".npy"), mmap_mode=mmap_mode)
+                  for name in _COLUMNS}
+        return cls(arrays)
+
+    # row range of all moves of a layer
+    def layer_rows(self, layerID):
+        if layerID < 0 or layerID > self.num_layer:
+            return slice(0, 0)
+        return slice(int(self.layer_offsets[layerID]), int(self.layer_offsets[layerID + 1]))
+
+    def layer_moves(self, layerID):
+        rows = self.layer_rows(layerID)
+        return {name: getattr(self, name)[rows] for name in _MOVE_COLUMNS + ("type", "flags")}
+
+    # list of (N, 2) arrays of the contour points of a layer and type, closed contours repeat their first point
+    def contour_points(self, layerID, target_type = 2):
+        key = layerID * 16 + target_type
+        first = np.searchsorted(self.contour_key, key, side="left")
+        last = np.searchsorted(self.contour_key, key, side="right")
+        contours = []
+        for c in range(first, last):
+            rows = self.point_rows[self.contour_start[c]:self.contour_stop[c]]
+            if self.contour_closed[c]:
+                rows = np.append(rows, rows[0])
+            contours.append(np.stack([self.x[rows], self.y[rows]], axis=1))
+        return contours
+
+    def layer_height_z(self, layerID):
+        if layerID < 0 or layerID > self.num_layer or np.isnan(self.layer_z[layerID]):
+            return None
+        return float(self.layer_z[layerID])
+
+    # same output as the original gcode_layer_visualization.get_layer_coordinates
+    def layer_coordinates(self, target_layer = 1, target_type = 2):
+        contours = self.contour_points(target_layer, target_type)
+        shape_list_X = [c[:, 0].tolist() for c in contours]
+        shape_list_Y = [c[:, 1].tolist() for c in contours]
+        z_val = self.layer_height_z(target_layer) if contours else 0
+        return shape_list_X, shape_list_Y, z_val
+
+
+def index_dir_path(gcode_path, source_hash):
+    return "{}.{}.layeridx".format(gcode_path, source_hash[:16])
+
+
+# load the index of a G-code file, building and caching it on disk the first time
+def load_layer_index(gcode_path, use_disk_cache = True):
+    stat = os.stat(gcode_path)
+    key = (os.path.abspath(gcode_path), stat.st_mtime_ns, stat.st_size)
+    if key in _loaded_indexes:
+        return _loaded_indexes[key]
+
+    index = None
+    source_hash = file_hash(gcode_path)
+    index_dir = index_dir_path(gcode_path, source_hash)
+    if use_disk_cache and os.path.isdir(index_dir):
+        try:
+            index = GcodeLayerIndex.load(index_dir, source_hash)
+        except (OSError, ValueError) as err:
+            print("Rebuilding layer index: {}".format(err))
+    if index is None:
+        index = GcodeLayerIndex.build(gcode_path)
+        if use_disk_cache:
+            try:
+                index.save(index_dir, source_hash)
+            except OSError as err:
+                print("Could not cache layer index: {}".format(err))
+
+    _loaded_indexes[key] = index
+    return index
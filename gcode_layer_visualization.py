@@ -1,101 +1,210 @@
-""" 
+"""
 Extract contour from the gcode file
 
 This file extracts the absolute coordinates of each component of the print,
-keeping the external perimeter for ironing.
+keeping the external perimeter for ironing. The file is parsed once into
+a layer index (see gcode_layer_index.py) and every later query reads from it.
+
+Layers are rendered headless with OpenCV, colored by ;TYPE: category, as
+single images or as a tiled contact sheet. matplotlib is only imported for
+interactive plotting (plot_layer).
+
+Example:
+    python gcode_layer_visualization.py part.gcode --layers 1:80 --sheet sheet.png --out-dir ./layers/
 """
 
-import matplotlib.pyplot as plt
+import os
+import copy
+import argparse
+import numpy as np
+import cv2 as cv
+from gcode_layer_index import load_layer_index, FLAG_POINT
+
+# BGR color of every ;TYPE: category (PrusaSlicer preview colors), 0: before any ;TYPE:
+TYPE_COLORS = {
+    0: (128, 128, 128),
+    1: (77, 230, 255),      # Perimeter
+    2: (56, 125, 255),      # External perimeter
+    3: (255, 31, 31),       # Overhang perimeter
+    4: (41, 48, 176),       # Internal infill
+    5: (204, 84, 150),      # Solid infill
+    6: (64, 64, 240),       # Top solid infill
+    7: (186, 128, 77),      # Bridge infill
+    8: (110, 135, 0),       # Skirt/Brim
+    9: (148, 209, 94),      # Custom
+}
+
+# sub-pixel bits of the drawn polylines
+_SHIFT = 4
+
+# contours of one layer and type, answered from the parsed layer index
 def get_layer_coordinates(gcode_path, target_layer = 1, target_type = 2):
-    # get the number of layers
-    num_layer = 0
     # type of layer (1: Perimeter, 2: External Perimeter, 3: Overhang perimeter, 4: Internal infill, 5: Solid infill, 6: Top solid infill,
     # 7: Bridge infill, 8: Skirt/Brim, 9: Custom)
-    layer_type = 0
-    layer_number_list = []
-    layer_type_list = []
-    layer_code_list = []
-    z_val_dict = {}
-
-    # Gcode parsing linking each line to layer number and layer type
-    with open(gcode_path, 'r') as f:
-        for line in f.readlines():
-            # ignore empty & comments line
-            if line == '\n' or line.startswith(';'):
-                pass     
-            else:
-                layer_number_list.append(num_layer)
-                layer_type_list.append(layer_type)
-                layer_code_list.append(line.strip())
-            
-            # set layer type and layer number with comments
-            if line.strip() == ";LAYER_CHANGE":
-                num_layer += 1
-                layer_type = 0
-            elif line.strip().startswith(";Z:"): 
-                z_val_dict[num_layer] = float(line.strip()[3:])
-            elif line.strip() == ";TYPE:Perimeter":
-                layer_type = 1
-            elif line.strip() == ";TYPE:External perimeter":
-                layer_type = 2
-            elif line.strip() == ";TYPE:Overhang perimeter":
-                layer_type = 3
-            elif line.strip() == ";TYPE:Internal infill":
-                layer_type = 4
-            elif line.strip() == ";TYPE:Solid infill":
-                layer_type = 5
-            elif line.strip() == ";TYPE:Top solid infill":
-                layer_type = 6
-            elif line.strip() == ";TYPE:Bridge infill":
-                layer_type = 7
-            elif line.strip() == ";TYPE:Skirt/Brim":
-                layer_type = 8
-            elif line.strip() == ";TYPE:Custom":
-                layer_type = 9
-            
-    # Gcode parsing for plane coordinates
-    X_external_perimeter = []
-    Y_external_perimeter = []
-
-
-    shape_list_X = []
-    shape_list_Y = []
-    z_val = 0
-
-    for i in range(len(layer_number_list)):
-        # break if layer is over
-        if layer_number_list[i] > target_layer:
-            break
-        # if target layer and type is found
-        if layer_number_list[i] == target_layer and layer_type_list[i] == target_type:
-            z_val = z_val_dict.get(layer_number_list[i])
-            line = layer_code_list[i]
-            if line.split(" ")[-1][0] == 'E':
-                for ele in line.split(" "):
-                    if ele[0] == "X":
-                        X_external_perimeter.append(float(ele[1:]))
-                    elif ele[0] == "Y":
-                        Y_external_perimeter.append(float(ele[1:]))
-            elif line.startswith("M"):
-                pass
-            elif line.split(" ")[1][0] == 'F':
-                pass
-            else:
-                if len(X_external_perimeter) != 0:
-                    X_external_perimeter.append(X_external_perimeter[0])
-                    Y_external_perimeter.append(Y_external_perimeter[0])
-                shape_list_X.append(X_external_perimeter)
-                shape_list_Y.append(Y_external_perimeter)
-                X_external_perimeter = []
-                Y_external_perimeter = []
-    shape_list_X.append(X_external_perimeter)
-    shape_list_Y.append(Y_external_perimeter)
-
-    def remove_empty_lists(input_list):
-        output_list = [sublist for sublist in input_list if sublist]
-        return output_list
-
-    shape_list_X = remove_empty_lists(shape_list_X)
-    shape_list_Y = remove_empty_lists(shape_list_Y)
-
-    return shape_list_X, shape_list_Y, z_val
+    layer_index = load_layer_index(gcode_path)
+    return layer_index.layer_coordinates(target_layer, target_type)
+
+
+# extrusion paths of a layer: list of ((N, 2) points, type), consecutive extrusion moves of a type form one path
+def layer_paths(layer_index, layerID, types = None):
+    rows = layer_index.layer_rows(layerID)
+    point = layer_index.flags[rows] == FLAG_POINT
+    layer_types = layer_index.type[rows]
+    if types is not None:
+        point &= np.isin(layer_types, types)
+    ends = np.flatnonzero(point) + rows.start
+    ends = ends[ends > 0]
+    if len(ends) == 0:
+        return []
+
+    # a path continues while the previous row is an extrusion move of the same type
+    new_path = np.ones(len(ends), dtype=bool)
+    new_path[1:] = (ends[1:] != ends[:-1] + 1) | (layer_index.type[ends[1:]] != layer_index.type[ends[:-1]])
+    first = np.flatnonzero(new_path)
+    last = np.append(first[1:], len(ends)) - 1
+
+    paths = []
+    for f, l in zip(first.tolist(), last.tolist()):
+        # each path starts where the move before its first extrusion ended
+        path_rows = np.arange(ends[f] - 1, ends[l] + 1)
+        points = np.stack([layer_index.x[path_rows], layer_index.y[path_rows]], axis=1)
+        paths.append((points, int(layer_index.type[ends[f]])))
+    return paths
+
+
+# (x0, y0, x1, y1) in mm of the extrusion moves of the given layers
+def layer_bounds(layer_index, layers):
+    x0, y0, x1, y1 = np.inf, np.inf, -np.inf, -np.inf
+    for layerID in layers:
+        rows = layer_index.layer_rows(layerID)
+        point = layer_index.flags[rows] == FLAG_POINT
+        if not point.any():
+            continue
+        xs, ys = layer_index.x[rows][point], layer_index.y[rows][point]
+        x0, y0 = min(x0, xs.min()), min(y0, ys.min())
+        x1, y1 = max(x1, xs.max()), max(y1, ys.max())
+    if x0 > x1:
+        return (0., 0., 1., 1.)
+    return (float(x0), float(y0), float(x1), float(y1))
+
+
+class LayerRenderer:
+    """
+    Class for rasterizing layers of a G-code file, top view with Y pointing up
+    """
+    def __init__(self, gcode_path, scale = 10., bounds = None, layers = None, margin = 10, thickness = 1,
+                 types = None, background = (255, 255, 255)):
+        # scale: pixels per mm, bounds: (x0, y0, x1, y1) in mm, defaults to the extent of `layers`
+        self.layer_index = load_layer_index(gcode_path)
+        if layers is None:
+            layers = range(1, self.layer_index.num_layer + 1)
+        self.bounds = layer_bounds(self.layer_index, layers) if bounds is None else bounds
+        self.thickness = thickness
+        self.types = types
+        self.background = background
+        self.set_scale(scale, margin)
+
+    def set_scale(self, scale, margin):
+        self.scale = scale
+        self.margin = margin
+        x0, y0, x1, y1 = self.bounds
+        self.img_size = (int(np.ceil((x1 - x0) * scale)) + 2 * margin, int(np.ceil((y1 - y0) * scale)) + 2 * margin)
+
+    # printer (x, y) in mm to fixed-point pixel coordinates for cv.polylines
+    def to_pixels(self, points):
+        x0, y0, x1, y1 = self.bounds
+        px = (points[:, 0] - x0) * self.scale + self.margin
+        py = (y1 - points[:, 1]) * self.scale + self.margin
+        return np.round(np.stack([px, py], axis=1) * (1 << _SHIFT)).astype(np.int32)
+
+    def render(self, layerID):
+        (width, height) = self.img_size
+        img = np.empty((height, width, 3), dtype=np.uint8)
+        img[:] = self.background
+        by_type = {}
+        for points, layer_type in layer_paths(self.layer_index, layerID, self.types):
+            by_type.setdefault(layer_type, []).append(self.to_pixels(points))
+        for layer_type, polylines in sorted(by_type.items()):
+            cv.polylines(img, polylines, False, TYPE_COLORS.get(layer_type, TYPE_COLORS[0]), self.thickness,
+                         cv.LINE_AA, _SHIFT)
+        return img
+
+    # tiled image of the given layers, `columns` tiles per row, every tile labeled with its layer number
+    def contact_sheet(self, layers, columns = None, tile_width = 256, label = True):
+        layers = list(layers)
+        if columns is None:
+            columns = int(np.ceil(np.sqrt(len(layers))))
+        rows = int(np.ceil(len(layers) / columns))
+        # tiles are rendered directly at their size
+        x0, y0, x1, y1 = self.bounds
+        tile_renderer = copy.copy(self)
+        margin = max(tile_width // 32, 1)
+        tile_renderer.set_scale((tile_width - 2 * margin) / max(x1 - x0, 1e-6), margin)
+        (tile_width, tile_height) = tile_renderer.img_size
+        sheet = np.empty((rows * tile_height, columns * tile_width, 3), dtype=np.uint8)
+        sheet[:] = self.background
+        for k, layerID in enumerate(layers):
+            tile = tile_renderer.render(layerID)
+            if label:
+                cv.putText(tile, str(layerID), (4, 16), cv.FONT_HERSHEY_SIMPLEX, 0.5, (0, 0, 0), 1, cv.LINE_AA)
+            r, c = divmod(k, columns)
+            sheet[r * tile_height:(r + 1) * tile_height, c * tile_width:(c + 1) * tile_width] = tile
+        return sheet
+
+    # write one image per layer, returns the paths
+    def save_layers(self, layers, out_dir, ext = ".png"):
+        os.makedirs(out_dir, exist_ok=True)
+        paths = []
+        for layerID in layers:
+            path = os.path.join(out_dir, "layer_{}{}".format(layerID, ext))
+            cv.imwrite(path, self.render(layerID))
+            paths.append(path)
+        return paths
+
+
+# interactive plot of the contours of a layer, needs matplotlib
+def plot_layer(gcode_path, target_layer = 1, target_type = 2):
+    import matplotlib.pyplot as plt
+    shape_list_X, shape_list_Y, z_val = get_layer_coordinates(gcode_path, target_layer, target_type)
+    for X, Y in zip(shape_list_X, shape_list_Y):
+        plt.plot(X, Y)
+    plt.axis("equal")
+    plt.title("layer {} (Z = {})".format(target_layer, z_val))
+    plt.show()
+
+
+# "1:80" (both included) or "1,5,9"
+def parse_layers(text):
+    if ":" in text:
+        first, last = [int(v) for v in text.split(":")]
+        return list(range(first, last + 1))
+    return [int(v) for v in text.split(",")]
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description="Render the layers of a G-code file")
+    parser.add_argument("gcode")
+    parser.add_argument("--layers", default=None, help="e.g. 1:80 or 1,5,9, all layers by default")
+    parser.add_argument("--scale", type=float, default=10., help="pixels per mm")
+    parser.add_argument("--types", default=None, help="comma separated ;TYPE: numbers, all by default")
+    parser.add_argument("--out-dir", default=None, help="write one image per layer here")
+    parser.add_argument("--sheet", default=None, help="write a contact sheet of the layers here")
+    parser.add_argument("--columns", type=int, default=None)
+    parser.add_argument("--tile-width", type=int, default=256)
+    parser.add_argument("--plot", action="store_true", help="plot the first layer with matplotlib")
+    args = parser.parse_args(argv)
+
+    layer_index = load_layer_index(args.gcode)
+    layers = range(1, layer_index.num_layer + 1) if args.layers is None else parse_layers(args.layers)
+    types = None if args.types is None else [int(v) for v in args.types.split(",")]
+    renderer = LayerRenderer(args.gcode, args.scale, layers=layers, types=types)
+    if args.out_dir is not None:
+        renderer.save_layers(layers, args.out_dir)
+    if args.sheet is not None:
+        cv.imwrite(args.sheet, renderer.contact_sheet(layers, args.columns, args.tile_width))
+    if args.plot:
+        plot_layer(args.gcode, layers[0])
+
+
+if __name__ == "__main__":
+    main()
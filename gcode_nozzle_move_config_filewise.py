@@ -7,9 +7,13 @@ Gcode for nozzle movement to predetermined camera position.
 
 import os 
 
-def add_nozzle_movement(directory_path, X, Y):
+def camera_move_lines(X, Y):
     retract_line = "G1 E-1."
     line_to_add = "G1 X{} Y{} F9000".format(X, Y)
+    return [retract_line, line_to_add]
+
+def add_nozzle_movement(directory_path, X, Y):
+    retract_line, line_to_add = camera_move_lines(X, Y)
 
     for filename in os.listdir(directory_path):
         if filename.endswith(".gcode") and filename != "end.gcode" and filename != "layer_0.gcode": 
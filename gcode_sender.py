@@ -1,26 +1,224 @@
-from printrun.printcore import printcore
-from printrun import gcoder
+import threading
+import queue
 import time
+import re
+
+# axis values of an M114 position report, "X:180.00 Y:152.00 Z:1.10 E:0.00 Count X: ..."
+_POSITION_RE = re.compile(r"([XYZE]):\s*(-?\d+(?:\.\d+)?)")
+
+class GcodeSegment:
+    """
+    A block of G-code lines queued on the printer stream
+    """
+    def __init__(self, gcode_lines):
+        # strip comments and empty lines like printcore does when printing
+        self.lines = [l.split(";")[0].strip() for l in gcode_lines]
+        self.lines = [l for l in self.lines if l]
+        self.done = threading.Event()
+        # ConnectionError if the printer stopped answering before every line was acknowledged
+        self.error = None
+        self.enqueue_time = time.time()
+        self.start_time = None
+        self.end_time = None
+        self.ack_latencies = []
+
+    # raises the error of a failed segment
+    def wait(self, timeout = None):
+        done = self.done.wait(timeout)
+        if done and self.error is not None:
+            raise self.error
+        return done
+
+    # number of lines of the segment the printer has acknowledged so far
+    def acked_lines(self):
+        return len(self.ack_latencies)
+
+    def mean_ack_latency(self):
+        if len(self.ack_latencies) == 0:
+            return 0.
+        return sum(self.ack_latencies) / len(self.ack_latencies)
+
+    def max_ack_latency(self):
+        return max(self.ack_latencies, default=0.)
+
 
 class GcodeSender:
     """
     Class for establishing connection with printer
+
+    All G-code is streamed over one long-lived session: segments are queued
+    and a sender thread sends their lines with line numbers and checksums,
+    one at a time, each released by the printer's "ok".
+
+    Any object with the printcore interface (online, onlinecb, recvcb, 
+    send_now, disconnect) can be passed as print_core instead of a serial 
+    port, e.g. simulation.SimulatedPrintcore.
+
+    A line is only counted as sent once the printer acknowledged it. If the
+    link drops, or the printer says nothing for ack_timeout seconds (busy
+    and temperature reports count as answers), the segment in flight and
+    every later one fail with a ConnectionError.
     """ 
-    def __init__(self, port = '/dev/tty.usbmodem14201'):
-        self.print_core = printcore(port, 115200)
+    def __init__(self, port = '/dev/tty.usbmodem14201', print_core = None, ack_timeout = 60.):
+        self.online_event = threading.Event()
+        if print_core is None:
+            from printrun.printcore import printcore
+            print_core = printcore(port, 115200)
+        self.print_core = print_core
+        self.print_core.onlinecb = self.online_event.set
+        self.print_core.recvcb = self._on_recv
+
+        self.segment_queue = queue.Queue()
+        self.stream_thread = None
+        self.streaming = False
+        self.last_segment = None
+        self.pending_lines = 0
+
+        # acknowledgement state of the line in flight
+        self.ack_cond = threading.Condition()
+        self.acked = True
+        self.lineno = 0
+        self.sent_lines = {}
+        self.resend_lines = []
+        self.ack_timeout = ack_timeout
+        self.last_recv_time = time.time()
+        # error that stopped the stream, later segments fail with it
+        self.error = None
+        # last position reported by M114
+        self.position = None
 
     def disconnect(self):
+        self.stop_stream()
         self.print_core.disconnect()
 
+    def wait_online(self):
+        while not self.print_core.online:
+            self.online_event.wait(1.)
+
+    def start_stream(self):
+        if self.streaming:
+            return
+        self.wait_online()
+        self.streaming = True
+        self.stream_thread = threading.Thread(target=self._stream_loop, daemon=True)
+        self.stream_thread.start()
+
+    def stop_stream(self):
+        if not self.streaming:
+            return
+        self.segment_queue.put(None)
+        self.stream_thread.join()
+        with self.ack_cond:
+            self.streaming = False
+            self.ack_cond.notify_all()
+
+    # number of queued lines not yet acknowledged by the printer
+    def queue_depth(self):
+        return self.pending_lines
+
+    # Queue G-code lines on the stream, returns immediately
+    def enqueue(self, gcode_lines):
+        self.start_stream()
+        segment = GcodeSegment(gcode_lines)
+        with self.ack_cond:
+            self.pending_lines += len(segment.lines)
+        self.segment_queue.put(segment)
+        return segment
+
     # Read in a .gcode file and send command to printer line by line
     def send_gcode(self, gcode_path):
         gcode0 = [i.strip() for i in open(gcode_path)]
-        gcode = gcoder.LightGCode(gcode0)
+        return self.send_lines(gcode0)
 
-        while not self.print_core.online:
-            time.sleep(0.1)
+    # Send a list of in-memory G-code lines to printer and wait until all are acknowledged
+    def send_lines(self, gcode_lines):
+        segment = self.enqueue(gcode_lines)
+        segment.wait()
+        return segment
+
+    # Wait until the printer has finished all queued moves: M400 is only acknowledged
+    # once the planner is empty, unlike a move, which is acknowledged when it is queued
+    def wait_motion_complete(self):
+        return self.send_lines(["M400"])
+
+    # Position reported by M114 after all queued lines, {"X": x, "Y": y, "Z": z, "E": e}
+    def get_position(self):
+        self.position = None
+        self.send_lines(["M114"])
+        return self.position
+
+    def _stream_loop(self):
+        # reset the line numbers of the printer once per session
+        try:
+            self._send_and_wait("M110 N0")
+        except ConnectionError as err:
+            self.error = err
+        while True:
+            segment = self.segment_queue.get()
+            if segment is None:
+                break
+            self.last_segment = segment
+            segment.start_time = time.time()
+            try:
+                if self.error is not None:
+                    raise ConnectionError("Segment not sent, the stream stopped: {}".format(self.error))
+                for line in segment.lines:
+                    self.lineno += 1
+                    sent_time = time.time()
+                    self._send_and_wait(self._numbered(self.lineno, line))
+                    segment.ack_latencies.append(time.time() - sent_time)
+                    with self.ack_cond:
+                        self.pending_lines -= 1
+            except ConnectionError as err:
+                self.error = self.error or err
+                segment.error = err
+                with self.ack_cond:
+                    self.pending_lines -= len(segment.lines) - segment.acked_lines()
+            segment.end_time = time.time()
+            segment.done.set()
+
+    def _numbered(self, lineno, line):
+        prefix = "N{} {}".format(lineno, line)
+        checksum = 0
+        for c in prefix:
+            checksum ^= ord(c)
+        command = "{}*{}".format(prefix, checksum)
+        self.sent_lines[lineno] = command
+        self.sent_lines.pop(lineno - 100, None)
+        return command
 
-        self.print_core.startprint(gcode)
-        while (self.print_core.printing == True) or (not self.print_core.priqueue.empty()):
-            time.sleep(0.1)
+    # send a line and wait for its "ok", raises ConnectionError if the printer goes offline or silent
+    def _send_and_wait(self, command):
+        with self.ack_cond:
+            self.acked = False
+            self.last_recv_time = time.time()
+            self.print_core.send_now(command)
+            while not self.acked:
+                if not self.print_core.online:
+                    raise ConnectionError("Printer went offline before acknowledging {}".format(command))
+                if time.time() - self.last_recv_time > self.ack_timeout:
+                    raise ConnectionError("No answer from the printer for {} s after {}".format(self.ack_timeout, 
+                                                                                              command))
+                self.ack_cond.wait(1.)
 
+    def _on_recv(self, line):
+        self.last_recv_time = time.time()
+        line = line.strip()
+        if line.lower().startswith("resend") or line.startswith("rs"):
+            digits = "".join(c if c.isdigit() else " " for c in line).split()
+            if digits:
+                with self.ack_cond:
+                    first = int(digits[0])
+                    self.resend_lines = [self.sent_lines[n] for n in range(first, self.lineno + 1)
+                                         if n in self.sent_lines]
+        elif line.startswith("X:"):
+            # the report is followed by "ok", it is stored before the M114 line is released
+            report = line.split("Count")[0]
+            self.position = {axis: float(value) for axis, value in _POSITION_RE.findall(report)}
+        elif line.startswith("ok"):
+            with self.ack_cond:
+                if self.resend_lines:
+                    self.print_core.send_now(self.resend_lines.pop(0))
+                else:
+                    self.acked = True
+                    self.ack_cond.notify_all()
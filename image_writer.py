@@ -0,0 +1,107 @@
+"""
+Asynchronous image persistence
+
+This file writes the images of a run (layer frames, corrected frames,
+contour overlays, crops and defect masks) from a background thread through
+a bounded queue, so disk I/O stays off the critical path. Each artifact has
+its own enable flag and file format; JPEG quality and PNG compression are
+configurable. Images are handed over by reference and must not be modified
+by the caller afterwards. With an archive (see run_archive.py) the images
+of a layer are appended to it raw instead of being encoded to files.
+"""
+
+import time
+import queue
+import threading
+import cv2 as cv
+
+# artifact name -> default file extension
+DEFAULT_FORMATS = {
+    "frame": ".jpg",        # layer_N
+    "corrected": ".jpg",    # layer_N_corrected
+    "contour": ".jpg",      # layer_N_w_contour
+    "crop": ".png",         # layer_N_crop
+    "defect": ".png",       # layer_N_defect
+}
+
+
+class AsyncImageWriter:
+    """
+    Background writer for run images
+    """
+    def __init__(self, max_queue = 32, formats = None, enabled = None, jpeg_quality = 95, png_compression = 3,
+                 drop_when_full = ("contour", "crop", "defect"), archive = None):
+        self.formats = dict(DEFAULT_FORMATS)
+        if formats is not None:
+            self.formats.update(formats)
+        self.enabled = {artifact: True for artifact in self.formats}
+        if enabled is not None:
+            self.enabled.update(enabled)
+        self.params = {
+            ".jpg": [cv.IMWRITE_JPEG_QUALITY, jpeg_quality],
+            ".png": [cv.IMWRITE_PNG_COMPRESSION, png_compression],
+        }
+        # debug artifacts are dropped rather than blocking the caller when the queue is full
+        self.drop_when_full = set(drop_when_full)
+        self.dropped = 0
+        self.written = 0
+        # anything with an append(artifact, layerID, img, correction, capture_time, origin) method
+        self.archive = archive
+
+        self.queue = queue.Queue(max_queue)
+        self.thread = threading.Thread(target=self._write_loop, daemon=True)
+        self.thread.start()
+
+    def is_enabled(self, artifact):
+        return self.enabled.get(artifact, False)
+
+    # queue an image for writing to base_path + the artifact's extension, or to the archive when the
+    # layer is given; origin: position of the image in the frame (crops)
+    def save(self, artifact, base_path, img, layerID = None, correction = False, origin = (0, 0)):
+        if not self.is_enabled(artifact):
+            return None
+        path = base_path + self.formats[artifact]
+        archived = None
+        if self.archive is not None and layerID is not None:
+            archived = (layerID, correction, time.time(), tuple(int(v) for v in origin))
+        if artifact in self.drop_when_full:
+            try:
+                self.queue.put_nowait((artifact, path, img, archived))
+            except queue.Full:
+                self.dropped += 1
+                print("image writer queue full, dropped {}".format(path))
+                return None
+        else:
+            self.queue.put((artifact, path, img, archived))
+        return path
+
+    def _write_loop(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                artifact, path, img, archived = item
+                if archived is not None:
+                    layerID, correction, capture_time, origin = archived
+                    self.archive.append(artifact, layerID, img, correction, capture_time, origin)
+                else:
+                    ext = path[path.rfind("."):].lower()
+                    cv.imwrite(path, img, self.params.get(ext, []))
+                self.written += 1
+            except Exception as err:
+                print("Could not write image: {}".format(err))
+            finally:
+                self.queue.task_done()
+
+    # wait until every queued image is on disk
+    def flush(self):
+        self.queue.join()
+        if self.archive is not None:
+            self.archive.flush()
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        if self.archive is not None:
+            self.archive.close()
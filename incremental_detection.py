@@ -0,0 +1,227 @@
+"""
+Incremental defect detection against the previous layer
+
+The camera moves up with the nozzle, so consecutive layer frames are nearly
+identical outside the new material. This file keeps the blurred frame, mask
+and defects of the previous layer, registers them to the new layer with the
+homography given by the known Z offset, and thresholds and labels only the
+tiles that changed or where the layer contour moved. Defects in unchanged
+tiles are carried over from the previous layer. The homography is usually a
+whole pixel shift (the camera moves with the nozzle), in which case the
+previous layer is sliced instead of warped, and changes are only looked for
+inside the contour band of either layer.
+"""
+
+import numpy as np
+import cv2 as cv
+from defect_extraction import extract_defects, DEFECT_DTYPE, SPAN_DTYPE
+
+
+# homography acting on region-local pixels: region (x0, y0) of `src_roi` to region of `dst_roi`
+def local_homography(homography, src_roi, dst_roi):
+    src = np.array([[1., 0., src_roi[0]], [0., 1., src_roi[1]], [0., 0., 1.]])
+    dst = np.array([[1., 0., -dst_roi[0]], [0., 1., -dst_roi[1]], [0., 0., 1.]])
+    return dst @ homography @ src
+
+
+# concatenate (defects, spans) parts and relabel the defects 1..n
+def merge_defects(parts, with_spans):
+    all_defects, all_spans = [], []
+    next_label = 1
+    for defects, spans in parts:
+        lut = np.zeros(max(int(defects["label"].max()) if len(defects) else 0, 0) + 1, dtype=np.int32)
+        lut[defects["label"]] = np.arange(next_label, next_label + len(defects), dtype=np.int32)
+        defects = defects.copy()
+        defects["label"] = lut[defects["label"]]
+        all_defects.append(defects)
+        if with_spans:
+            spans = spans.copy()
+            spans["label"] = lut[spans["label"]]
+            all_spans.append(spans)
+        next_label += len(defects)
+    defects = np.concatenate(all_defects) if all_defects else np.zeros(0, dtype=DEFECT_DTYPE)
+    if not with_spans:
+        return defects, None
+    spans = np.concatenate(all_spans) if all_spans else np.zeros(0, dtype=SPAN_DTYPE)
+    return defects, spans[np.argsort(spans["label"], kind="stable")]
+
+
+# whole pixel shift (dx, dy) of a homography acting on a region of the given size, None unless it moves
+# every corner of the region by that shift to within half a pixel
+def integer_shift(homography, size, tolerance = 0.5):
+    width, height = size
+    corners = np.array([[[0, 0], [width, 0], [width, height], [0, height]]], dtype=np.float64)
+    moves = (cv.perspectiveTransform(corners, homography) - corners).reshape(-1, 2)
+    shift = np.round(moves.mean(axis=0))
+    if np.abs(moves - shift).max() > tolerance:
+        return None
+    return int(shift[0]), int(shift[1])
+
+
+# mask of the pixels of a box (x0, y0, x1, y1, region pixels) lying in the tiles of a region
+def region_pixels(region_tiles, tile_size, box, region):
+    bx0, by0, bx1, by1 = box
+    t = tile_size
+    tx0, ty0 = bx0 // t, by0 // t
+    tiles = (region_tiles[ty0:-(-by1 // t), tx0:-(-bx1 // t)] == region).astype(np.uint8)
+    pixels = cv.resize(tiles, (tiles.shape[1] * t, tiles.shape[0] * t), interpolation=cv.INTER_NEAREST)
+    return pixels[by0 - ty0 * t:by1 - ty0 * t, bx0 - tx0 * t:bx1 - tx0 * t]
+
+
+class IncrementalDetection:
+    """
+    Defect detection of a layer reusing the result of the previous layer in unchanged tiles
+    """
+    def __init__(self, tile_size = 32, change_threshold = 12, full_every = 0):
+        # tiles must be larger than the largest defect, full_every: run a full detection every N layers (0: never)
+        self.tile_size = tile_size
+        self.change_threshold = change_threshold
+        self.full_every = full_every
+        self.prev = None
+        self.layers_since_full = 0
+        # fraction of the region analysed for the last layer
+        self.last_active_fraction = 1.
+
+    def reset(self):
+        self.prev = None
+
+    # defects of a layer image, blurred and mask cover the image region roi = (x0, y0, x1, y1)
+    # homography maps full image pixels of the previous layer to this layer, None forces a full detection
+    # returns (defects, spans, defect_mask) like defect_extraction.extract_defects
+    def detect(self, layerID, blurred, mask, roi, homography, binary_threshold = 90, min_area = 10, max_area = 200,
+               with_spans = False):
+        params = (binary_threshold, min_area, max_area)
+        prev = self.prev
+        full = (prev is None or homography is None or prev["layerID"] != layerID - 1 or prev["params"] != params or
+                (with_spans and prev["spans"] is None) or
+                (self.full_every > 0 and self.layers_since_full >= self.full_every))
+        if full:
+            ret, binary = cv.threshold(blurred, binary_threshold, 255, cv.THRESH_BINARY_INV)
+            defects, spans, defect_mask = extract_defects(binary, min_area, max_area, roi[:2], with_spans)
+            self.layers_since_full = 0
+            self.last_active_fraction = 1.
+        else:
+            defects, spans, defect_mask = self._detect_changed(blurred, mask, roi, homography, params, with_spans)
+            self.layers_since_full += 1
+
+        self.prev = {"layerID": layerID, "params": params, "roi": roi, "blurred": blurred.copy(),
+                     "mask": mask.copy(), "defects": defects, "spans": spans, "defect_mask": defect_mask}
+        return defects, spans, defect_mask
+
+    def _detect_changed(self, blurred, mask, roi, homography, params, with_spans):
+        binary_threshold, min_area, max_area = params
+        height, width = blurred.shape
+        t = self.tile_size
+
+        # previous layer registered to this layer's region: the camera moves with the nozzle, so the
+        # homography is usually a whole pixel shift and the previous arrays are only sliced
+        H = local_homography(homography, self.prev["roi"], roi)
+        shift = integer_shift(H, (width, height))
+        if shift is None:
+            changed, defect_mask = self._warped_changes(blurred, mask, H)
+        else:
+            changed, defect_mask = self._shifted_changes(blurred, mask, shift)
+
+        # changed tiles, grown by one tile so every defect touching them is inside
+        tiles_y, tiles_x = -(-height // t), -(-width // t)
+        padded = cv.copyMakeBorder(changed, 0, tiles_y * t - height, 0, tiles_x * t - width, cv.BORDER_CONSTANT,
+                                   value=0)
+        active = padded.reshape(tiles_y, t, tiles_x * t).max(axis=1).reshape(tiles_y, tiles_x, t).max(axis=2)
+        grown = cv.dilate((active > 0).astype(np.uint8), np.ones((3, 3), dtype=np.uint8))
+        self.last_active_fraction = float(grown.mean())
+        num_region, region_tiles, stats, _ = cv.connectedComponentsWithStats(grown, 8, cv.CV_32S)
+
+        # defect mask of the previous layer in unchanged tiles, replaced in the tiles of every region
+        parts = [self._carried(roi, homography, region_tiles, with_spans)]
+        for region in range(1, num_region):
+            tx, ty, tw, th = stats[region, :4]
+            # pixel box of the tiles, padded by half a tile for defects reaching out of them
+            bx0, by0 = max(tx * t - t // 2, 0), max(ty * t - t // 2, 0)
+            bx1, by1 = min((tx + tw) * t + t // 2, width), min((ty + th) * t + t // 2, height)
+            ret, binary = cv.threshold(blurred[by0:by1, bx0:bx1], binary_threshold, 255, cv.THRESH_BINARY_INV)
+            defects, spans, box_mask = extract_defects(binary, min_area, max_area,
+                                                       (roi[0] + bx0, roi[1] + by0), with_spans)
+            # keep the defects centred in this region's tiles
+            keep = self._tile_of(defects, roi, region_tiles) == region
+            parts.append((defects[keep], None if spans is None else spans[np.isin(spans["label"],
+                                                                                  defects["label"][keep])]))
+            in_region = region_pixels(region_tiles, t, (bx0, by0, bx1, by1), region) > 0
+            defect_mask[by0:by1, bx0:bx1][in_region] = box_mask[in_region]
+
+        defects, spans = merge_defects(parts, with_spans)
+        return defects, spans, defect_mask
+
+    # change map (255: changed) and previous defect mask of a previous layer shifted by whole pixels (dx, dy)
+    def _shifted_changes(self, blurred, mask, shift):
+        prev = self.prev
+        dx, dy = shift
+        height, width = blurred.shape
+        prev_height, prev_width = prev["blurred"].shape
+        changed = np.full((height, width), 255, dtype=np.uint8)
+        defect_mask = np.zeros((height, width), dtype=np.uint8)
+        # window of this region seen in the previous one, pixels outside it count as changed
+        x0, y0 = max(dx, 0), max(dy, 0)
+        x1, y1 = min(prev_width + dx, width), min(prev_height + dy, height)
+        if x1 <= x0 or y1 <= y0:
+            return changed, defect_mask
+        cur = (slice(y0, y1), slice(x0, x1))
+        old = (slice(y0 - dy, y1 - dy), slice(x0 - dx, x1 - dx))
+        # new content or contour moved, inside the contour band of either layer only
+        ret, diff = cv.threshold(cv.absdiff(blurred[cur], prev["blurred"][old]), self.change_threshold, 255,
+                                 cv.THRESH_BINARY)
+        band = cv.bitwise_or(mask[cur], prev["mask"][old])
+        changed[cur] = cv.bitwise_and(cv.bitwise_or(diff, cv.compare(mask[cur], prev["mask"][old], cv.CMP_NE)),
+                                      band)
+        defect_mask[cur] = prev["defect_mask"][old]
+        return changed, defect_mask
+
+    # change map and previous defect mask of a previous layer warped by a region-local homography
+    def _warped_changes(self, blurred, mask, H):
+        prev = self.prev
+        height, width = blurred.shape
+        size = (width, height)
+        prev_blurred = cv.warpPerspective(prev["blurred"], H, size, flags=cv.INTER_LINEAR)
+        valid = cv.warpPerspective(np.full(prev["blurred"].shape, 255, dtype=np.uint8), H, size,
+                                   flags=cv.INTER_NEAREST)
+        prev_mask = cv.warpPerspective(prev["mask"], H, size, flags=cv.INTER_NEAREST)
+        defect_mask = cv.warpPerspective(prev["defect_mask"], H, size, flags=cv.INTER_NEAREST)
+
+        # new content or contour moved inside the contour band, or not seen in the previous region
+        ret, changed = cv.threshold(cv.absdiff(blurred, prev_blurred), self.change_threshold, 255, cv.THRESH_BINARY)
+        changed = cv.bitwise_or(changed, cv.compare(mask, prev_mask, cv.CMP_NE))
+        changed = cv.bitwise_and(changed, cv.bitwise_or(mask, prev_mask))
+        changed[valid == 0] = 255
+        return changed, defect_mask
+
+    # region label of the tile holding each defect centroid, 0: unchanged tile, -1: outside the region
+    def _tile_of(self, defects, roi, region_tiles):
+        tx = np.floor((defects["cx"] - roi[0]) / self.tile_size).astype(np.int64)
+        ty = np.floor((defects["cy"] - roi[1]) / self.tile_size).astype(np.int64)
+        inside = (tx >= 0) & (ty >= 0) & (tx < region_tiles.shape[1]) & (ty < region_tiles.shape[0])
+        regions = np.full(len(defects), -1, dtype=np.int64)
+        regions[inside] = region_tiles[ty[inside], tx[inside]]
+        return regions
+
+    # defects of the previous layer lying in unchanged tiles, moved to this layer
+    def _carried(self, roi, homography, region_tiles, with_spans):
+        defects = self.prev["defects"].copy()
+        spans = self.prev["spans"]
+        if len(defects) == 0:
+            return defects, None if spans is None else spans[:0]
+        centres = np.stack([defects["cx"], defects["cy"]], axis=1).reshape(-1, 1, 2)
+        moved = cv.perspectiveTransform(centres, homography).reshape(-1, 2)
+        shift = np.round(moved - centres.reshape(-1, 2)).astype(np.int32)
+        defects["cx"], defects["cy"] = moved[:, 0], moved[:, 1]
+        defects["x"] += shift[:, 0]
+        defects["y"] += shift[:, 1]
+        keep = self._tile_of(defects, roi, region_tiles) == 0
+        if not with_spans:
+            return defects[keep], None
+        spans = spans[np.isin(spans["label"], defects["label"][keep])].copy()
+        # spans follow their defect by the rounded centroid shift
+        lut = np.zeros((len(defects) + 1, 2), dtype=np.int32)
+        lut[defects["label"]] = shift
+        spans["row"] += lut[spans["label"], 1]
+        spans["start"] += lut[spans["label"], 0]
+        spans["stop"] += lut[spans["label"], 0]
+        return defects[keep], spans
@@ -3,58 +3,56 @@ Parse full Gcode file to layerwise Gcode files
 
 This file reads in a .gcode file produced by the 3D printer parser 
 and separate it into the preparation file, the end file, and files 
-containing commands for fabricating each layer. 
+containing commands for fabricating each layer. The file is streamed 
+line by line, so memory use does not grow with the file size.
 """
 
-def parse_layer(gcode_file, bellow_dir, triangle_dir):
-    all_lines = []
+from layer_store import LayerStore
+from gcode_nozzle_move_config_filewise import camera_move_lines
+
+# split the gcode file into layer segments of the printed object and the wiping pattern
+def split_layers(gcode_file, layer_store, object_marker = "SmallBellow", 
+                 wipe_marker = "wiping_pattern_z", camera_position = None):
+    object_stop = "; stop printing object " + object_marker
+    wipe_stop = None if wipe_marker is None else "; stop printing object " + wipe_marker
     temp_list = []
-    line_dict = {}
     layer_num = 1
+    in_preset = True
 
-    # read in all lines
-    with open(gcode_file, "r") as f: 
-        all_lines = f.readlines()
-
-    # get the preset layer
-    for line in all_lines:
-        line = line.strip()
-        temp_list.append(line)
-        all_lines = all_lines[1:]
-        if "M107" in line:       
-            line_dict[0] = temp_list
-            file_name = bellow_dir + "layer_0.gcode"
-            file = open(file_name, "w")
-            for l in temp_list:
-                file.write(l + "\n")
-            temp_list = []
-            break
-
-    # remove all empty lines
-    l = list(map(lambda x: x.replace('\n', ''), all_lines))
-    all_lines = list(filter(None, l))
-
-    all_lines = iter(all_lines)
-    for line in all_lines:
-        if line.strip():
+    with open(gcode_file, "r") as f:
+        for line in f:
             line = line.strip()
+            # get the preset layer
+            if in_preset:
+                temp_list.append(line)
+                if "M107" in line:
+                    layer_store.put("layer_0", temp_list)
+                    temp_list = []
+                    in_preset = False
+                continue
+
+            # remove all empty lines
+            if not line:
+                continue
             temp_list.append(line)
-            if "; stop printing object SmallBellow" in line:
-                file_name = bellow_dir + "layer_{}.gcode".format(layer_num)
-                file = open(file_name, "w")
-                for l in temp_list:
-                    file.write(l + "\n")
+            if object_stop in line:
+                # add nozzle movement for camera position
+                if camera_position is not None:
+                    temp_list.extend(camera_move_lines(camera_position[0], camera_position[1]))
+                layer_store.put("layer_{}".format(layer_num), temp_list)
                 temp_list = []
-            elif "; stop printing object wiping_pattern_z" in line:
-                file_name = triangle_dir + "layer_{}.gcode".format(layer_num)
-                file = open(file_name, "w")
-                for l in temp_list:
-                    file.write(l + "\n")
+                if wipe_stop is None:
+                    layer_num += 1
+            elif wipe_stop is not None and wipe_stop in line:
+                layer_store.put("layer_{}".format(layer_num), temp_list, kind="wipe")
                 temp_list = []
                 layer_num += 1
 
     # write the last layer
-    file_name = bellow_dir + "end.gcode"
-    file = open(file_name, "w")
-    for l in temp_list:
-        file.write(l + "\n")
\ No newline at end of file
+    layer_store.put("end", temp_list)
+    return layer_store
+
+
+def parse_layer(gcode_file, bellow_dir, triangle_dir):
+    layer_store = LayerStore(bellow_dir, triangle_dir, keep_in_memory=False)
+    split_layers(gcode_file, layer_store)
@@ -0,0 +1,63 @@
+"""
+In-memory store for layerwise G-code
+
+This file holds the layerwise G-code segments produced by the layer splitter
+("layer_0", "layer_1", ..., "end" for the printed object and "layer_N" for
+the wiping pattern). The segments are kept in memory and can optionally be
+mirrored to disk, in which case the memory copy can be dropped. The ironing
+template of a segment is parsed on first use and kept until it is replaced.
+"""
+
+import os
+from gcode_ironing import IroningTemplate
+
+
+class LayerStore:
+    """
+    Layerwise G-code segments, keyed by segment name and kind ("object" or "wipe")
+    """
+    def __init__(self, object_dir = None, wipe_dir = None, keep_in_memory = True):
+        self.dirs = {"object": object_dir, "wipe": wipe_dir}
+        self.keep_in_memory = keep_in_memory
+        self.segments = {"object": {}, "wipe": {}}
+        self.templates = {}
+
+    def path(self, name, kind = "object"):
+        if self.dirs[kind] is None:
+            return None
+        return os.path.join(self.dirs[kind], name + ".gcode")
+
+    def put(self, name, lines, kind = "object"):
+        file_path = self.path(name, kind)
+        if file_path is not None:
+            with open(file_path, "w") as f:
+                for l in lines:
+                    f.write(l + "\n")
+        if self.keep_in_memory or file_path is None:
+            self.segments[kind][name] = list(lines)
+        else:
+            self.segments[kind][name] = None
+        self.templates.pop((name, kind), None)
+
+    def get(self, name, kind = "object"):
+        lines = self.segments[kind][name]
+        if lines is None:
+            lines = [i.strip() for i in open(self.path(name, kind))]
+        return lines
+
+    # ironing template of a segment (see gcode_ironing.py), parsed once
+    def ironing_template(self, name, kind = "object"):
+        template = self.templates.get((name, kind))
+        if template is None:
+            template = self.templates[(name, kind)] = IroningTemplate(self.get(name, kind))
+        return template
+
+    def has(self, name, kind = "object"):
+        return name in self.segments[kind]
+
+    def names(self, kind = "object"):
+        return list(self.segments[kind])
+
+    # number of printed layers (layer_0 and end are not counted)
+    def num_layer(self, kind = "object"):
+        return len([n for n in self.segments[kind] if n.startswith("layer_") and n != "layer_0"])
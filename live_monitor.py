@@ -0,0 +1,326 @@
+"""
+In-print video monitoring
+
+This file checks the part while a layer is printed instead of only after it.
+A monitor thread takes decimated frames from the camera's grab thread at a
+fixed analysis rate and estimates where the nozzle is from the layer G-code
+being streamed: move times follow from lengths and feed rates, bounded by the
+lines the printer has acknowledged. Only the path deposited in the last few
+millimetres behind the nozzle is checked. The image region around it is
+undistorted at reduced resolution, and dark spots inside the projected layer
+contour are flagged as suspect regions while the layer is still printing.
+Spots pass the same area bounds as the defects of the post-layer detection,
+scaled to the analysed resolution. Suspects feed the correction decision
+taken after the layer; no correction is started while the layer prints.
+
+For every analysed frame the latency from grab to result is recorded. Analysis
+slots missed because the previous frame was still being analysed are counted
+as dropped frames.
+"""
+
+import math
+import time
+import threading
+import numpy as np
+import cv2 as cv
+
+# moves of a layer segment: segment line, XY start and end, timing from the segment start,
+# and deposited path length before / after the move
+MOVE_DTYPE = np.dtype([("line", np.int32), ("x0", np.float64), ("y0", np.float64), ("x1", np.float64),
+                       ("y1", np.float64), ("extruding", np.bool_), ("start", np.float64), ("end", np.float64),
+                       ("s0", np.float64), ("s1", np.float64)])
+
+
+# G0/G1 moves of a list of G-code lines, timed from the first line
+def parse_moves(gcode_lines, start = None, relative_e = True, max_speed = 200.):
+    # start: (x, y) before the first line, defaults to the first XY target
+    # max_speed: mm/s cap of the XY speed (firmware limit)
+    x, y = (None, None) if start is None else start
+    relative = False
+    feedrate = 1500.
+    e = 0.
+    t = s = 0.
+    rows = []
+    for k, line in enumerate(gcode_lines):
+        tokens = line.split(";")[0].split()
+        if not tokens:
+            continue
+        cmd = tokens[0]
+        if cmd == "G90":
+            relative = False
+        elif cmd == "G91":
+            relative = True
+        elif cmd == "M82":
+            relative_e = False
+        elif cmd == "M83":
+            relative_e = True
+        if cmd not in ("G0", "G1", "G92"):
+            continue
+        params = {}
+        for token in tokens[1:]:
+            try:
+                params[token[0]] = float(token[1:])
+            except ValueError:
+                pass
+        if cmd == "G92":
+            e = params.get("E", e)
+            continue
+
+        if x is None:
+            x, y = params.get("X", 0.), params.get("Y", 0.)
+        nx = x + params.get("X", 0.) if relative else params.get("X", x)
+        ny = y + params.get("Y", 0.) if relative else params.get("Y", y)
+        dz = params.get("Z", 0.) if relative else 0.
+        de = 0.
+        if "E" in params:
+            de = params["E"] if relative or relative_e else params["E"] - e
+            e += de
+        if "F" in params:
+            feedrate = params["F"]
+
+        length = math.hypot(nx - x, ny - y)
+        speed = feedrate / 60.
+        travel = max(length, abs(dz), abs(de) if length == 0 else 0.)
+        duration = travel / speed if speed > 0 else 0.
+        duration = max(duration, length / max_speed)
+        extruding = de > 0 and length > 0
+        ds = length if extruding else 0.
+        rows.append((k, x, y, nx, ny, extruding, t, t + duration, s, s + ds))
+        x, y = nx, ny
+        t += duration
+        s += ds
+    return np.array(rows, dtype=MOVE_DTYPE)
+
+
+class ToolpathTracker:
+    """
+    Estimated nozzle position while a G-code segment is streamed
+    """
+    def __init__(self, moves, segment, planner_lines = 16):
+        # planner_lines: lines the printer can accept ahead of the move it executes
+        self.moves = moves
+        self.segment = segment
+        self.planner_lines = planner_lines
+
+    # (x, y, deposited path length) at wall time `now`, None before the segment starts
+    def position(self, now):
+        start_time = self.segment.start_time
+        if start_time is None or len(self.moves) == 0:
+            return None
+        moves = self.moves
+        t = now - start_time
+        acked = self.segment.acked_lines()
+        # moves of acknowledged lines may have run, the planner holds at most planner_lines of them
+        last = np.searchsorted(moves["line"], acked) - 1
+        first = np.searchsorted(moves["line"], acked - self.planner_lines) - 1
+        if last < 0:
+            return float(moves["x0"][0]), float(moves["y0"][0]), 0.
+        k = int(np.clip(np.searchsorted(moves["end"], t, side="right"), max(first, 0), last))
+        move = moves[k]
+        duration = move["end"] - move["start"]
+        if k == last and t >= move["end"]:
+            fraction = 1.
+        elif k == first and t < move["start"]:
+            fraction = 0.
+        else:
+            fraction = float(np.clip((t - move["start"]) / duration, 0., 1.)) if duration > 0 else 1.
+        x = move["x0"] + (move["x1"] - move["x0"]) * fraction
+        y = move["y0"] + (move["y1"] - move["y0"]) * fraction
+        return float(x), float(y), float(move["s0"] + (move["s1"] - move["s0"]) * fraction)
+
+    # deposited path between path lengths s0 and s1, as a list of (N, 2) polylines
+    def path_between(self, s0, s1):
+        moves = self.moves[self.moves["extruding"] & (self.moves["s1"] > s0) & (self.moves["s0"] < s1)]
+        if len(moves) == 0:
+            return []
+        # clip the first and last move to the interval
+        length = moves["s1"] - moves["s0"]
+        a = np.clip((s0 - moves["s0"]) / length, 0., 1.)
+        b = np.clip((s1 - moves["s0"]) / length, 0., 1.)
+        starts = np.stack([moves["x0"] + (moves["x1"] - moves["x0"]) * a,
+                           moves["y0"] + (moves["y1"] - moves["y0"]) * a], axis=1)
+        ends = np.stack([moves["x0"] + (moves["x1"] - moves["x0"]) * b,
+                         moves["y0"] + (moves["y1"] - moves["y0"]) * b], axis=1)
+        # consecutive moves sharing an end point form one polyline
+        breaks = np.flatnonzero(np.any(np.abs(starts[1:] - ends[:-1]) > 1e-6, axis=1)) + 1
+        paths = []
+        for f, l in zip(np.r_[0, breaks], np.r_[breaks, len(moves)]):
+            paths.append(np.vstack([starts[f:f + 1], ends[f:l]]))
+        return paths
+
+
+def _stats(samples):
+    if len(samples) == 0:
+        return {"mean_s": 0., "p90_s": 0., "max_s": 0.}
+    samples = np.asarray(samples)
+    return {"mean_s": float(samples.mean()), "p90_s": float(np.percentile(samples, 90)),
+            "max_s": float(samples.max())}
+
+
+class LiveMonitor:
+    """
+    Class for checking the recently deposited path in the camera feed while a layer prints
+    """
+    def __init__(self, camera, defect_detector, analysis_fps = 5., downsample = 2, window = 8., lag = 3.,
+                 bead_width = 0.45, binary_threshold = 85, min_area = 10, max_area = 200, merge_distance = 1.,
+                 planner_lines = 16, on_suspect = None):
+        # window: mm of deposited path checked per frame, lag: mm behind the nozzle left out (nozzle in view)
+        # min_area, max_area: area bounds of a suspect spot like DefectDetection.get_defects, in pixels of a
+        # 1920 wide capture for max_area, divided by downsample^2 for the analysed pixels
+        # on_suspect: called with (layerID, (x, y, z)) for every new suspect region
+        self.camera = camera
+        self.detector = defect_detector
+        self.analysis_fps = analysis_fps
+        self.downsample = downsample
+        self.window = window
+        self.lag = lag
+        self.bead_px = bead_width / abs(defect_detector.pixel_scale[0])
+        self.binary_threshold = binary_threshold
+        self.min_area = min_area / downsample ** 2
+        self.max_area = defect_detector.max_area(max_area) / downsample ** 2
+        self.merge_distance = merge_distance
+        self.planner_lines = planner_lines
+        self.on_suspect = on_suspect
+
+        self.layerID = None
+        self.thread = None
+        self.stop_event = threading.Event()
+        self.error = None
+        self._reset()
+
+    def _reset(self):
+        self.suspects = []
+        self.latencies = []
+        self.analyzed = 0
+        self.dropped = 0
+        self.start_time = time.time()
+        self.end_time = None
+
+    # start monitoring a layer streamed as `segment` (see gcode_sender.GcodeSegment)
+    def start_layer(self, layerID, segment, start = None):
+        self.end_layer()
+        self._reset()
+        det = self.detector
+        self.layerID = layerID
+        self.tracker = ToolpathTracker(parse_moves(segment.lines, start), segment, self.planner_lines)
+        # projected layer contour seen from the picture taking position, shifted with the nozzle per frame
+        self.layer_mask = det.get_layer_mask(layerID)
+        z = det.layer_index.layer_height_z(layerID)
+        det.update_nozzle_pos(layerID)
+        self.layer_z = det.nozzle_pos[2] if z is None else z
+        self.mask_pos = (det.img_taken_position[0], det.img_taken_position[1], self.layer_z)
+
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    # stop monitoring, returns the (N, 3) suspect positions of the layer
+    def end_layer(self):
+        if self.thread is not None:
+            self.stop_event.set()
+            self.thread.join()
+            self.thread = None
+            self.end_time = time.time()
+        return np.array(self.suspects, dtype=np.float64).reshape(-1, 3)
+
+    def _run(self):
+        try:
+            self._monitor_loop()
+        except Exception as err:
+            self.error = err
+            print("live monitor of layer {} stopped: {!r}".format(self.layerID, err))
+
+    def _monitor_loop(self):
+        period = 1. / self.analysis_fps
+        next_time = time.time()
+        count = None
+        while not self.stop_event.is_set():
+            wait = next_time - time.time()
+            if wait > 0:
+                if self.stop_event.wait(wait):
+                    break
+            else:
+                # analysis slots missed while the previous frame was analysed
+                missed = int(-wait // period)
+                self.dropped += missed
+                next_time += missed * period
+            next_time += period
+
+            try:
+                img, count, grab_time = self.camera.next_timed_frame(count, timeout=period * 4)
+            except TimeoutError:
+                self.dropped += 1
+                continue
+            position = self.tracker.position(grab_time)
+            if position is None:
+                continue
+            x, y, s = position
+            new = self.analyze(img, (x, y), s)
+            self.latencies.append(time.time() - grab_time)
+            self.analyzed += 1
+            for suspect in new:
+                print("layer {}: suspect region at ({:.2f}, {:.2f}) while printing".format(
+                    self.layerID, suspect[0], suspect[1]))
+                if self.on_suspect is not None:
+                    self.on_suspect(self.layerID, suspect)
+
+    # suspect positions found in a frame taken with the nozzle at `nozzle_xy`, after `path_length` mm
+    # of the layer were deposited; returns the ones not flagged before
+    def analyze(self, img, nozzle_xy, path_length):
+        det = self.detector
+        paths = self.tracker.path_between(path_length - self.lag - self.window, path_length - self.lag)
+        if len(paths) == 0:
+            return []
+        nozzle_pos = (nozzle_xy[0], nozzle_xy[1], self.layer_z)
+        pixel_paths = [det.printer_to_pixels(p, nozzle_pos) for p in paths]
+        points = np.concatenate(pixel_paths)
+
+        # region around the recent path, undistorted at reduced resolution with strided remap tables
+        (width, height) = det.img_shape
+        ds = self.downsample
+        margin = self.bead_px + 2 * ds
+        x0, y0 = np.clip(np.floor(points.min(axis=0) - margin), 0, [width, height]).astype(int)
+        x1, y1 = np.clip(np.ceil(points.max(axis=0) + margin), 0, [width, height]).astype(int)
+        if x1 - x0 < ds or y1 - y0 < ds:
+            return []
+        if img.shape[1::-1] != det.img_shape:
+            img = cv.resize(img, det.img_shape)
+        roi = cv.remap(img, det.undistort_map1[y0:y1:ds, x0:x1:ds], det.undistort_map2[y0:y1:ds, x0:x1:ds],
+                       cv.INTER_LINEAR)
+        gray = cv.GaussianBlur(cv.cvtColor(roi, cv.COLOR_BGR2GRAY), (3, 3), 0)
+
+        # inner part of the bead band, inside the layer contour moved by the nozzle offset
+        band = np.zeros(gray.shape, dtype=np.uint8)
+        polylines = [np.round((p - [x0, y0]) / ds * 16).astype(np.int32) for p in pixel_paths]
+        cv.polylines(band, polylines, False, 255, max(int(round(self.bead_px / ds)), 1), cv.LINE_8, 4)
+        dx, dy = np.round(det.printer_to_pixels([nozzle_xy], nozzle_pos)[0] -
+                          det.printer_to_pixels([nozzle_xy], self.mask_pos)[0]).astype(int)
+        mask = self.layer_mask.region(x0 - dx, y0 - dy, x1 - dx, y1 - dy)[::ds, ::ds]
+        mask = cv.erode(mask, np.ones((3, 3), dtype=np.uint8))
+        check = cv.bitwise_and(band, mask)
+
+        dark = np.where((gray < self.binary_threshold) & (check > 0), np.uint8(255), np.uint8(0))
+        num_label, labels, stats, centroids = cv.connectedComponentsWithStats(dark, 8, cv.CV_32S)
+        areas = stats[1:, cv.CC_STAT_AREA]
+        spots = centroids[1:][(areas >= self.min_area) & (areas <= self.max_area)]
+        if len(spots) == 0:
+            return []
+        positions = det.pixels_to_printer(spots * ds + [x0, y0], nozzle_pos)
+        positions[:, 2] = self.layer_z
+
+        new = []
+        for position in positions:
+            if all(math.hypot(position[0] - p[0], position[1] - p[1]) > self.merge_distance
+                   for p in self.suspects):
+                self.suspects.append(position)
+                new.append(position)
+        return new
+
+    # per-layer monitoring statistics
+    def report(self):
+        end_time = time.time() if self.end_time is None else self.end_time
+        duration = end_time - self.start_time
+        report = {"frames": self.analyzed, "dropped": self.dropped, "suspects": len(self.suspects),
+                  "analysis_fps": self.analyzed / duration if duration > 0 else 0.}
+        report["latency"] = _stats(self.latencies)
+        return report
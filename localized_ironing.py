@@ -0,0 +1,221 @@
+"""
+Localized ironing around detected defects
+
+This file generates a short correction program for a layer instead of
+re-printing the whole layer. The extrusion moves of the layer (perimeters
+by default) are taken from the G-code layer index, clipped to a radius
+around each defect position, and the remaining pieces are chained into
+paths and visited in nearest-neighbour order with reduced extrusion and
+feed rate, like the whole-layer ironing of gcode_ironing.py. Travels between
+paths are retracted and lifted by a Z hop so the nozzle does not drag over
+the fresh top surface; the program starts from and ends in the retraction
+state the layer's G-code leaves the extruder in.
+"""
+
+import numpy as np
+from gcode_layer_index import load_layer_index, FLAG_POINT
+
+SEGMENT_DTYPE = np.dtype([
+    ("row", np.int64),      # index row of the move ending the segment
+    ("x0", np.float64),
+    ("y0", np.float64),
+    ("x1", np.float64),
+    ("y1", np.float64),
+    ("z", np.float64),
+    ("e", np.float64),      # extrusion of the whole segment
+    ("f", np.float64),
+])
+
+
+# extrusion segments of a layer with one of the given ;TYPE: categories
+def layer_segments(layer_index, layerID, types = (1, 2, 3)):
+    rows = layer_index.layer_rows(layerID)
+    flags = layer_index.flags[rows]
+    layer_types = layer_index.type[rows]
+    ends = np.flatnonzero((flags == FLAG_POINT) & np.isin(layer_types, types)) + rows.start
+    # a segment starts where the previous move ended
+    ends = ends[ends > 0]
+    starts = ends - 1
+
+    segments = np.zeros(len(ends), dtype=SEGMENT_DTYPE)
+    segments["row"] = ends
+    segments["x0"] = layer_index.x[starts]
+    segments["y0"] = layer_index.y[starts]
+    segments["x1"] = layer_index.x[ends]
+    segments["y1"] = layer_index.y[ends]
+    segments["z"] = layer_index.z[ends]
+    segments["e"] = layer_index.e[ends]
+    segments["f"] = layer_index.f[ends]
+    return segments
+
+
+# parameter intervals [t0, t1] of the segments inside a circle of `radius` around any centre
+# returns (segment index, t0, t1) arrays with overlapping intervals of a segment merged
+def clip_segments(segments, centres, radius):
+    if len(segments) == 0 or len(centres) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0), np.zeros(0)
+    centres = np.asarray(centres, dtype=np.float64)[:, :2]
+
+    p0 = np.stack([segments["x0"], segments["y0"]], axis=1)
+    d = np.stack([segments["x1"], segments["y1"]], axis=1) - p0
+
+    # |p0 + t d - c|^2 = r^2, for every segment / centre pair
+    m = p0[:, None, :] - centres[None, :, :]
+    a = (d * d).sum(axis=1)[:, None]
+    b = 2 * (m * d[:, None, :]).sum(axis=2)
+    c = (m * m).sum(axis=2) - radius ** 2
+    disc = b * b - 4 * a * c
+    hit = (disc > 0) & (a > 0)
+    seg, centre = np.nonzero(hit)
+    root = np.sqrt(disc[seg, centre])
+    t0 = np.clip((-b[seg, centre] - root) / (2 * a[seg, 0]), 0., 1.)
+    t1 = np.clip((-b[seg, centre] + root) / (2 * a[seg, 0]), 0., 1.)
+    inside = t1 > t0
+    seg, t0, t1 = seg[inside], t0[inside], t1[inside]
+
+    # merge the intervals of every segment
+    order = np.lexsort((t0, seg))
+    merged_seg, merged_t0, merged_t1 = [], [], []
+    for s, a0, a1 in zip(seg[order].tolist(), t0[order].tolist(), t1[order].tolist()):
+        if merged_seg and merged_seg[-1] == s and a0 <= merged_t1[-1]:
+            merged_t1[-1] = max(merged_t1[-1], a1)
+        else:
+            merged_seg.append(s)
+            merged_t0.append(a0)
+            merged_t1.append(a1)
+    return np.array(merged_seg, dtype=np.int64), np.array(merged_t0), np.array(merged_t1)
+
+
+# chain clipped pieces into paths; a path continues while the pieces are consecutive moves
+# returns a list of (points (N+1, 2), e (N,), f (N,)) tuples
+def clipped_paths(segments, seg, t0, t1, min_length = 0.):
+    paths = []
+    points, es, fs = [], [], []
+    last_row = None
+    for s, a0, a1 in zip(seg.tolist(), t0.tolist(), t1.tolist()):
+        segment = segments[s]
+        x0, y0, x1, y1 = segment["x0"], segment["y0"], segment["x1"], segment["y1"]
+        start = (x0 + a0 * (x1 - x0), y0 + a0 * (y1 - y0))
+        stop = (x0 + a1 * (x1 - x0), y0 + a1 * (y1 - y0))
+        connected = last_row is not None and segment["row"] == last_row + 1 and a0 == 0. and points
+        if not connected:
+            if es:
+                paths.append((np.array(points), np.array(es), np.array(fs)))
+            points, es, fs = [start], [], []
+        points.append(stop)
+        es.append(segment["e"] * (a1 - a0))
+        fs.append(segment["f"])
+        # only a piece reaching the end of its segment can continue into the next one
+        last_row = segment["row"] if a1 == 1. else None
+    if es:
+        paths.append((np.array(points), np.array(es), np.array(fs)))
+
+    return [p for p in paths if np.hypot(*np.diff(p[0], axis=0).T).sum() >= min_length]
+
+
+# greedy nearest-neighbour order of the paths from `start`, paths may be reversed
+def order_paths(paths, start = None):
+    if not paths:
+        return []
+    ends = np.array([[p[0][0], p[0][-1]] for p in paths])      # (N, 2 ends, 2)
+    left = np.ones(len(paths), dtype=bool)
+    position = ends[0, 0] if start is None else np.asarray(start[:2], dtype=np.float64)
+    ordered = []
+    for _ in range(len(paths)):
+        dist = np.hypot(*(ends - position).transpose(2, 0, 1))
+        dist[~left] = np.inf
+        k, end = np.unravel_index(np.argmin(dist), dist.shape)
+        points, es, fs = paths[k]
+        if end == 1:
+            points, es, fs = points[::-1], es[::-1], fs[::-1]
+        ordered.append((points, es, fs))
+        left[k] = False
+        position = points[-1]
+    return ordered
+
+
+# filament left retracted at the end of a layer: the trailing run of negative extrusions (retraction,
+# wipe) after the last positive one, 0 when the layer ends unretracted
+def retracted_at_end(layer_index, layerID):
+    e = layer_index.e[layer_index.layer_rows(layerID)]
+    e = e[e != 0]
+    last_positive = np.flatnonzero(e > 0)
+    trailing = e[last_positive[-1] + 1:] if len(last_positive) else e
+    return float(-trailing.sum())
+
+
+class LocalizedIroning:
+    """
+    Class for generating ironing programs around the defects of a layer
+    """
+    def __init__(self, gcode_path, radius = 2., types = (1, 2, 3), E_proportion = 0.2, S_proportion = 0.6,
+                 travel_feedrate = 9000, retract_length = 0.8, retract_feedrate = 2100, z_hop = 0.4,
+                 z_feedrate = 720, min_length = 0.2, end_position = None):
+        self.layer_index = load_layer_index(gcode_path)
+        self.radius = radius
+        self.types = types
+        # extrusion and feed rate of the ironing moves, relative to the printed ones
+        self.E_proportion = E_proportion
+        self.S_proportion = S_proportion
+        self.travel_feedrate = travel_feedrate
+        self.retract_length = retract_length
+        self.retract_feedrate = retract_feedrate
+        # lift above the layer for every travel
+        self.z_hop = z_hop
+        self.z_feedrate = z_feedrate
+        self.min_length = min_length
+        # travel here at the end, e.g. the camera position
+        self.end_position = end_position
+
+    # ordered ironing paths of a layer, defect_positions: (N, 2) or (N, 3) printer frame positions
+    def paths(self, layerID, defect_positions, start = None):
+        defect_positions = np.asarray(defect_positions, dtype=np.float64)
+        if len(defect_positions) == 0:
+            return []
+        segments = layer_segments(self.layer_index, layerID, self.types)
+        seg, t0, t1 = clip_segments(segments, defect_positions[:, :2], self.radius)
+        paths = clipped_paths(segments, seg, t0, t1, self.min_length)
+        return order_paths(paths, start if start is not None else self.end_position)
+
+    # G-code lines of the ironing program, empty when no extrusion move is near a defect
+    def program(self, layerID, defect_positions, start = None):
+        paths = self.paths(layerID, defect_positions, start)
+        if not paths:
+            return []
+        rows = self.layer_index.layer_rows(layerID)
+        z = self.layer_index.z[rows][self.layer_index.flags[rows] == FLAG_POINT]
+        z = z[0] if len(z) > 0 else None
+        # retraction state left by the layer, restored at the end
+        retracted_start = retracted_at_end(self.layer_index, layerID)
+        lines = []
+        retracted = retracted_start
+        for points, es, fs in paths:
+            retracted = self.retract(lines, retracted, self.retract_length)
+            self.travel(lines, points[0], z)
+            retracted = self.retract(lines, retracted, 0.)
+            feedrate = None
+            for (x, y), e, f in zip(points[1:].tolist(), (es * self.E_proportion).tolist(),
+                                    (fs * self.S_proportion).tolist()):
+                if f != feedrate:
+                    lines.append("G1 F{:g}".format(f))
+                    feedrate = f
+                lines.append("G1 X{:.3f} Y{:.3f} E{:.5f}".format(x, y, e))
+        if self.end_position is not None:
+            retracted = self.retract(lines, retracted, max(self.retract_length, retracted_start))
+            self.travel(lines, self.end_position, z)
+        self.retract(lines, retracted, retracted_start)
+        return lines
+
+    # retract (or unretract) from `retracted` to `target` mm of filament, returns the new state
+    def retract(self, lines, retracted, target):
+        if abs(retracted - target) > 1e-9:
+            lines.append("G1 E{:.5f} F{}".format(retracted - target, self.retract_feedrate))
+        return target
+
+    # travel to (x, y) lifted by the Z hop, back down to the layer Z
+    def travel(self, lines, position, z):
+        if z is not None:
+            lines.append("G1 Z{:.3f} F{}".format(z + self.z_hop, self.z_feedrate))
+        lines.append("G1 X{:.3f} Y{:.3f} F{}".format(position[0], position[1], self.travel_feedrate))
+        if z is not None:
+            lines.append("G1 Z{:.3f} F{}".format(z, self.z_feedrate))
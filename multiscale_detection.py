@@ -0,0 +1,174 @@
+"""
+Multi-scale tiled defect detection for native resolution frames
+
+At the native resolution of the sensor (e.g. 3840x2160) undistorting,
+thresholding and labeling the whole part region costs about four times the
+1920x1080 pipeline. This file screens the region on a downsampled level
+instead: the frame is area-averaged by `scale`, undistorted with remap tables
+of the downsampled pixels, and thresholded a little more
+permissively than the final threshold, since averaging lightens small holes.
+Only the tiles holding dark spots inside the projected layer become
+candidates; they are grouped into connected regions which are undistorted and
+labeled at full resolution, in parallel threads (OpenCV releases the GIL).
+A defect is kept by the region whose tiles hold its centroid, so one spanning
+two tiles is reported once, exactly as the full resolution pipeline would.
+"""
+
+import numpy as np
+import cv2 as cv
+from concurrent.futures import ThreadPoolExecutor
+from defect_extraction import extract_defects
+from incremental_detection import merge_defects, region_pixels
+from calibration import scale_camera_matrix
+
+# remap tables of the image downsampled by `scale`, both camera matrices scaled to the downsampled pixels
+def downsampled_maps(detector, scale):
+    width, height = detector.img_shape
+    size = (width // scale, height // scale)
+    camera_matrix = scale_camera_matrix(detector.camera_matrix, 1. / scale, 1. / scale)
+    undistort_camera_matrix = scale_camera_matrix(detector.undistort_camera_matrix, 1. / scale, 1. / scale)
+    return cv.initUndistortRectifyMap(camera_matrix, detector.dist_coeffs, None, undistort_camera_matrix, size,
+                                      cv.CV_16SC2)
+
+
+class MultiscaleDetection:
+    """
+    Defect detection screening a downsampled level and refining candidate tiles at full resolution
+    """
+    def __init__(self, scale = 2, tile_size = 64, screen_margin = 20, screen_min_area = 1, min_area = 10,
+                 max_area = None, threads = None):
+        # tiles (full resolution pixels) must be larger than twice the largest defect
+        # screen_margin: added to the binary threshold on the downsampled level
+        # min_area, max_area: defect area bounds in full resolution pixels, max_area None takes the bound of
+        # the detector scaled to the capture resolution (DefectDetection.max_area)
+        self.scale = scale
+        self.tile_size = tile_size
+        self.screen_margin = screen_margin
+        self.screen_min_area = screen_min_area
+        self.min_area = min_area
+        self.max_area = max_area
+        self.pool = ThreadPoolExecutor(threads, thread_name_prefix="multiscale")
+        self.coarse_maps = None
+        # fraction of the region refined at full resolution for the last layer
+        self.last_refined_fraction = 0.
+
+    # coarse remap tables, computed on first use
+    def maps(self, detector):
+        if self.coarse_maps is None:
+            self.coarse_maps = downsampled_maps(detector, self.scale)
+        return self.coarse_maps
+
+    def area_bounds(self, detector):
+        return self.min_area, detector.max_area() if self.max_area is None else self.max_area
+
+    # defects of a full resolution layer image
+    # returns (defects, spans, defect_mask, roi, coarse_img, coarse_origin): defect_mask covers the region
+    # roi = (x0, y0, x1, y1) at full resolution, coarse_img is the downsampled crop (BGRA, mask as alpha) at
+    # coarse_origin in the full resolution frame; both images are None when their artifact is not saved
+    def detect(self, detector, img, layerID, binary_threshold = 90, with_spans = False, save_projection_img = True):
+        s = self.scale
+        detector.update_nozzle_pos(layerID)
+        layer_mask = detector.get_layer_mask(layerID)
+        roi = x0, y0, x1, y1 = detector.get_roi(layer_mask)
+        if img.shape[1::-1] != detector.img_shape:
+            img = cv.resize(img, detector.img_shape)
+
+        # screen: downsampled region, undistorted in gray and masked like defect_detection.project_contour
+        coarse_map1, coarse_map2 = self.maps(detector)
+        cx0, cy0 = x0 // s, y0 // s
+        cx1, cy1 = min(-(-x1 // s), coarse_map1.shape[1]), min(-(-y1 // s), coarse_map1.shape[0])
+        coarse_origin = (cx0 * s, cy0 * s)
+        small = cv.resize(img, (img.shape[1] // s, img.shape[0] // s), interpolation=cv.INTER_AREA)
+        coarse_map1, coarse_map2 = coarse_map1[cy0:cy1, cx0:cx1], coarse_map2[cy0:cy1, cx0:cx1]
+        # downsampled pixels entirely inside the layer, averaged pixels on the contour would look dark
+        coarse_mask = cv.resize(layer_mask.region(cx0 * s, cy0 * s, cx1 * s, cy1 * s), (cx1 - cx0, cy1 - cy0),
+                                interpolation=cv.INTER_AREA)
+        coarse_mask[coarse_mask < 255] = 0
+        gray = cv.remap(cv.cvtColor(small, cv.COLOR_BGR2GRAY), coarse_map1, coarse_map2, cv.INTER_LINEAR)
+        gray[coarse_mask == 0] = 255
+        ret, dark = cv.threshold(gray, binary_threshold + self.screen_margin, 255, cv.THRESH_BINARY_INV)
+        if self.screen_min_area > 1:
+            num, labels, stats, _ = cv.connectedComponentsWithStats(dark, 8, cv.CV_32S)
+            small_spots = np.flatnonzero(stats[:, cv.CC_STAT_AREA] < self.screen_min_area)
+            dark[np.isin(labels, small_spots)] = 0
+
+        # debug images of the downsampled level only
+        coarse_img = None
+        if (save_projection_img and detector.save_enabled("contour")) or detector.save_enabled("crop"):
+            coarse = cv.remap(small, coarse_map1, coarse_map2, cv.INTER_LINEAR)
+            if save_projection_img and detector.save_enabled("contour"):
+                polylines = [np.int32(np.round((points - np.float32(coarse_origin)) / s))
+                             for points in layer_mask.polylines]
+                img_contour = cv.polylines(coarse.copy(), polylines, True, (255, 0, 0), 1)
+                detector.save_image("contour", "layer_{}_w_contour".format(layerID), img_contour, layerID,
+                                    coarse_origin)
+            if detector.save_enabled("crop"):
+                coarse[coarse_mask == 0] = 255
+                b, g, r = cv.split(coarse)
+                coarse_img = cv.merge([b, g, r, coarse_mask])
+
+        # candidate tiles of the full resolution region, grown by one tile so every defect touching them is inside
+        width, height = x1 - x0, y1 - y0
+        t = self.tile_size
+        tiles_y, tiles_x = -(-height // t), -(-width // t)
+        ys, xs = np.nonzero(dark)
+        active = np.zeros((tiles_y, tiles_x), dtype=np.uint8)
+        tx = np.clip(((xs + cx0) * s + s // 2 - x0) // t, 0, tiles_x - 1)
+        ty = np.clip(((ys + cy0) * s + s // 2 - y0) // t, 0, tiles_y - 1)
+        active[ty, tx] = 1
+        grown = cv.dilate(active, np.ones((3, 3), dtype=np.uint8))
+        self.last_refined_fraction = float(grown.mean())
+        num_region, region_tiles, stats, _ = cv.connectedComponentsWithStats(grown, 8, cv.CV_32S)
+
+        # refine the regions at full resolution in parallel
+        min_area, max_area = self.area_bounds(detector)
+        boxes = []
+        for region in range(1, num_region):
+            tx, ty, tw, th = stats[region, :4]
+            # pixel box of the tiles, padded by half a tile for defects reaching out of them
+            bx0, by0 = max(tx * t - t // 2, 0), max(ty * t - t // 2, 0)
+            bx1, by1 = min((tx + tw) * t + t // 2, width), min((ty + th) * t + t // 2, height)
+            boxes.append((region, x0 + bx0, y0 + by0, x0 + bx1, y0 + by1))
+        results = self.pool.map(lambda box: self._refine(detector, img, layer_mask, roi, box, region_tiles,
+                                                         binary_threshold, min_area, max_area, with_spans), boxes)
+
+        # the full resolution defect mask is only built to be saved
+        parts = []
+        defect_mask = np.zeros((height, width), dtype=np.uint8) if detector.save_enabled("defect") else None
+        for (region, bx0, by0, bx1, by1), (defects, spans, box_mask) in zip(boxes, results):
+            parts.append((defects, spans))
+            if defect_mask is not None:
+                cv.bitwise_or(defect_mask[by0 - y0:by1 - y0, bx0 - x0:bx1 - x0], box_mask,
+                              dst=defect_mask[by0 - y0:by1 - y0, bx0 - x0:bx1 - x0])
+        defects, spans = merge_defects(parts, with_spans)
+        return defects, spans, defect_mask, roi, coarse_img, coarse_origin
+
+    # undistort, mask and label one box (x0, y0, x1, y1 in the frame), keeping the defects centred in its region
+    def _refine(self, detector, img, layer_mask, roi, box, region_tiles, binary_threshold, min_area, max_area,
+                with_spans):
+        region, bx0, by0, bx1, by1 = box
+        undistorted = cv.remap(img, detector.undistort_map1[by0:by1, bx0:bx1],
+                               detector.undistort_map2[by0:by1, bx0:bx1], cv.INTER_LINEAR)
+        mask = layer_mask.region(bx0, by0, bx1, by1)
+        dst = cv.bitwise_and(undistorted, undistorted, mask=mask)
+        dst[mask == 0] = 255
+        ret, binary = cv.threshold(detector.preprocess(dst), binary_threshold, 255, cv.THRESH_BINARY_INV)
+        defects, spans, box_mask = extract_defects(binary, min_area, max_area, (bx0, by0), with_spans)
+
+        x0, y0 = roi[:2]
+        tx = np.floor((defects["cx"] - x0) / self.tile_size).astype(np.int64)
+        ty = np.floor((defects["cy"] - y0) / self.tile_size).astype(np.int64)
+        inside = (tx >= 0) & (ty >= 0) & (tx < region_tiles.shape[1]) & (ty < region_tiles.shape[0])
+        keep = np.zeros(len(defects), dtype=bool)
+        keep[inside] = region_tiles[ty[inside], tx[inside]] == region
+        if spans is not None:
+            spans = spans[np.isin(spans["label"], defects["label"][keep])]
+        # defect pixels of this region's tiles only
+        if detector.save_enabled("defect"):
+            in_region = region_pixels(region_tiles, self.tile_size, (bx0 - x0, by0 - y0, bx1 - x0, by1 - y0),
+                                      region)
+            box_mask[in_region == 0] = 0
+        return defects[keep], spans, box_mask
+
+    def shutdown(self):
+        self.pool.shutdown()
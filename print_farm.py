@@ -0,0 +1,330 @@
+"""
+Multi-printer farm runner
+
+This file runs the closed-loop printing job on several printers from one
+process. Every printer has its own G-code sender, camera, layer store and
+job configuration, and is driven by its own PrintOrchestrator thread. The
+defect detection of all printers is sent to one shared set of worker
+processes sized to the cores. Every printer is pinned to one worker, which
+builds its detector on first use and keeps it, so detector state carried
+from layer to layer (incremental detection) stays in one process. The worker
+writes its debug images in the background until the pool shuts
+down. Per printer, the layer throughput and the time detection requests
+wait in the pool queue are reported at the end.
+
+Example:
+    python print_farm.py farm.json
+
+farm.json lists the printers; every key not given falls back to the value
+of the same name in settings.py, with the printer name added
+to the image folder, log file and telemetry names:
+    {
+        "processes": null,
+        "report": "./logs/farm_report.json",
+        "printers": [
+            {"name": "mk3s_1", "printer_port": "COM3", "camera_id": 1,
+             "img_dir_path": "./images/mk3s_1/", "log_file_name": "mk3s_1.txt"},
+            {"name": "mk3s_2", "printer_port": "COM4", "camera_id": 2,
+             "img_dir_path": "./images/mk3s_2/", "log_file_name": "mk3s_2.txt"}
+        ]
+    }
+"""
+
+import os
+import sys
+import json
+import time
+import threading
+import multiprocessing.util
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+
+from calibration import load_calibration
+from camera_control import CameraControl
+from gcode_sender import GcodeSender
+from layer_parsing_separate import split_layers
+from layer_store import LayerStore
+from localized_ironing import LocalizedIroning
+from print_orchestrator import PrintOrchestrator
+from run_telemetry import RunTelemetry
+from image_writer import AsyncImageWriter
+import settings
+
+# job settings of a printer, defaults taken from settings.py
+JOB_KEYS = ("printer_port", "camera_id", "gcode_path", "gcode_noTri_path", "img_dir_path", "log_dir_path",
+            "log_file_name", "telemetry_name", "object_marker", "wipe_marker", "layer_height", "delay_time",
+            "motion_barrier", "settle_time", "confirm_camera_pose", "enable_correction", "fixing_E_proportion",
+            "fixing_S_proportion", "correction_radius", "total_layer", "img_taken_position", "defect_threshold",
+            "binary_threshold", "save_artifacts", "jpeg_quality", "png_compression", "roi_detection",
+            "incremental_detection", "capture_resolution", "multiscale_detection", "calibration_path")
+
+# detectors living in each worker process, keyed by printer name
+_worker_detectors = {}
+
+
+def job_config(overrides, defaults = settings):
+    unknown = set(overrides) - set(JOB_KEYS) - {"name"}
+    if unknown:
+        raise ValueError("Unknown job settings: {}".format(", ".join(sorted(unknown))))
+    job = {key: getattr(defaults, key) for key in JOB_KEYS}
+    # outputs of a printer get its name unless set explicitly
+    name = overrides.get("name", "printer")
+    job["img_dir_path"] = os.path.join(job["img_dir_path"], name) + "/"
+    job["log_file_name"] = "{}_{}".format(name, job["log_file_name"])
+    job["telemetry_name"] = "{}_{}".format(name, job["telemetry_name"])
+    job.update(overrides)
+    return job
+
+
+def _worker_detector(key, spec):
+    detector = _worker_detectors.get(key)
+    if detector is None:
+        from defect_detection import DefectDetection
+        detector_args, detector_kwargs, writer_kwargs = spec
+        detector = DefectDetection(*detector_args, **detector_kwargs)
+        detector.set_image_writer(AsyncImageWriter(**writer_kwargs))
+        if not _worker_detectors:
+            multiprocessing.util.Finalize(None, _close_worker_writers, exitpriority=10)
+        _worker_detectors[key] = detector
+    return detector
+
+
+# debug images are written in the background and only waited for when the worker process exits
+def _close_worker_writers():
+    for detector in _worker_detectors.values():
+        detector.image_writer.close()
+
+
+def _detect(key, spec, img, layerID, type, binary_threshold):
+    start = time.time()
+    detector = _worker_detector(key, spec)
+    positions = detector.get_defect_positions(img, layerID, type, binary_threshold)
+    return positions, detector.last_defects, detector.last_spans, start, time.time()
+
+
+class DetectionPool:
+    """
+    Worker processes shared by the detections of all printers, each printer pinned to one worker
+    """
+    def __init__(self, processes = None):
+        self.processes = os.cpu_count() if processes is None else processes
+        # one single-process executor per worker; a printer waits for each detection before the next,
+        # so pinning costs no parallelism while there are at least as many workers as printers
+        self.executors = [ProcessPoolExecutor(1) for _ in range(self.processes)]
+        self.workers = {}
+        self.lock = threading.Lock()
+
+    # worker of a printer, assigned round robin on first use
+    def worker(self, key):
+        with self.lock:
+            if key not in self.workers:
+                self.workers[key] = len(self.workers) % self.processes
+            return self.workers[key]
+
+    def submit(self, key, spec, img, layerID, type = 1, binary_threshold = 90):
+        return self.executors[self.worker(key)].submit(_detect, key, spec, img, layerID, type, binary_threshold)
+
+    def shutdown(self, wait = True):
+        for executor in self.executors:
+            executor.shutdown(wait=wait, cancel_futures=not wait)
+
+
+class PooledDetector:
+    """
+    Detector of one printer running its detections in a shared DetectionPool
+    """
+    def __init__(self, pool, key, detector_args, detector_kwargs, writer_kwargs = None):
+        self.pool = pool
+        self.key = key
+        self.spec = (detector_args, detector_kwargs, {} if writer_kwargs is None else writer_kwargs)
+        self.last_defects = None
+        self.last_spans = None
+        # seconds between submitting a request and a worker picking it up, and worker time per request
+        self.queue_waits = []
+        self.service_times = []
+
+    def get_defect_positions(self, img, layerID, type = 1, binary_threshold = 90):
+        submit_time = time.time()
+        future = self.pool.submit(self.key, self.spec, img, layerID, type, binary_threshold)
+        positions, self.last_defects, self.last_spans, start, end = future.result()
+        self.queue_waits.append(max(start - submit_time, 0.))
+        self.service_times.append(end - start)
+        return positions
+
+
+def _stats(samples):
+    if len(samples) == 0:
+        return {"mean_s": 0., "p90_s": 0., "max_s": 0.}
+    samples = np.asarray(samples)
+    return {"mean_s": float(samples.mean()), "p90_s": float(np.percentile(samples, 90)),
+            "max_s": float(samples.max())}
+
+
+class FarmPrinter:
+    """
+    Class for running the job of one printer of the farm
+    """
+    def __init__(self, name, job, pool):
+        self.name = name
+        self.job = job
+        self.pool = pool
+        self.detector = None
+        self.orchestrator = None
+        self.start_time = None
+        self.end_time = None
+        self.error = None
+
+    def log_header(self, log_path):
+        job = self.job
+        with open(log_path, 'a') as f:
+            f.write("Printer: {} on {}\n".format(self.name, job["printer_port"]))
+            f.write("Gcode path: {}\n".format(job["gcode_path"]))
+            f.write("Calibration path: {}\n".format(job["calibration_path"]))
+            f.write("Image folder path: {}\n".format(job["img_dir_path"]))
+            f.write("Picture taking position: {}\n".format(job["img_taken_position"]))
+            f.write("Total layer: {}\n".format(job["total_layer"]))
+            f.write("Defect binary threshold: {}\n".format(job["binary_threshold"]))
+            f.write("Defect number threshold: {}\n".format(job["defect_threshold"]))
+            f.write("Correction enabled: {}\n".format(job["enable_correction"]))
+            f.write("---------------------------------------------------------\n")
+
+    def run(self):
+        job = self.job
+        log_path = job["log_dir_path"] + job["log_file_name"]
+        os.makedirs(job["img_dir_path"], exist_ok=True)
+        self.log_header(log_path)
+
+        layer_store = LayerStore()
+        split_layers(job["gcode_path"], layer_store, job["object_marker"], job["wipe_marker"],
+                     job["img_taken_position"])
+        calibration = load_calibration(job["calibration_path"], img_shape=job["capture_resolution"])
+        detector_args = (calibration.camera_matrix, calibration.dist_coeffs, calibration.T_nozzle_cam,
+                         job["gcode_noTri_path"], job["img_dir_path"], job["img_taken_position"])
+        detector_kwargs = {"layer_height": job["layer_height"], "roi_mode": job["roi_detection"],
+                           "incremental": job["incremental_detection"], "multiscale": job["multiscale_detection"],
+                           "calibration": calibration}
+        writer_kwargs = {"enabled": job["save_artifacts"], "jpeg_quality": job["jpeg_quality"],
+                         "png_compression": job["png_compression"]}
+        self.detector = PooledDetector(self.pool, self.name, detector_args, detector_kwargs, writer_kwargs)
+
+        local_ironing = None
+        if job["enable_correction"] and job["correction_radius"] is not None:
+            local_ironing = LocalizedIroning(job["gcode_path"], job["correction_radius"],
+                                             E_proportion=job["fixing_E_proportion"],
+                                             S_proportion=job["fixing_S_proportion"],
+                                             end_position=job["img_taken_position"])
+
+        camera = CameraControl(job["camera_id"], job["capture_resolution"])
+        gcode_sender = GcodeSender(job["printer_port"])
+        print("[{}] connected".format(self.name))
+        image_writer = AsyncImageWriter(**writer_kwargs)
+        telemetry_path = job["log_dir_path"] + job["telemetry_name"]
+        telemetry = RunTelemetry(telemetry_path + ".jsonl", telemetry_path + ".csv", telemetry_path + "_summary.json")
+        try:
+            self.start_time = time.time()
+            gcode_sender.send_lines(layer_store.get("layer_0"))
+            self.orchestrator = PrintOrchestrator(gcode_sender, camera, self.detector, layer_store,
+                                                  job["img_dir_path"], log_path,
+                                                  defect_threshold=job["defect_threshold"],
+                                                  binary_threshold=job["binary_threshold"],
+                                                  delay_time=job["delay_time"],
+                                                  motion_barrier=job["motion_barrier"],
+                                                  settle_time=job["settle_time"],
+                                                  camera_position=(job["img_taken_position"]
+                                                                   if job["confirm_camera_pose"] else None),
+                                                  enable_correction=job["enable_correction"],
+                                                  fixing_E_proportion=job["fixing_E_proportion"],
+                                                  fixing_S_proportion=job["fixing_S_proportion"],
+                                                  telemetry=telemetry, image_writer=image_writer,
+                                                  local_ironing=local_ironing)
+            self.orchestrator.run(1, job["total_layer"])
+            gcode_sender.send_lines(layer_store.get("end"))
+            self.orchestrator.finish()
+        finally:
+            self.end_time = time.time()
+            camera.turn_off_cam()
+            gcode_sender.disconnect()
+            image_writer.close()
+
+    def report(self):
+        layers = 0 if self.orchestrator is None else len(self.orchestrator.results)
+        wall = 0. if self.start_time is None else (self.end_time or time.time()) - self.start_time
+        report = {
+            "printer": self.name,
+            "layers": layers,
+            "fixed_layers": 0 if self.orchestrator is None else len(self.orchestrator.fixed_layer_list),
+            "wall_s": wall,
+            "layers_per_hour": layers / wall * 3600. if wall > 0 else 0.,
+            "error": None if self.error is None else repr(self.error),
+        }
+        if self.detector is not None:
+            report["queue_wait"] = _stats(self.detector.queue_waits)
+            report["detect"] = _stats(self.detector.service_times)
+        return report
+
+
+class PrintFarm:
+    """
+    Class for running the jobs of several printers with one shared detection pool
+    """
+    def __init__(self, jobs, processes = None):
+        # jobs: {printer name: job settings}, see job_config
+        self.pool = DetectionPool(processes)
+        self.printers = [FarmPrinter(name, job, self.pool) for name, job in jobs.items()]
+
+    def _run_printer(self, printer):
+        try:
+            printer.run()
+        except Exception as err:
+            printer.error = err
+            print("[{}] stopped: {!r}".format(printer.name, err))
+
+    def run(self):
+        threads = [threading.Thread(target=self._run_printer, args=(printer,), name=printer.name)
+                   for printer in self.printers]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.pool.shutdown()
+        return self.report()
+
+    def report(self):
+        printers = [printer.report() for printer in self.printers]
+        waits = [w for printer in self.printers if printer.detector is not None for w in printer.detector.queue_waits]
+        return {"processes": self.pool.processes, "printers": printers,
+                "layers": sum(p["layers"] for p in printers), "queue_wait": _stats(waits)}
+
+
+def print_report(report):
+    print("{:<16}{:>8}{:>8}{:>12}{:>14}{:>14}{:>14}".format(
+        "printer", "layers", "fixed", "layers/h", "wait mean s", "wait max s", "detect mean s"))
+    for p in report["printers"]:
+        wait = p.get("queue_wait", _stats([]))
+        detect = p.get("detect", _stats([]))
+        print("{:<16}{:>8}{:>8}{:>12.1f}{:>14.3f}{:>14.3f}{:>14.3f}".format(
+            p["printer"], p["layers"], p["fixed_layers"], p["layers_per_hour"],
+            wait["mean_s"], wait["max_s"], detect["mean_s"]))
+    print("{} detection processes, queue wait mean {:.3f} s, p90 {:.3f} s".format(
+        report["processes"], report["queue_wait"]["mean_s"], report["queue_wait"]["p90_s"]))
+
+
+# the main guard keeps worker processes of the detection pool from rerunning the farm
+if __name__ == "__main__":
+    with open(sys.argv[1], "r") as f:
+        farm = json.load(f)
+    jobs = {}
+    for index, printer in enumerate(farm["printers"]):
+        name = printer.get("name")
+        if name is None:
+            raise ValueError("Printer entry {} of {} has no name".format(index, sys.argv[1]))
+        if name in jobs:
+            raise ValueError("Printer name {} is used twice in {}".format(name, sys.argv[1]))
+        job = job_config(printer)
+        job.pop("name")
+        jobs[name] = job
+    report = PrintFarm(jobs, farm.get("processes")).run()
+    print_report(report)
+    if farm.get("report") is not None:
+        with open(farm["report"], "w") as f:
+            json.dump(report, f, indent=2)
@@ -0,0 +1,281 @@
+"""
+Pipelined print / capture / detect / correct loop
+
+This file runs the closed-loop printing job layer by layer. The stages of
+one layer form a small dependency graph:
+
+    print layer -> settle -> capture +-> detect ----------+-> decide -> (correct -> settle -> capture -> wipe)
+                                     +-> print wipe ------+
+    (prepare correction G-code, started together with the layer print)
+
+The wiping pattern does not depend on the detection result, so it is printed
+while the image is analysed in a worker thread, and the ironing G-code of the
+layer is generated speculatively while the layer prints, from its ironing
+template kept in the layer store or a background precompute of all layers
+(see gcode_ironing.IroningPrecompute).
+With localized ironing (see localized_ironing.py) the correction depends on
+the defect positions, so it is generated after detection instead.
+
+With a live monitor (see live_monitor.py) the layer is also checked while it
+prints; regions it flags count as defects of the layer in the decision taken
+after it. With a run state (see
+run_state.py) every completed stage is checkpointed, and a resumed layer
+skips the stages already done.
+"""
+
+import time
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from run_telemetry import RunTelemetry
+from image_writer import AsyncImageWriter
+
+
+class PrintOrchestrator:
+    """
+    Class for running the closed-loop printing job
+    """
+    def __init__(self, gcode_sender, camera, defect_detector, layer_store, img_dir_path, log_path,
+                 defect_threshold = 2, binary_threshold = 85, delay_time = 3, motion_barrier = True,
+                 settle_time = 0., camera_position = None, position_tolerance = 0.05, enable_correction = True,
+                 fixing_E_proportion = 0.2, fixing_S_proportion = 0.6, ironing_layers = None,
+                 telemetry = None, image_writer = None, local_ironing = None, monitor = None,
+                 run_state = None, archive = None):
+        self.gcode_sender = gcode_sender
+        self.camera = camera
+        self.defect_detector = defect_detector
+        self.layer_store = layer_store
+        self.img_dir_path = img_dir_path
+        self.log_path = log_path
+
+        self.defect_threshold = defect_threshold
+        self.binary_threshold = binary_threshold
+        # settle before a capture: wait for the moves to finish (M400) and settle_time more, or sleep
+        # delay_time without the motion barrier; camera_position: (x, y) checked with M114 after the barrier
+        self.delay_time = delay_time
+        self.motion_barrier = motion_barrier
+        self.settle_time = settle_time
+        self.camera_position = camera_position
+        self.position_tolerance = position_tolerance
+        self.enable_correction = enable_correction
+        self.fixing_E_proportion = fixing_E_proportion
+        self.fixing_S_proportion = fixing_S_proportion
+        # precomputed ironing layers, anything with a get(layerID) method (see gcode_ironing.py)
+        self.ironing_layers = ironing_layers
+        # iron only around the defects instead of the whole layer, anything with a
+        # program(layerID, defect_positions) method (see localized_ironing.py)
+        self.local_ironing = local_ironing
+        # checks the layer in the camera feed while it prints, anything with start_layer(layerID, segment),
+        # end_layer() and report() methods (see live_monitor.py)
+        self.monitor = monitor
+        # progress checkpointed after every stage, for resuming the job (see run_state.py)
+        self.run_state = run_state
+        # image archive of the run, gets the defect statistics of every layer (see run_archive.py)
+        self.archive = archive
+        # per-layer stage timings, kept in memory only unless a configured RunTelemetry is given
+        self.telemetry = RunTelemetry() if telemetry is None else telemetry
+        # frames are handed to the detector in memory and written to disk in the background
+        self.image_writer = AsyncImageWriter() if image_writer is None else image_writer
+
+        self.executor = ThreadPoolExecutor(max_workers=2)
+        self.fixed_layer_list = []
+        self.results = []
+
+    def log(self, line):
+        with open(self.log_path, 'a') as f:
+            f.write(line + '\n')
+
+    # stage: print a G-code segment
+    def print_segment(self, gcode_lines, layerID, stage = "print"):
+        with self.telemetry.stage(layerID, stage):
+            segment = self.gcode_sender.send_lines(gcode_lines)
+        self.segment_sent(segment, gcode_lines)
+
+    # a stage only counts as done, and is checkpointed, once every line of it was acknowledged
+    def segment_sent(self, segment, gcode_lines):
+        if segment is not None and segment.acked_lines() < len(segment.lines):
+            raise ConnectionError("Only {} of {} lines acknowledged".format(segment.acked_lines(), 
+                                                                            len(segment.lines)))
+        if self.run_state is not None:
+            self.run_state.advance_extruder(gcode_lines)
+
+    # stage: print a layer under the live monitor, returns the suspect positions it flagged
+    def print_monitored(self, gcode_lines, layerID):
+        with self.telemetry.stage(layerID, "print"):
+            segment = self.gcode_sender.enqueue(gcode_lines)
+            self.monitor.start_layer(layerID, segment)
+            try:
+                segment.wait()
+            finally:
+                suspects = self.monitor.end_layer()
+        self.telemetry.record_monitor(layerID, self.monitor.report())
+        self.segment_sent(segment, gcode_lines)
+        return suspects
+
+    # wait until the head is parked at the camera, then for the rest of the settle budget
+    def settle(self, layerID, stage):
+        if not self.motion_barrier:
+            time.sleep(self.delay_time)
+            return
+        start = time.perf_counter()
+        self.gcode_sender.wait_motion_complete()
+        position = None
+        if self.camera_position is not None:
+            position = self.gcode_sender.get_position()
+            if position is None:
+                print("layer {}: no position report from the printer".format(layerID))
+            elif max(abs(position.get("X", 0.) - self.camera_position[0]),
+                     abs(position.get("Y", 0.) - self.camera_position[1])) > self.position_tolerance:
+                print("layer {}: head at ({}, {}) instead of the camera position {}".format(
+                    layerID, position.get("X"), position.get("Y"), list(self.camera_position)))
+        motion_time = time.perf_counter() - start
+        time.sleep(self.settle_time)
+        self.telemetry.record_settle(layerID, stage, motion_time, self.settle_time, position)
+
+    # stages: wait for the printer to settle, take a picture, queue it for saving
+    def capture(self, artifact, file_name, layerID, prefix = ""):
+        with self.telemetry.stage(layerID, prefix + "settle"):
+            self.settle(layerID, prefix + "settle")
+        with self.telemetry.stage(layerID, prefix + "capture"):
+            img = self.camera.take_stable_pic()
+        with self.telemetry.stage(layerID, prefix + "encode"):
+            self.image_writer.save(artifact, self.img_dir_path + file_name, img, layerID,
+                                   correction = prefix == "correction_")
+        return img
+
+    # stage: detect defects of a layer image
+    def detect(self, img, layerID):
+        with self.telemetry.stage(layerID, "detect"):
+            return self.defect_detector.get_defect_positions(img, layerID, type=1,
+                                                             binary_threshold=self.binary_threshold)
+
+    # stage: generate the ironing G-code of a layer, around the given defects with localized ironing
+    def prepare_correction(self, layerID, defect_positions = None):
+        with self.telemetry.stage(layerID, "prepare_correction"):
+            if self.local_ironing is not None:
+                return self.local_ironing.program(layerID, defect_positions)
+            if self.ironing_layers is not None:
+                cor_gcode = self.ironing_layers.get(layerID)
+                if cor_gcode is not None:
+                    return cor_gcode
+            template = self.layer_store.ironing_template("layer_{}".format(layerID))
+            return template.emit(E_proportion = self.fixing_E_proportion, S_proportion = self.fixing_S_proportion)
+
+    def run_layer(self, layerID):
+        layer_gcode = self.layer_store.get("layer_{}".format(layerID))
+        z_gcode = self.layer_store.get("layer_{}".format(layerID), kind="wipe")
+
+        self.telemetry.start_layer(layerID)
+        try:
+            return self._run_layer(layerID, layer_gcode, z_gcode)
+        finally:
+            self.telemetry.end_layer(layerID)
+
+    def _run_layer(self, layerID, layer_gcode, z_gcode):
+        # stages of the layer done before the job was resumed
+        done = set() if self.run_state is None else self.run_state.stages(layerID)
+
+        # Print the current layer and take picture, correction G-code is prepared meanwhile
+        cor_future = None
+        if self.enable_correction and self.local_ironing is None and "correction" not in done:
+            cor_future = self.executor.submit(self.prepare_correction, layerID)
+        suspects = np.zeros((0, 3))
+        if "print" in done:
+            print("layer {} already printed".format(layerID))
+        else:
+            print("Printing layer {}...".format(layerID))
+            if self.monitor is not None:
+                suspects = self.print_monitored(layer_gcode, layerID)
+            else:
+                self.print_segment(layer_gcode, layerID)
+            print("finished printing layer {}".format(layerID))
+            self.checkpoint(layerID, "print", suspects = suspects.tolist())
+
+        if "wipe" in done:
+            # detection result recorded before the job was resumed
+            record = self.run_state.layer(layerID)
+            coord_list = np.reshape(record["defect_positions"], (-1, 3))
+            suspects = np.reshape(record.get("suspects", []), (-1, 3))
+            fixed = record["fixed"]
+            defects = None
+        else:
+            if "print" in done:
+                suspects = np.reshape(self.run_state.layer(layerID).get("suspects", []), (-1, 3))
+            print("start taking picture")
+            img = self.capture("frame", 'layer_{}'.format(layerID), layerID)
+
+            # Detect defects while the Z supplement is printed
+            detect_future = self.executor.submit(self.detect, img, layerID)
+            self.print_segment(z_gcode, layerID, "wipe")
+            coord_list = detect_future.result()
+            fixed = max(len(coord_list), len(suspects)) >= self.defect_threshold
+            defects = self.defect_detector.last_defects
+            self.checkpoint(layerID, "wipe", defect_positions = np.reshape(coord_list, (-1, 3)).tolist(),
+                            num_defect = len(coord_list), num_suspect = len(suspects), fixed = fixed)
+        print("layer {} defect: {}".format(layerID, len(coord_list)))
+        line = "layer {}, num of defect: {}".format(layerID, len(coord_list))
+        if self.monitor is not None:
+            line += ", suspect while printing: {}".format(len(suspects))
+
+        self.results.append({"layer": layerID, "num_defect": len(coord_list), "num_suspect": len(suspects),
+                             "fixed": fixed})
+        self.telemetry.record_defects(layerID, len(coord_list), fixed, defects)
+        if self.archive is not None:
+            self.archive.record_detection(layerID, len(coord_list), fixed, defects, self.binary_threshold)
+        if not fixed:
+            self.log(line)
+            return coord_list
+
+        # Start ironing if the number of defect exceeds the threshold
+        print("start fixing")
+        self.fixed_layer_list.append(layerID)
+        self.log(line + ' FIXED')
+        if self.enable_correction and "correction" not in done:
+            if cor_future is None:
+                positions = coord_list
+                if len(suspects):
+                    positions = np.concatenate([np.reshape(coord_list, (-1, 3)), suspects])
+                cor_gcode = self.prepare_correction(layerID, positions)
+            else:
+                cor_gcode = cor_future.result()
+            if not cor_gcode:
+                print("nothing to iron near the defects of layer {}".format(layerID))
+                return coord_list
+            print("Fixing layer {}...".format(layerID))
+            self.print_segment(cor_gcode, layerID, "correction")
+            print("finished fixing layer {}".format(layerID))
+            self.checkpoint(layerID, "correction")
+            print("start taking correction picture")
+            self.capture("corrected", 'layer_{}_corrected'.format(layerID), layerID, "correction_")
+        if self.enable_correction and "correction_wipe" not in done:
+            # print the Z supplement
+            self.print_segment(z_gcode, layerID, "correction_wipe")
+            self.checkpoint(layerID, "correction_wipe")
+        return coord_list
+
+    # record a completed stage in the run state (see run_state.py)
+    def checkpoint(self, layerID, stage, **values):
+        if self.run_state is not None:
+            self.run_state.stage_done(layerID, stage, **values)
+
+    # continue a job from its run state: finished layers are taken over, not repeated
+    def resume(self, run_state):
+        self.run_state = run_state
+        resume_layer = run_state.resume_layer()
+        # the first unfinished layer appends its own result again
+        self.results = [result for result in run_state.results() if result["layer"] < resume_layer]
+        self.fixed_layer_list = [result["layer"] for result in self.results if result["fixed"]]
+        return resume_layer
+
+    def run(self, first_layer, last_layer):
+        for i in range(first_layer, last_layer + 1):
+            self.run_layer(i)
+            if self.run_state is not None:
+                self.run_state.layer_done(i)
+
+    def finish(self):
+        self.executor.shutdown()
+        self.image_writer.flush()
+        self.telemetry.write_summary()
+        self.log("TOTAL NUM OF FIXED LAYER: {}".format(len(self.fixed_layer_list)))
+        with open(self.log_path, 'a') as f:
+            f.write("Fixed layer list: {}".format(self.fixed_layer_list))
@@ -0,0 +1,272 @@
+"""
+Memory-mapped run image archive
+
+This file stores the images of a run (layer frames, corrected frames,
+contour overlays, crops and defect masks) in a few large chunk files instead
+of one encoded file per image. Images are appended raw to chunk files of
+bounded size and described by a structured index: layer, pass (print or
+correction), artifact, capture time, shape, position of the crop in the
+frame, and the defect statistics and threshold of the layer. The reader
+memory-maps the chunks, so any layer range is sliced without decoding
+or reading the rest, and an exporter writes the images back as the usual
+layer_N*.jpg/png files. The offline tools (defect_threshold_sweep.py,
+simulation.RunReplay) read the frames of an archived run directly.
+
+Example:
+    python run_archive.py info ./images/elp_0301_0/archive
+    python run_archive.py export ./images/elp_0301_0/archive ./export/ --layers 10:20 --artifacts frame,defect
+"""
+
+import os
+import json
+import time
+import argparse
+import threading
+import numpy as np
+import cv2 as cv
+from image_writer import DEFAULT_FORMATS
+
+ARCHIVE_VERSION = 1
+
+# artifact codes of the index, and file names of the exported images
+ARTIFACTS = ("frame", "corrected", "contour", "crop", "defect")
+ARTIFACT_NAMES = {
+    "frame": "layer_{}",
+    "corrected": "layer_{}_corrected",
+    "contour": "layer_{}_w_contour",
+    "crop": "layer_{}_crop",
+    "defect": "layer_{}_defect",
+}
+
+# one row per image; num_defect is -1 for passes that were not analysed
+INDEX_DTYPE = np.dtype([("layer", np.int32), ("correction", np.bool_), ("artifact", np.uint8),
+                        ("time", np.float64), ("chunk", np.int32), ("offset", np.int64), ("height", np.int32),
+                        ("width", np.int32), ("channels", np.uint8), ("x0", np.int32), ("y0", np.int32),
+                        ("num_defect", np.int32), ("total_defect_area", np.int64), ("max_defect_area", np.int32),
+                        ("fixed", np.bool_), ("binary_threshold", np.int16)])
+
+
+def chunk_path(archive_dir, chunk):
+    return os.path.join(archive_dir, "chunk_{:05d}.bin".format(chunk))
+
+
+# archive of an image folder: the folder itself or its archive subfolder, None if it has none
+def find_archive(img_dir_path):
+    for archive_dir in (img_dir_path, os.path.join(img_dir_path, "archive")):
+        if os.path.exists(os.path.join(archive_dir, "meta.json")):
+            return archive_dir
+    return None
+
+
+class RunArchive:
+    """
+    Writer appending the images of a run to an archive directory
+    """
+    def __init__(self, archive_dir, chunk_bytes = 256 << 20, params = None, flush_every = 16):
+        # params: run parameters kept in meta.json (thresholds, G-code paths, ...)
+        # flush_every: rows between index rewrites, the index is also written on flush and close
+        self.archive_dir = archive_dir
+        self.chunk_bytes = chunk_bytes
+        self.flush_every = flush_every
+        self.lock = threading.Lock()
+        os.makedirs(archive_dir, exist_ok=True)
+
+        # continue an existing archive (resumed run)
+        index_path = os.path.join(archive_dir, "index.npy")
+        self.rows = []
+        if os.path.exists(index_path):
+            self.rows = [np.array(row, dtype=INDEX_DTYPE) for row in np.load(index_path)]
+        self.chunk = int(max((row["chunk"] for row in self.rows), default=0))
+        path = chunk_path(archive_dir, self.chunk)
+        self.chunk_size = os.path.getsize(path) if os.path.exists(path) else 0
+        self.unflushed = 0
+        # defect statistics of (layer, correction) passes, applied to their later images too
+        self.stats = {}
+
+        meta_path = os.path.join(archive_dir, "meta.json")
+        if not os.path.exists(meta_path):
+            meta = {"version": ARCHIVE_VERSION, "created": time.time(), "params": params or {}}
+            with open(meta_path, "w") as f:
+                json.dump(meta, f, indent=1)
+
+    # append an image, origin: position (x0, y0) of the image in the frame (crops)
+    def append(self, artifact, layerID, img, correction = False, capture_time = None, origin = (0, 0)):
+        img = np.ascontiguousarray(img, dtype=np.uint8)
+        height, width = img.shape[:2]
+        channels = 1 if img.ndim == 2 else img.shape[2]
+        with self.lock:
+            if self.chunk_size > 0 and self.chunk_size + img.nbytes > self.chunk_bytes:
+                self.chunk += 1
+                self.chunk_size = 0
+            with open(chunk_path(self.archive_dir, self.chunk), "ab") as f:
+                f.write(img.data)
+            row = np.zeros((), dtype=INDEX_DTYPE)
+            row["layer"] = layerID
+            row["correction"] = correction
+            row["artifact"] = ARTIFACTS.index(artifact)
+            row["time"] = time.time() if capture_time is None else capture_time
+            row["chunk"] = self.chunk
+            row["offset"] = self.chunk_size
+            row["height"], row["width"], row["channels"] = height, width, channels
+            row["x0"], row["y0"] = origin
+            row["num_defect"] = -1
+            self._apply_stats(row, self.stats.get((layerID, correction)))
+            self.rows.append(row)
+            self.chunk_size += img.nbytes
+            self.unflushed += 1
+            if self.unflushed >= self.flush_every:
+                self._write_index()
+
+    def _apply_stats(self, row, stats):
+        if stats is None:
+            return
+        for name, value in stats.items():
+            row[name] = value
+
+    # defect statistics of a pass, defects: structured array of defect_extraction.extract_defects or None
+    def record_detection(self, layerID, num_defect, fixed, defects = None, binary_threshold = 0,
+                         correction = False):
+        stats = {"num_defect": num_defect, "fixed": fixed, "binary_threshold": binary_threshold,
+                 "total_defect_area": 0, "max_defect_area": 0}
+        if defects is not None and len(defects) > 0:
+            stats["total_defect_area"] = int(defects["area"].sum())
+            stats["max_defect_area"] = int(defects["area"].max())
+        with self.lock:
+            self.stats[(layerID, correction)] = stats
+            for row in self.rows:
+                if row["layer"] == layerID and row["correction"] == correction:
+                    self._apply_stats(row, stats)
+            self._write_index()
+
+    # rewrite the index atomically
+    def _write_index(self):
+        index = np.array(self.rows, dtype=INDEX_DTYPE)
+        tmp_path = os.path.join(self.archive_dir, "index.tmp.npy")
+        np.save(tmp_path, index)
+        os.replace(tmp_path, os.path.join(self.archive_dir, "index.npy"))
+        self.unflushed = 0
+
+    def flush(self):
+        with self.lock:
+            self._write_index()
+
+    def close(self):
+        self.flush()
+
+
+class RunArchiveReader:
+    """
+    Memory-mapped access to the images of a run archive
+    """
+    def __init__(self, archive_dir):
+        self.archive_dir = archive_dir
+        with open(os.path.join(archive_dir, "meta.json"), "r") as f:
+            self.meta = json.load(f)
+        if self.meta.get("version") != ARCHIVE_VERSION:
+            raise ValueError("Archive version mismatch: {}".format(archive_dir))
+        self.index = np.load(os.path.join(archive_dir, "index.npy"))
+        self.chunks = {}
+
+    def __len__(self):
+        return len(self.index)
+
+    def layers(self):
+        return np.unique(self.index["layer"])
+
+    # index rows of the given layers (range or iterable), artifact and pass
+    def select(self, layers = None, artifact = None, correction = None):
+        keep = np.ones(len(self.index), dtype=bool)
+        if layers is not None:
+            if isinstance(layers, range) and layers.step == 1:
+                keep &= (self.index["layer"] >= layers.start) & (self.index["layer"] < layers.stop)
+            else:
+                keep &= np.isin(self.index["layer"], list(layers))
+        if artifact is not None:
+            keep &= self.index["artifact"] == ARTIFACTS.index(artifact)
+        if correction is not None:
+            keep &= self.index["correction"] == correction
+        return self.index[keep]
+
+    def _chunk(self, chunk):
+        data = self.chunks.get(chunk)
+        if data is None:
+            data = self.chunks[chunk] = np.memmap(chunk_path(self.archive_dir, chunk), dtype=np.uint8, mode="r")
+        return data
+
+    # read-only view of the image of an index row, nothing is copied or decoded
+    def image(self, row):
+        height, width, channels = int(row["height"]), int(row["width"]), int(row["channels"])
+        offset = int(row["offset"])
+        data = self._chunk(int(row["chunk"]))[offset:offset + height * width * channels]
+        if channels == 1:
+            return data.reshape(height, width)
+        return data.reshape(height, width, channels)
+
+    # (row, image) of the selected images
+    def images(self, layers = None, artifact = None, correction = None):
+        for row in self.select(layers, artifact, correction):
+            yield row, self.image(row)
+
+    # index row of the frame of every layer {layerID: row}, the corrected frames with correction set;
+    # the last one is taken when a layer was captured more than once (resumed run)
+    def layer_frames(self, correction = False):
+        rows = self.select(artifact="corrected" if correction else "frame", correction=correction)
+        return {int(row["layer"]): row for row in rows}
+
+    # one row per analysed pass of the given layers: layer, correction, time, defect statistics
+    def detections(self, layers = None):
+        rows = self.select(layers)
+        rows = rows[rows["num_defect"] >= 0]
+        _, first = np.unique(rows["layer"].astype(np.int64) * 2 + rows["correction"], return_index=True)
+        return rows[np.sort(first)]
+
+    # write the selected images as individual files with the usual names, returns the paths
+    def export(self, out_dir, layers = None, artifacts = None, formats = None):
+        formats = dict(DEFAULT_FORMATS) if formats is None else formats
+        os.makedirs(out_dir, exist_ok=True)
+        paths = []
+        for row in self.select(layers):
+            artifact = ARTIFACTS[row["artifact"]]
+            if artifacts is not None and artifact not in artifacts:
+                continue
+            path = os.path.join(out_dir, ARTIFACT_NAMES[artifact].format(row["layer"]) + formats[artifact])
+            cv.imwrite(path, self.image(row))
+            paths.append(path)
+        return paths
+
+
+# "1:80" (both included) or "1,5,9"
+def parse_layers(text):
+    if ":" in text:
+        first, last = [int(v) for v in text.split(":")]
+        return range(first, last + 1)
+    return [int(v) for v in text.split(",")]
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description="Inspect or export a run image archive")
+    parser.add_argument("command", choices=("info", "export"))
+    parser.add_argument("archive")
+    parser.add_argument("out_dir", nargs="?", default=None)
+    parser.add_argument("--layers", default=None, help="e.g. 1:80 or 1,5,9, all layers by default")
+    parser.add_argument("--artifacts", default=None, help="comma separated, e.g. frame,defect; all by default")
+    args = parser.parse_args(argv)
+
+    reader = RunArchiveReader(args.archive)
+    layers = None if args.layers is None else parse_layers(args.layers)
+    if args.command == "info":
+        print("{} images, layers {}, params {}".format(len(reader), reader.layers().tolist(), reader.meta["params"]))
+        for row in reader.detections(layers):
+            print("layer {:>4}{:>12}  defects {:>4}  total area {:>6}  max area {:>5}{}".format(
+                row["layer"], " correction" if row["correction"] else "", row["num_defect"],
+                row["total_defect_area"], row["max_defect_area"], "  FIXED" if row["fixed"] else ""))
+    else:
+        if args.out_dir is None:
+            parser.error("export needs an output directory")
+        artifacts = None if args.artifacts is None else args.artifacts.split(",")
+        paths = reader.export(args.out_dir, layers, artifacts)
+        print("exported {} images to {}".format(len(paths), args.out_dir))
+
+
+if __name__ == "__main__":
+    main()
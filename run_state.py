@@ -0,0 +1,200 @@
+"""
+Checkpointed run state
+
+This file keeps the progress of a closed-loop job in a JSON file so that a job
+stopped by a crash or a dropped serial link can be resumed instead of
+restarted. The file is replaced atomically after every completed stage of a
+layer (print, wipe, correction, correction_wipe). It holds the layer pointer,
+the detection results and corrections of every layer, the printer state to
+restore (temperatures, extruder mode and position), and the hashes of the
+G-code files and calibration the job was started with. A stage is only
+recorded once every line of it was acknowledged by the printer.
+
+On resume the hashes are checked, the printer state is reissued (see
+resume_gcode) and the job continues with the first stage not done yet. The
+printer must have kept power: Z is not homed again, so its position has to be
+known to the firmware.
+"""
+
+import os
+import json
+import time
+from gcode_layer_index import file_hash
+
+RUN_STATE_VERSION = 2
+
+
+# extruder position and mode (relative_e) after a block of G-code lines
+def extruder_position(gcode_lines, e = 0., relative_e = False):
+    for line in gcode_lines:
+        tokens = line.split(";")[0].split()
+        if not tokens:
+            continue
+        cmd = tokens[0]
+        if cmd in ("M83", "G91"):
+            relative_e = True
+        elif cmd in ("M82", "G90"):
+            relative_e = False
+        elif cmd in ("G0", "G1", "G92"):
+            for token in tokens[1:]:
+                if token[0] == "E":
+                    value = float(token[1:])
+                    e = value if cmd == "G92" or not relative_e else e + value
+    return e, relative_e
+
+
+# temperatures, extruder mode and position set by the start G-code (layer_0)
+def printer_state(start_gcode):
+    state = {"hotend": None, "bed": None}
+    for line in start_gcode:
+        tokens = line.split(";")[0].split()
+        if not tokens:
+            continue
+        cmd = tokens[0]
+        temperature = None
+        for token in tokens[1:]:
+            if token[0] == "S":
+                try:
+                    temperature = float(token[1:])
+                except ValueError:
+                    pass
+        if cmd in ("M104", "M109") and temperature is not None:
+            state["hotend"] = temperature
+        elif cmd in ("M140", "M190") and temperature is not None:
+            state["bed"] = temperature
+    state["e_position"], state["relative_e"] = extruder_position(start_gcode)
+    return state
+
+
+# G-code bringing a printer that kept power back to the state of an interrupted job, parked at
+# `park_position` (x, y) above the last printed layer at height z; in absolute E mode the extruder
+# position of the last finished stage is restored, so the next move does not extrude the whole job again
+def resume_gcode(state, park_position, z, lift = 1.):
+    lines = ["M107", "G21", "G90"]
+    if state["bed"] is not None:
+        lines.append("M140 S{:g}".format(state["bed"]))
+    if state["hotend"] is not None:
+        lines.append("M104 S{:g}".format(state["hotend"]))
+    if state["bed"] is not None:
+        lines.append("M190 S{:g}".format(state["bed"]))
+    if state["hotend"] is not None:
+        lines.append("M109 S{:g}".format(state["hotend"]))
+    lines.append("M83" if state["relative_e"] else "M82")
+    lines.append("G92 E0" if state["relative_e"] else "G92 E{:.5f}".format(state["e_position"]))
+    # home X and Y only, clear of the part
+    lines.append("G1 Z{:.3f} F720".format(z + lift))
+    lines.append("G28 X Y")
+    lines.append("G1 X{:.3f} Y{:.3f} F9000".format(park_position[0], park_position[1]))
+    lines.append("G1 Z{:.3f} F720".format(z))
+    lines.append("M400")
+    return lines
+
+
+class RunState:
+    """
+    Class for the persistent progress of a job
+    """
+    def __init__(self, path, state):
+        self.path = path
+        self.state = state
+
+    # new run state for a job, written immediately
+    @classmethod
+    def create(cls, path, gcode_path, detect_gcode_path, calibration, total_layer, start_gcode):
+        state = {
+            "version": RUN_STATE_VERSION,
+            "created": time.time(),
+            "updated": time.time(),
+            "gcode_path": gcode_path,
+            "gcode_hash": file_hash(gcode_path),
+            "detect_gcode_path": detect_gcode_path,
+            "detect_gcode_hash": file_hash(detect_gcode_path),
+            "calibration_path": calibration.path,
+            "calibration_hash": calibration.hash,
+            "total_layer": total_layer,
+            "printer_state": printer_state(start_gcode),
+            # last layer whose stages are all done
+            "layer": 0,
+            "layers": {},
+        }
+        run_state = cls(path, state)
+        run_state.save()
+        return run_state
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "r") as f:
+            state = json.load(f)
+        if state.get("version") != RUN_STATE_VERSION:
+            raise ValueError("Run state version mismatch: {}".format(path))
+        return cls(path, state)
+
+    # raise ValueError if the job files differ from the ones the run was started with
+    def check(self, gcode_path, detect_gcode_path, calibration):
+        mismatches = []
+        if file_hash(gcode_path) != self.state["gcode_hash"]:
+            mismatches.append("G-code {}".format(gcode_path))
+        if file_hash(detect_gcode_path) != self.state["detect_gcode_hash"]:
+            mismatches.append("detection G-code {}".format(detect_gcode_path))
+        if calibration.hash != self.state["calibration_hash"]:
+            mismatches.append("calibration {}".format(calibration.path))
+        if mismatches:
+            raise ValueError("Run state {} was written for a different {}".format(self.path, ", ".join(mismatches)))
+
+    # write to a temporary file and replace, so the file is never half written
+    def save(self):
+        self.state["updated"] = time.time()
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.state, f, indent=1)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+    # record of a layer, created on first use
+    def layer(self, layerID):
+        return self.state["layers"].setdefault(str(layerID), {"stages": []})
+
+    # stages of a layer already done
+    def stages(self, layerID):
+        record = self.state["layers"].get(str(layerID))
+        return set() if record is None else set(record["stages"])
+
+    # follow the extruder through a block of G-code the printer acknowledged, saved with the next stage
+    def advance_extruder(self, gcode_lines):
+        printer = self.state["printer_state"]
+        printer["e_position"], printer["relative_e"] = extruder_position(gcode_lines, printer["e_position"],
+                                                                         printer["relative_e"])
+
+    def stage_done(self, layerID, stage, **values):
+        record = self.layer(layerID)
+        if stage not in record["stages"]:
+            record["stages"].append(stage)
+        record.update(values)
+        self.save()
+
+    def layer_done(self, layerID):
+        self.layer(layerID)["done"] = True
+        self.state["layer"] = max(self.state["layer"], layerID)
+        self.save()
+
+    # first layer not finished
+    def resume_layer(self):
+        return self.state["layer"] + 1
+
+    # layer the nozzle was last printing on, 0 before the first layer
+    def park_layer(self):
+        layerID = self.resume_layer()
+        return layerID if "print" in self.stages(layerID) else layerID - 1
+
+    # results of the finished layers in the format of PrintOrchestrator.results
+    def results(self):
+        results = []
+        for key, record in sorted(self.state["layers"].items(), key=lambda item: int(item[0])):
+            if "fixed" in record:
+                results.append({"layer": int(key), "num_defect": record["num_defect"],
+                                "num_suspect": record.get("num_suspect", 0), "fixed": record["fixed"]})
+        return results
+
+    def fixed_layer_list(self):
+        return [result["layer"] for result in self.results() if result["fixed"]]
@@ -0,0 +1,167 @@
+"""
+Structured per-layer timing and telemetry
+
+This file records, for every layer of a job, the wall-clock duration of
+each stage (print, settle, capture, encode, detect, wipe, correction, ...)
+together with the defect statistics, and writes one record per layer to a
+JSONL and/or CSV file. At the end of the run a summary is written with the
+total idle time of the printer, the slowest stages and the time spent in
+corrections. Selected stages of selected layers can be run under cProfile.
+"""
+
+import os
+import csv
+import json
+import time
+import cProfile
+import threading
+from contextlib import contextmanager
+
+# stages in the order they happen; correction pass stages are prefixed with "correction_"
+STAGES = ("prepare_correction", "print", "settle", "capture", "encode", "detect", "wipe",
+          "correction", "correction_settle", "correction_capture", "correction_encode", "correction_wipe")
+# stages during which the printer is moving
+PRINTING_STAGES = ("print", "wipe", "correction", "correction_wipe")
+# stages running in the background, not on the critical path
+BACKGROUND_STAGES = ("prepare_correction",)
+
+
+class RunTelemetry:
+    """
+    Per-layer stage timings and defect statistics of a run
+    """
+    def __init__(self, jsonl_path = None, csv_path = None, summary_path = None,
+                 profile_layers = (), profile_stages = ("detect",), profile_dir = "./"):
+        self.jsonl_path = jsonl_path
+        self.csv_path = csv_path
+        self.summary_path = summary_path
+        self.profile_layers = set(profile_layers)
+        self.profile_stages = set(profile_stages)
+        self.profile_dir = profile_dir
+
+        self.lock = threading.Lock()
+        self.records = {}
+        self.finished = []
+        self.run_start = time.time()
+
+        if self.csv_path is not None and not os.path.exists(self.csv_path):
+            with open(self.csv_path, "w", newline="") as f:
+                csv.writer(f).writerow(self.csv_header())
+
+    def csv_header(self):
+        return (["layer", "start_time", "wall_s", "num_defect", "fixed", "total_defect_area", "max_defect_area"] +
+                ["{}_s".format(stage) for stage in STAGES])
+
+    def start_layer(self, layerID):
+        with self.lock:
+            self.records[layerID] = {"layer": layerID, "start_time": time.time(), "stages": {}}
+
+    # time a stage of a layer, optionally under cProfile
+    @contextmanager
+    def stage(self, layerID, name):
+        profiler = None
+        if layerID in self.profile_layers and name in self.profile_stages:
+            profiler = cProfile.Profile()
+            profiler.enable()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            duration = time.perf_counter() - start
+            if profiler is not None:
+                profiler.disable()
+                profiler.dump_stats(os.path.join(self.profile_dir, "layer_{}_{}.prof".format(layerID, name)))
+            with self.lock:
+                # background stages may finish after their layer was closed
+                if layerID in self.records:
+                    stages = self.records[layerID]["stages"]
+                    stages[name] = stages.get(name, 0.) + duration
+
+    # defect statistics, defects: structured array of defect_extraction.extract_defects or None
+    def record_defects(self, layerID, num_defect, fixed, defects = None):
+        with self.lock:
+            record = self.records[layerID]
+            record["num_defect"] = num_defect
+            record["fixed"] = fixed
+            if defects is not None and len(defects) > 0:
+                record["total_defect_area"] = int(defects["area"].sum())
+                record["max_defect_area"] = int(defects["area"].max())
+            else:
+                record["total_defect_area"] = 0
+                record["max_defect_area"] = 0
+
+    # motion barrier wait and extra settle time of a settle stage, with the confirmed head position, JSONL only
+    def record_settle(self, layerID, stage, motion_s, settle_s, position = None):
+        with self.lock:
+            settles = self.records[layerID].setdefault("settle", {})
+            settles[stage] = {"motion_s": motion_s, "settle_s": settle_s, "position": position}
+
+    # statistics of the live monitor of a layer (see live_monitor.LiveMonitor.report), JSONL only
+    def record_monitor(self, layerID, report):
+        with self.lock:
+            self.records[layerID]["monitor"] = report
+
+    def end_layer(self, layerID):
+        with self.lock:
+            record = self.records.pop(layerID)
+        record["wall_s"] = time.time() - record["start_time"]
+        self.finished.append(record)
+
+        if self.jsonl_path is not None:
+            with open(self.jsonl_path, "a") as f:
+                f.write(json.dumps(record) + "\n")
+        if self.csv_path is not None:
+            row = [record["layer"], record["start_time"], record["wall_s"], record.get("num_defect"),
+                   record.get("fixed"), record.get("total_defect_area"), record.get("max_defect_area")]
+            row += [record["stages"].get(stage, "") for stage in STAGES]
+            with open(self.csv_path, "a", newline="") as f:
+                csv.writer(f).writerow(row)
+        return record
+
+    def summary(self, num_slowest = 3):
+        stage_total = {}
+        stage_max = {}
+        idle_time = 0.
+        correction_time = 0.
+        motion_wait = settle_time = 0.
+        for record in self.finished:
+            for settle in record.get("settle", {}).values():
+                motion_wait += settle["motion_s"]
+                settle_time += settle["settle_s"]
+            printing = 0.
+            for stage, duration in record["stages"].items():
+                stage_total[stage] = stage_total.get(stage, 0.) + duration
+                stage_max[stage] = max(stage_max.get(stage, 0.), duration)
+                if stage in PRINTING_STAGES:
+                    printing += duration
+                if stage.startswith("correction"):
+                    correction_time += duration
+            idle_time += max(record["wall_s"] - printing, 0.)
+
+        slowest = sorted((s for s in stage_total if s not in BACKGROUND_STAGES),
+                         key=lambda s: stage_total[s], reverse=True)[:num_slowest]
+        return {
+            "layers": len(self.finished),
+            "fixed_layers": sum(1 for r in self.finished if r.get("fixed")),
+            "run_time_s": time.time() - self.run_start,
+            "layer_time_s": sum(r["wall_s"] for r in self.finished),
+            "idle_time_s": idle_time,
+            "correction_time_s": correction_time,
+            "motion_wait_s": motion_wait,
+            "settle_time_s": settle_time,
+            "stage_total_s": stage_total,
+            "stage_max_s": stage_max,
+            "slowest_stages": slowest,
+        }
+
+    def write_summary(self):
+        summary = self.summary()
+        if self.summary_path is not None:
+            with open(self.summary_path, "w") as f:
+                json.dump(summary, f, indent=2)
+        print("Run time {:.1f} s, idle {:.1f} s, corrections {:.1f} s, slowest stages: {}".format(
+            summary["run_time_s"], summary["idle_time_s"], summary["correction_time_s"],
+            ", ".join(summary["slowest_stages"])))
+        print("Settle: {:.1f} s waiting for moves to finish, {:.1f} s of settle budget".format(
+            summary["motion_wait_s"], summary["settle_time_s"]))
+        return summary
@@ -0,0 +1,66 @@
+"""
+Settings of a print job
+
+This file holds the printer, file, detection and correction settings of a
+job. iron_detect_and_correct.py runs the job with them, and the tools
+(defect_threshold_sweep.py, benchmark_stages.py, simulation.py and
+print_farm.py) take their defaults from here.
+"""
+
+printer_port = "COM3"
+camera_id = 1
+
+# Path to related files and directories
+gcode_path = './gcode/SmallBellow_Zwiping_37mm_generic_Oct30_0.3mm.gcode'
+gcode_noTri_path = './gcode/SmallBellow_only_Oct29_0.3mm.gcode'
+img_dir_path = './images/elp_0301_0/'
+log_dir_path = './logs/'
+log_file_name = '0301_shooting.txt'
+telemetry_name = '0301_shooting_telemetry'    # per-layer stage timings (.jsonl, .csv, _summary.json)
+run_state_name = '0301_shooting_state.json'    # progress checkpointed after every stage
+resume = False    # continue the interrupted job of run_state_name instead of starting a new one
+profile_layers = []     # layers whose detection is run under cProfile (.prof files in log_dir_path)
+bellow_dir = "./bellow_layer_gcode_file/"
+tri_dir = "./triangle_layer_gcode_file/"
+save_layer_files = False    # mirror the parsed layers to bellow_dir and tri_dir
+
+# Object names in the sliced G-code ("; stop printing object <name>")
+object_marker = "SmallBellow"
+wipe_marker = "wiping_pattern_z"
+
+# Hyperparameters
+parse_support_line = 1
+layer_height = 0.3
+delay_time = 3    # seconds slept before a picture, only without the motion barrier
+motion_barrier = True    # wait for the moves to finish (M400) before a picture instead of sleeping delay_time
+settle_time = 0.    # seconds waited after the moves finished, before a picture
+confirm_camera_pose = True    # check with M114 that the head is parked at img_taken_position
+enable_correction = True
+fixing_E_proportion = 0.2
+fixing_S_proportion = 0.6
+correction_radius = None    # mm, iron only the perimeters within this distance of a defect; None irons the whole layer
+total_layer = 80
+move_X = 180    # X coordinates for camera position
+move_Y = 152    # Y coordinates for camera position 
+img_taken_position = [move_X, move_Y]
+
+# threashold information for defect detection
+defect_threshold = 2
+binary_threshold = 85
+
+# Saved images: per-artifact enable flags and compression
+save_artifacts = {"frame": True, "corrected": True, "contour": True, "crop": True, "defect": True}
+jpeg_quality = 95
+png_compression = 3
+archive_images = False    # append the images to img_dir_path/archive (see run_archive.py) instead of files
+
+mask_precompute_processes = None    # None: one process per core
+roi_detection = True    # undistort and detect only around the projected part
+incremental_detection = False    # re-detect only the tiles that changed since the previous layer
+capture_resolution = (1920, 1080)    # e.g. (3840, 2160) for native 4K, the calibration is scaled to it
+multiscale_detection = False    # screen a downsampled level, refine candidate tiles at full resolution
+live_monitoring = False    # check the deposited path in the camera feed while the layer prints
+monitor_fps = 5.    # analysed frames per second of the live monitor
+
+# Camera matrix, distortion coefficients and nozzle to camera transform (see calibration.py)
+calibration_path = './calibration/elp_camera.json'
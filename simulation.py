@@ -0,0 +1,426 @@
+"""
+Simulated printer and replay camera
+
+This file provides backends to run the whole closed-loop job without
+hardware. SimulatedPrintcore has the printcore interface used by
+GcodeSender: it checks line numbers and checksums, acknowledges lines
+through a planner buffer of limited depth, and models the execution time of
+every move from its length and feed rate. RunReplay is a frame source with
+the cv2.VideoCapture interface serving the images of a recorded run (image
+files or an archive, see run_archive.py): the frame of a layer is shown once the simulated print head has parked at the
+camera position at that layer's height, after a few shaking frames.
+
+Example:
+    python simulation.py --layers 20 --time-scale 0.05
+    python simulation.py --gcode ./gcode/SmallBellow_Zwiping_37mm_generic_Oct30_0.3mm.gcode
+        --detect-gcode ./gcode/SmallBellow_only_Oct29_0.3mm.gcode --run-dir ./images/elp_0301_0/
+
+Without --gcode a synthetic part is generated, and without --run-dir its
+frames are rendered. Other settings default to the values in settings.py.
+"""
+
+import os
+import re
+import math
+import json
+import time
+import queue
+import random
+import shutil
+import tempfile
+import argparse
+import threading
+from collections import deque
+import numpy as np
+import cv2 as cv
+
+from synthetic_data import generate_gcode, FrameRenderer, FrameReplay
+from run_archive import RunArchiveReader, find_archive
+import settings as config
+
+# seconds taken by blocking commands, after the planner has emptied
+FIXED_TIMES = {"G28": 15., "G29": 0., "M109": 0., "M190": 0.}
+# maximum axis speeds in mm/s (Prusa MK3S firmware defaults)
+MAX_FEEDRATES = {"X": 200., "Y": 200., "Z": 12., "E": 120.}
+
+
+class SimulatedPrintcore:
+    """
+    In-process printer answering G-code like the firmware does over printcore
+    """
+    def __init__(self, time_scale = 1., buffer_size = 16, fixed_times = None, max_feedrates = None,
+                 error_rate = 0., seed = None):
+        # time_scale: wall seconds per simulated second
+        self.time_scale = time_scale
+        self.buffer_size = buffer_size
+        self.fixed_times = dict(FIXED_TIMES)
+        if fixed_times is not None:
+            self.fixed_times.update(fixed_times)
+        self.max_feedrates = dict(MAX_FEEDRATES)
+        if max_feedrates is not None:
+            self.max_feedrates.update(max_feedrates)
+        # probability of answering a line with a checksum error
+        self.error_rate = error_rate
+        self.rng = random.Random(seed)
+
+        self.online = True
+        self.onlinecb = None
+        self.recvcb = None
+        # called with (x, y, z, end time) for every travel move in the XY plane
+        self.park_callbacks = []
+
+        # machine state
+        self.pos = {"X": 0., "Y": 0., "Z": 0., "E": 0.}
+        self.feedrate = 1500.
+        self.relative = False
+        self.relative_e = False
+        self.expected_line = 1
+        # end times of the moves in the planner buffer
+        self.planned = deque()
+        self.busy_until = time.time()
+
+        self.machine_time = 0.
+        self.num_lines = 0
+        self.num_moves = 0
+        self.resends = 0
+
+        self.commands = queue.Queue()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def send_now(self, command):
+        self.commands.put(command)
+
+    def disconnect(self):
+        self.online = False
+        self.commands.put(None)
+
+    def _reply(self, line):
+        if self.recvcb is not None:
+            self.recvcb(line + "\n")
+
+    def _run(self):
+        while True:
+            command = self.commands.get()
+            if command is None:
+                return
+            code = command
+            if command.startswith("N"):
+                body, _, checksum = command.partition("*")
+                number, _, code = body.partition(" ")
+                expected = 0
+                for c in body:
+                    expected ^= ord(c)
+                if (checksum != str(expected) or int(number[1:]) != self.expected_line or
+                        self.rng.random() < self.error_rate):
+                    self.resends += 1
+                    self._reply("Error:checksum mismatch, Last Line: {}".format(self.expected_line - 1))
+                    self._reply("Resend: {}".format(self.expected_line))
+                    self._reply("ok")
+                    continue
+                self.expected_line += 1
+            self._execute(code)
+            self.num_lines += 1
+            self._reply("ok")
+
+    def _execute(self, code):
+        tokens = code.split(";")[0].split()
+        if not tokens:
+            return
+        cmd = tokens[0]
+        params = {}
+        for token in tokens[1:]:
+            try:
+                params[token[0]] = float(token[1:])
+            except ValueError:
+                pass
+
+        if cmd in ("G0", "G1"):
+            self._move(params)
+        elif cmd == "G4":
+            self._block(params.get("P", 0.) / 1000. + params.get("S", 0.))
+        elif cmd == "G90":
+            self.relative = False
+        elif cmd == "G91":
+            self.relative = True
+        elif cmd == "M82":
+            self.relative_e = False
+        elif cmd == "M83":
+            self.relative_e = True
+        elif cmd == "G92":
+            for axis, value in params.items():
+                if axis in self.pos:
+                    self.pos[axis] = value
+        elif cmd == "M110":
+            self.expected_line = int(params.get("N", 0)) + 1
+        elif cmd == "M400":
+            self._block(0.)
+        elif cmd == "M114":
+            self._reply("X:{:.2f} Y:{:.2f} Z:{:.2f} E:{:.2f} Count X: {:.2f} Y:{:.2f} Z:{:.2f}".format(
+                self.pos["X"], self.pos["Y"], self.pos["Z"], self.pos["E"], self.pos["X"], self.pos["Y"],
+                self.pos["Z"]))
+        elif cmd in self.fixed_times:
+            self._block(self.fixed_times[cmd])
+
+    # wait until all planned moves are done, then spend `duration` simulated seconds
+    def _block(self, duration):
+        wait = self.busy_until - time.time()
+        if wait > 0:
+            time.sleep(wait)
+        time.sleep(duration * self.time_scale)
+        self.machine_time += duration
+        self.busy_until = time.time()
+        self.planned.clear()
+
+    def _move(self, params):
+        target = dict(self.pos)
+        for axis in "XYZ":
+            if axis in params:
+                target[axis] = self.pos[axis] + params[axis] if self.relative else params[axis]
+        de = 0.
+        if "E" in params:
+            de = params["E"] if self.relative or self.relative_e else params["E"] - self.pos["E"]
+            target["E"] = self.pos["E"] + de
+        if "F" in params:
+            self.feedrate = params["F"]
+
+        deltas = {axis: abs(target[axis] - self.pos[axis]) for axis in "XYZ"}
+        deltas["E"] = abs(de)
+        length = math.sqrt(deltas["X"] ** 2 + deltas["Y"] ** 2 + deltas["Z"] ** 2)
+        if length == 0:
+            length = deltas["E"]
+        duration = length / (self.feedrate / 60.) if self.feedrate > 0 else 0.
+        # an axis may limit the speed of the move
+        for axis, delta in deltas.items():
+            duration = max(duration, delta / self.max_feedrates[axis])
+        end_time = self._plan(duration)
+
+        if deltas["X"] > 0 or deltas["Y"] > 0:
+            self.num_moves += 1
+            if de <= 0:
+                for callback in self.park_callbacks:
+                    callback(target["X"], target["Y"], target["Z"], end_time)
+        self.pos = target
+
+    # queue a move in the planner, waits while the planner buffer is full
+    def _plan(self, duration):
+        now = time.time()
+        end_time = max(now, self.busy_until) + duration * self.time_scale
+        self.busy_until = end_time
+        self.machine_time += duration
+        self.planned.append(end_time)
+        while self.planned and self.planned[0] <= now:
+            self.planned.popleft()
+        while len(self.planned) > self.buffer_size:
+            wait = self.planned[0] - time.time()
+            if wait > 0:
+                time.sleep(wait)
+            self.planned.popleft()
+        return end_time
+
+
+def find_run_images(run_dir):
+    layer_images = {}
+    corrected_images = {}
+    for filename in os.listdir(run_dir):
+        match = re.fullmatch(r"layer_(\d+)(_corrected)?\.(jpg|png)", filename)
+        if match:
+            images = corrected_images if match.group(2) else layer_images
+            images[int(match.group(1))] = os.path.join(run_dir, filename)
+    return layer_images, corrected_images
+
+
+class RunReplay(FrameReplay):
+    """
+    Frame source replaying the layer images of a recorded run as the print head parks at the camera
+    """
+    def __init__(self, run_dir, camera_position, layer_height = 0.3, first_layer_height = 0.2,
+                 fps = 30., jitter_frames = 5, jitter_px = 3, tolerance = 0.05):
+        # images of an archived run are index rows of the archive, file paths otherwise
+        self.archive = None
+        archive_dir = find_archive(run_dir)
+        if archive_dir is not None:
+            self.archive = RunArchiveReader(archive_dir)
+            self.layer_images = self.archive.layer_frames()
+            self.corrected_images = self.archive.layer_frames(correction=True)
+        else:
+            self.layer_images, self.corrected_images = find_run_images(run_dir)
+        if not self.layer_images:
+            raise ValueError("No layer_N images in {}".format(run_dir))
+        first = self.load(self.layer_images[min(self.layer_images)])
+        super().__init__([first], fps, jitter_frames, jitter_px)
+        self.camera_position = camera_position
+        self.layer_height = layer_height
+        self.first_layer_height = first_layer_height
+        self.tolerance = tolerance
+        self.lock = threading.Lock()
+        self.pending = deque()
+        self.parks = {}
+
+    def load(self, image):
+        if self.archive is not None:
+            return np.array(self.archive.image(image))
+        return cv.imread(image)
+
+    # SimulatedPrintcore park callback
+    def on_park(self, x, y, z, end_time):
+        if abs(x - self.camera_position[0]) > self.tolerance or abs(y - self.camera_position[1]) > self.tolerance:
+            return
+        layerID = int(round((z - self.first_layer_height) / self.layer_height)) + 1
+        with self.lock:
+            self.pending.append((end_time, layerID))
+
+    # the second park at a layer shows its corrected image, if there is one
+    def show(self, layerID):
+        parks = self.parks.get(layerID, 0)
+        self.parks[layerID] = parks + 1
+        image = self.corrected_images.get(layerID) if parks > 0 else None
+        image = self.layer_images.get(layerID) if image is None else image
+        if image is not None:
+            self.frames = [self.load(image)]
+            self.index = 0
+        self.settle()
+
+    def read(self, image = None):
+        with self.lock:
+            while self.pending and self.pending[0][0] <= time.time():
+                _, layerID = self.pending.popleft()
+                self.show(layerID)
+        return super().read(image)
+
+
+# render a synthetic run directory of layer_N.jpg frames
+def render_run(detector, run_dir, layers, num_defect = 5, seed = 0):
+    rng = np.random.default_rng(seed)
+    renderer = FrameRenderer(detector)
+    os.makedirs(run_dir, exist_ok=True)
+    for layerID in layers:
+        frame, _ = renderer.render(layerID, num_defect, rng=rng)
+        cv.imwrite(os.path.join(run_dir, "layer_{}.jpg".format(layerID)), frame)
+    return run_dir
+
+
+def simulate_job(config, calibration, gcode_path, detect_gcode_path, run_dir, workdir, total_layer,
+                 time_scale = 0.1, delay_time = None, correction_radius = None, roi_mode = True,
+                 error_rate = 0., motion_barrier = True):
+    from defect_detection import DefectDetection
+    from gcode_sender import GcodeSender
+    from camera_control import CameraControl
+    from layer_parsing_separate import split_layers
+    from layer_store import LayerStore
+    from localized_ironing import LocalizedIroning
+    from print_orchestrator import PrintOrchestrator
+    from run_telemetry import RunTelemetry
+
+    img_dir_path = os.path.join(workdir, "images") + os.sep
+    os.makedirs(img_dir_path, exist_ok=True)
+    layer_store = LayerStore()
+    split_layers(gcode_path, layer_store, config.object_marker, config.wipe_marker, config.img_taken_position)
+    detector = DefectDetection.from_calibration(calibration, detect_gcode_path, img_dir_path,
+                                                config.img_taken_position, config.layer_height, roi_mode=roi_mode)
+    local_ironing = None
+    if correction_radius is not None:
+        local_ironing = LocalizedIroning(gcode_path, correction_radius, E_proportion=config.fixing_E_proportion,
+                                         S_proportion=config.fixing_S_proportion,
+                                         end_position=config.img_taken_position)
+
+    printer = SimulatedPrintcore(time_scale, error_rate=error_rate)
+    replay = RunReplay(run_dir, config.img_taken_position, config.layer_height)
+    printer.park_callbacks.append(replay.on_park)
+    gcode_sender = GcodeSender(print_core=printer)
+    camera = CameraControl(capture=replay)
+    telemetry = RunTelemetry(summary_path=os.path.join(workdir, "telemetry_summary.json"))
+    orchestrator = PrintOrchestrator(gcode_sender, camera, detector, layer_store, img_dir_path,
+                                     os.path.join(workdir, "log.txt"),
+                                     defect_threshold=config.defect_threshold,
+                                     binary_threshold=config.binary_threshold,
+                                     delay_time=config.delay_time * time_scale if delay_time is None else delay_time,
+                                     motion_barrier=motion_barrier,
+                                     settle_time=config.settle_time * time_scale,
+                                     camera_position=config.img_taken_position if config.confirm_camera_pose else None,
+                                     enable_correction=config.enable_correction,
+                                     fixing_E_proportion=config.fixing_E_proportion,
+                                     fixing_S_proportion=config.fixing_S_proportion,
+                                     telemetry=telemetry, local_ironing=local_ironing)
+    detector.set_image_writer(orchestrator.image_writer)
+
+    start = time.time()
+    try:
+        gcode_sender.send_lines(layer_store.get("layer_0"))
+        orchestrator.run(1, total_layer)
+        gcode_sender.send_lines(layer_store.get("end"))
+    finally:
+        job_time = time.time() - start
+        camera.turn_off_cam()
+        gcode_sender.disconnect()
+    summary = orchestrator.telemetry.summary()
+    orchestrator.finish()
+    return {
+        "layers": total_layer,
+        "fixed_layers": len(orchestrator.fixed_layer_list),
+        "time_scale": time_scale,
+        "job_time_s": job_time,
+        "machine_time_s": printer.machine_time * time_scale,
+        "overhead_s": job_time - printer.machine_time * time_scale,
+        "lines": printer.num_lines,
+        "resends": printer.resends,
+        "stage_total_s": summary["stage_total_s"],
+    }
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description="Run the closed-loop job on a simulated printer and replay camera")
+    parser.add_argument("--gcode", default=None, help="sliced G-code with the wiping pattern, synthetic if not given")
+    parser.add_argument("--detect-gcode", default=None, help="G-code without the wiping pattern, defaults to --gcode")
+    parser.add_argument("--run-dir", default=None, help="recorded run images (layer_N.jpg or archive), rendered if not given")
+    parser.add_argument("--layers", type=int, default=None, help="layers to print, defaults to total_layer")
+    parser.add_argument("--time-scale", type=float, default=0.1, help="wall seconds per simulated second")
+    parser.add_argument("--delay-time", type=float, default=None, help="settle delay, defaults to the scaled one")
+    parser.add_argument("--no-motion-barrier", action="store_true", help="sleep the settle delay instead of M400")
+    parser.add_argument("--correction-radius", type=float, default=None, help="localized ironing radius in mm")
+    parser.add_argument("--error-rate", type=float, default=0., help="probability of a checksum error per line")
+    parser.add_argument("--no-roi", action="store_true")
+    parser.add_argument("--calibration", default=None)
+    parser.add_argument("--workdir", default=None, help="kept after the run if given")
+    parser.add_argument("--json", default=None, help="write the result to this file")
+    args = parser.parse_args(argv)
+
+    from calibration import load_calibration
+    from defect_detection import DefectDetection
+    calibration = load_calibration(config.calibration_path if args.calibration is None else args.calibration)
+    total_layer = config.total_layer if args.layers is None else args.layers
+    workdir = args.workdir or tempfile.mkdtemp(prefix="clp_sim_")
+    os.makedirs(workdir, exist_ok=True)
+    try:
+        gcode_path = args.gcode
+        if gcode_path is None:
+            center = (config.img_taken_position[0] - calibration.T_nozzle_cam[0, 3],
+                      config.img_taken_position[1] + calibration.T_nozzle_cam[1, 3])
+            gcode_path = generate_gcode(os.path.join(workdir, "part.gcode"), total_layer, center=center,
+                                        layer_height=config.layer_height, object_marker=config.object_marker,
+                                        wipe_marker=config.wipe_marker)
+        detect_gcode_path = gcode_path if args.detect_gcode is None else args.detect_gcode
+        run_dir = args.run_dir
+        if run_dir is None:
+            detector = DefectDetection.from_calibration(calibration, detect_gcode_path, workdir + os.sep,
+                                                        config.img_taken_position, config.layer_height)
+            run_dir = render_run(detector, os.path.join(workdir, "replay"), range(1, total_layer + 1))
+
+        result = simulate_job(config, calibration, gcode_path, detect_gcode_path, run_dir, workdir, total_layer,
+                              args.time_scale, args.delay_time, args.correction_radius, not args.no_roi,
+                              args.error_rate, not args.no_motion_barrier)
+    finally:
+        if args.workdir is None:
+            shutil.rmtree(workdir)
+
+    print("{} layers, {} fixed: job {:.1f} s, machine {:.1f} s, overhead {:.1f} s (time scale {})".format(
+        result["layers"], result["fixed_layers"], result["job_time_s"], result["machine_time_s"],
+        result["overhead_s"], result["time_scale"]))
+    if args.json is not None:
+        with open(args.json, "w") as f:
+            json.dump(result, f, indent=2)
+    return result
+
+
+if __name__ == "__main__":
+    main()
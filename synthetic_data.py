@@ -0,0 +1,199 @@
+"""
+Synthetic sliced G-code and camera frames
+
+This file generates PrusaSlicer-style G-code (;LAYER_CHANGE, ;Z:, ;TYPE:
+and object start/stop markers, with the wiping pattern printed after the
+part in every layer) of any number of layers and contours, and renders
+camera frames of a layer with injected defects, round holes and gaps of
+missing bead along the contour, distorted like the real camera. Both are used to benchmark and test the pipeline without a
+printer attached.
+"""
+
+import math
+import time
+import numpy as np
+import cv2 as cv
+
+
+def _ring(cx, cy, r, num_point):
+    angles = np.linspace(0, 2 * math.pi, num_point, endpoint=False)
+    return [(cx + r * math.cos(a), cy + r * math.sin(a)) for a in angles]
+
+
+def _extrude(points, lines, e_per_mm = 0.03):
+    # travel to the start, unretract, print the closed loop, retract
+    lines.append("G1 X{:.3f} Y{:.3f} F9000".format(*points[0]))
+    lines.append("G1 E.8 F2100")
+    lines.append("G1 F1200")
+    for p0, p1 in zip(points, points[1:] + points[:1]):
+        length = math.hypot(p1[0] - p0[0], p1[1] - p0[1])
+        lines.append("G1 X{:.3f} Y{:.3f} E{:.5f}".format(p1[0], p1[1], length * e_per_mm))
+    lines.append("G1 E-.8 F2100")
+
+
+# write a sliced G-code file; contours are circles on a grid centred on `center`
+def generate_gcode(gcode_path, num_layer = 20, num_contour = 1, points_per_contour = 120,
+                   center = (124.7, 107.7), size = 16., layer_height = 0.3, first_layer_height = 0.2,
+                   object_marker = "SmallBellow", wipe_marker = "wiping_pattern_z", infill = True):
+    grid = int(math.ceil(math.sqrt(num_contour)))
+    cell = size / grid
+    centers = [(center[0] - size / 2 + cell * (k % grid + 0.5), center[1] - size / 2 + cell * (k // grid + 0.5))
+               for k in range(num_contour)]
+    radius = cell / 2 * 0.8
+
+    lines = ["; generated by synthetic_data.py", "M73 P0 R10", "M201 X1000 Y1000 Z200 E5000",
+             "M104 S230", "M140 S60", "M190 S60", "M109 S230", "G28 W", "G92 E0", "M83", "G21", "G90",
+             "M107"]
+    for layer in range(1, num_layer + 1):
+        z = first_layer_height + (layer - 1) * layer_height
+        lines += [";LAYER_CHANGE", ";Z:{:.2f}".format(z), ";HEIGHT:{}".format(layer_height),
+                  "G1 Z{:.2f} F720".format(z),
+                  "; printing object {} id:0 copy 0".format(object_marker)]
+        for cx, cy in centers:
+            lines.append(";TYPE:Perimeter")
+            _extrude(_ring(cx, cy, radius * 0.85, points_per_contour), lines)
+            lines.append(";TYPE:External perimeter")
+            _extrude(_ring(cx, cy, radius, points_per_contour), lines)
+            if infill:
+                lines.append(";TYPE:Solid infill")
+                r = radius * 0.7
+                zigzag = [(cx - r, cy + r * (k / 4. - 1)) if k % 2 == 0 else (cx + r, cy + r * (k / 4. - 1))
+                          for k in range(9)]
+                _extrude(zigzag, lines)
+        lines.append("; stop printing object {} id:0 copy 0".format(object_marker))
+        if wipe_marker is not None:
+            lines.append("; printing object {} id:1 copy 0".format(wipe_marker))
+            lines.append(";TYPE:External perimeter")
+            _extrude([(20., 20.), (30., 20.), (25., 28.)], lines)
+            lines.append("; stop printing object {} id:1 copy 0".format(wipe_marker))
+    lines += ["M107", "G1 Z{:.2f} F720".format(first_layer_height + num_layer * layer_height + 10),
+              "M104 S0", "M140 S0", "M84"]
+
+    with open(gcode_path, "w") as f:
+        for l in lines:
+            f.write(l + "\n")
+    return gcode_path
+
+
+class FrameRenderer:
+    """
+    Render distorted camera frames of a layer as seen by a DefectDetection setup
+    """
+    def __init__(self, defect_detector, background = 60, part = 190, hole = 25, noise = 4.):
+        self.detector = defect_detector
+        self.background = background
+        self.part = part
+        self.hole = hole
+        self.noise = noise
+
+        # distorted pixel -> undistorted pixel, used to distort the rendered image
+        (width, height) = defect_detector.img_shape
+        grid = np.mgrid[0:height, 0:width][::-1].reshape(2, -1).T.astype(np.float32).reshape(-1, 1, 2)
+        undistorted = cv.undistortPoints(grid, defect_detector.camera_matrix, defect_detector.dist_coeffs,
+                                         P=defect_detector.undistort_camera_matrix)
+        self.mapx = undistorted[:, 0, 0].reshape(height, width)
+        self.mapy = undistorted[:, 0, 1].reshape(height, width)
+
+    # frame of a layer with `num_defect` dark holes inside the part and `num_gap` gaps, stretches of missing
+    # bead along the layer contour (elongated defects); returns (frame, hole and gap centres)
+    def render(self, layerID, num_defect = 5, defect_radius = (2, 5), rng = None, num_gap = 2,
+               gap_length = (12, 30), gap_width = 3):
+        rng = np.random.default_rng() if rng is None else rng
+        layer_mask = self.detector.build_layer_mask(layerID)
+        mask = layer_mask.full()
+        img = np.full(mask.shape, self.background, dtype=np.float32)
+        img[mask > 0] = self.part
+        img += rng.normal(0, self.noise, img.shape).astype(np.float32)
+        img = np.clip(img, 0, 255).astype(np.uint8)
+
+        inside = np.argwhere(mask > 0)
+        centres = []
+        if len(inside) > 0:
+            for k in rng.choice(len(inside), size=min(num_defect, len(inside)), replace=False):
+                y, x = inside[k]
+                cv.circle(img, (int(x), int(y)), int(rng.integers(defect_radius[0], defect_radius[1] + 1)),
+                          self.hole, -1)
+                centres.append((int(x), int(y)))
+            for _ in range(num_gap):
+                centre = self._gap(img, mask, layer_mask.polylines, rng.uniform(*gap_length), gap_width, rng)
+                if centre is not None:
+                    centres.append(centre)
+
+        img = cv.remap(img, self.mapx, self.mapy, cv.INTER_LINEAR, borderValue=self.background)
+        return cv.cvtColor(img, cv.COLOR_GRAY2BGR), centres
+
+    # darken `width` pixels inside the part along a stretch of `length` pixels of a random contour,
+    # returns the middle of the stretch, None when the contour is shorter
+    def _gap(self, img, mask, polylines, length, width, rng):
+        # contours in view only (the wiping pattern is outside the frame)
+        height, width_px = mask.shape
+        polylines = [p for p in polylines if len(p) > 1 and (p.reshape(-1, 2).min(axis=0) >= 0).all() and
+                     (p.reshape(-1, 2).max(axis=0) < (width_px, height)).all()]
+        if not polylines:
+            return None
+        points = np.asarray(polylines[rng.integers(len(polylines))], dtype=np.float64).reshape(-1, 2)
+        closed = np.vstack([points, points[:1]])
+        arc = np.concatenate([[0.], np.cumsum(np.hypot(*np.diff(closed, axis=0).T))])
+        if arc[-1] <= length:
+            return None
+        start = rng.uniform(0., arc[-1] - length)
+        samples = np.linspace(start, start + length, max(int(length), 2))
+        stretch = np.stack([np.interp(samples, arc, closed[:, 0]), np.interp(samples, arc, closed[:, 1])], axis=1)
+        stretch = np.int32(np.round(stretch))
+
+        # stroke centred on the contour, only its half inside the part is kept
+        x0, y0 = np.maximum(stretch.min(axis=0) - width - 1, 0)
+        x1, y1 = stretch.max(axis=0) + width + 2
+        stroke = np.zeros((y1 - y0, x1 - x0), dtype=np.uint8)
+        cv.polylines(stroke, [stretch - (x0, y0)], False, 255, 2 * width + 1)
+        stroke = stroke[:height - y0, :width_px - x0]
+        region = (slice(y0, y0 + stroke.shape[0]), slice(x0, x0 + stroke.shape[1]))
+        img[region][(stroke > 0) & (mask[region] > 0)] = self.hole
+        x, y = stretch[len(stretch) // 2]
+        return int(x), int(y)
+
+
+class FrameReplay:
+    """
+    Frame source with the cv2.VideoCapture interface, serving frames in a loop at a fixed rate
+
+    After every settle() call the next `jitter_frames` frames are shifted by a
+    few pixels, like a camera still shaking after the print head parked.
+    """
+    def __init__(self, frames, fps = 30., jitter_frames = 0, jitter_px = 3):
+        self.frames = frames
+        self.period = 1. / fps
+        self.jitter_frames = jitter_frames
+        self.jitter_px = jitter_px
+        self.index = 0
+        self.jitter_left = jitter_frames
+        self.last_read = 0.
+        self.opened = True
+
+    def settle(self):
+        self.jitter_left = self.jitter_frames
+
+    def isOpened(self):
+        return self.opened
+
+    def set(self, prop_id, value):
+        return True
+
+    def read(self, image = None):
+        wait = self.last_read + self.period - time.time()
+        if wait > 0:
+            time.sleep(wait)
+        self.last_read = time.time()
+
+        frame = self.frames[self.index % len(self.frames)]
+        self.index += 1
+        if self.jitter_left > 0:
+            self.jitter_left -= 1
+            frame = np.roll(frame, self.jitter_px * (1 if self.jitter_left % 2 else -1), axis=1)
+        if image is not None and image.shape == frame.shape:
+            image[...] = frame
+            return True, image
+        return True, frame.copy()
+
+    def release(self):
+        self.opened = False